@@ -51,6 +51,7 @@ EXTRAS = {
           'FUSE':  [],               # required for jotta-fuse
           'monitor': ['watchdog',],  # required for jotta-monitor
           'scanner': [],             # optional for jotta-scanner
+          'async': ['aiohttp',],     # required for jottalib.aio
         }
 
 if sys.platform != 'win32':
@@ -40,9 +40,7 @@ def get_jotta_device(jfs):
 
 
 def get_root_dir(jfs):
-    jottadev = get_jotta_device(jfs)
-    root_dir = jottadev.mountPoints['Archive']
-    return root_dir
+    return jfs.getFolder('/Jotta/Archive') # a well known path, no need to look at the devices
 
 
 def set_jottalib_logging_level(log_level):
@@ -116,9 +114,7 @@ class JottaCloudBackend(duplicity.backend.Backend):
         # - Retried if an exception is thrown
         remote_file = self.client.getObject(posixpath.join(self.folder.path, remote_filename))
         log.Debug('jottacloud.get(%s,%s): %s' % (remote_filename, local_path.name, remote_file))
-        with open(local_path.name, 'wb') as to_file:
-            for chunk in remote_file.stream():
-                to_file.write(chunk)
+        remote_file.download_to(local_path.name) # straight from the socket into the preallocated file
     get = _get
 
     def _list(self):
@@ -138,6 +134,16 @@ class JottaCloudBackend(duplicity.backend.Backend):
         remote_file.delete()
     delete = _delete
 
+    def _delete_list(self, filename_list):
+        # - Delete a list of files, looking them all up in one go
+        remote_paths = [posixpath.join(self.folder.path, f) for f in filename_list]
+        remote_files = self.client.getObjects(remote_paths)
+        for remote_path in remote_paths:
+            remote_file = remote_files.get(remote_path) or self.client.getObject(remote_path)
+            log.Debug('jottacloud.delete deleting: %s (%s)' % (remote_file, type(remote_file)))
+            remote_file.delete()
+    delete_list = _delete_list
+
     def _query(self, filename):
         """Get size of filename"""
         #  - Query metadata of one file
@@ -155,6 +161,17 @@ class JottaCloudBackend(duplicity.backend.Backend):
         }
     query = _query
 
+    def _query_list(self, filename_list):
+        """Get sizes of a list of filenames, looking them all up in one go"""
+        log.Info('Querying size of %s files' % len(filename_list))
+        remote_files = self.client.getObjects([posixpath.join(self.folder.path, f) for f in filename_list])
+        result = {}
+        for filename in filename_list:
+            remote_file = remote_files.get(posixpath.join(self.folder.path, filename))
+            result[filename] = {'size': remote_file.size if remote_file is not None else -1}
+        return result
+    query_list = _query_list
+
     def _close(self):
         # - If your backend needs to clean up after itself, do that here.
         pass
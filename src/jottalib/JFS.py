@@ -23,21 +23,30 @@ __author__ = 'havard@gulldahl.no'
 from jottalib import __version__
 
 # importing stdlib
-import sys, os, os.path, time
+import sys, os, os.path, re, time, calendar
 import posixpath, logging, datetime, hashlib
-import tempfile
-from collections import namedtuple
+import tempfile, threading, itertools, mmap, errno, socket, warnings
+from collections import deque
 import six
+from six.moves import queue, http_client
 
 # importing external dependencies (pip these, please!)
 import requests
 from requests.utils import quote
 import netrc
-import requests_toolbelt
-import certifi
 
-import lxml, lxml.objectify
-import dateutil, dateutil.parser # pip install python-dateutil
+import lxml, lxml.objectify, lxml.etree
+import dateutil, dateutil.parser, dateutil.tz # pip install python-dateutil
+
+# import our stuff
+from jottalib.cache import ObjectCache, SingleFlight
+from jottalib.httpcache import HTTPCache, HTTPCACHE_DIR
+from jottalib.retry import RetryPolicy
+from jottalib.throttle import TokenBucket, Throttle, ThrottledReader, ThrottledBody, GLOBAL_UPLOAD, GLOBAL_DOWNLOAD
+from jottalib.multipart import MultipartBody, UPLOAD_CHUNK_SIZE
+from jottalib.transport import TRANSPORTS
+from jottalib.readahead import ReadAhead, WaitCounter
+from jottalib.filedirtree import FileDirTree, TreeFile
 
 log = logging.getLogger(__name__)
 
@@ -51,6 +60,23 @@ urllib3.fields.format_header_param = mp
 # some setup
 JFS_ROOT='https://www.jottacloud.com/jfs/'
 
+# defaults for parallel, ranged downloads. see JFS.download()
+DOWNLOAD_WORKERS=4 # number of concurrent connections
+DOWNLOAD_RANGE_SIZE=16*1024*1024 # bytes per range request
+DOWNLOAD_RETRIES=3 # number of times in a row to retry a broken or stalled download before giving up
+STALL_TIMEOUT=60 # seconds a download may go without progress before we reconnect, see JFS.iterrange()
+READAHEAD=0 # chunks JFS.stream() reads ahead of its consumer, in a background thread. 0: none
+REQUEST_TIMEOUT=1800 # seconds to wait for anything else
+
+# connection pools, one per JottaCloud host. see JFS.__init__()
+POOL_SIZE=10 # connections kept open to www.jottacloud.com (metadata and downloads)
+UPLOAD_POOL_SIZE=10 # connections kept open to up.jottacloud.com (uploads)
+IDEMPOTENT_POSTS=('mkDir', 'dl', 'dlDir') # POST parameters that are safe to repeat
+NOTFOUND_TTL=10 # seconds we remember that a path doesn't exist, see JFS.getObject()
+
+SPOOL_MAX_MEMORY=32*1024*1024 # how much of an upload to keep in memory before spooling to disk. see spool_and_hash()
+SPOOL_DIR=None # where uploads are spooled on disk. None: the temp dir of the system, see tempfile.gettempdir()
+
 # helper functions
 try:
     unicode("we are python2")
@@ -104,25 +130,180 @@ def calculate_md5(fileobject, size=2**16):
     fileobject.seek(0) # rewind read head
     return md5.hexdigest()
 
+def spool_and_hash(fileobject, max_memory=SPOOL_MAX_MEMORY, size=2**16, directory=None):
+    """Read fileobject once, calculating its md5 hash while copying it to a local spool.
+
+    The spool is kept in memory up to `max_memory` bytes, after that it is moved to a
+    temporary file on local disk, in `directory` (default: SPOOL_DIR). Returns a tuple of
+    (md5 hexdigest, spool), with the spool rewound to the start"""
+    md5 = hashlib.md5()
+    spool = six.BytesIO()
+    for data in iter(lambda: fileobject.read(size), b''):
+        if not data: break
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8') # md5 needs a byte string
+        md5.update(data)
+        if isinstance(spool, six.BytesIO) and spool.tell() + len(data) > max_memory:
+            # too big to keep in memory, move it to local disk
+            _spool = tempfile.TemporaryFile(dir=directory or SPOOL_DIR)
+            _spool.write(spool.getvalue())
+            spool = _spool
+        spool.write(data)
+    spool.seek(0)
+    return md5.hexdigest(), spool
+
+class IterableReader(object):
+    'Make an iterable of bytes, e.g. a generator, look like a file that we can .read() from'
+    def __init__(self, iterable):
+        self._chunks = iter(iterable)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode('utf-8')
+            self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def readable(source):
+    """Get something we can .read() the bytes of `source` from, for JFS.up().
+
+    A file-like object is returned as is, bytes are wrapped in a BytesIO, a socket is
+    made into a file, and anything else we can iterate over, e.g. a generator, in an IterableReader"""
+    if hasattr(source, 'read'):
+        return source
+    if isinstance(source, six.binary_type):
+        return six.BytesIO(source)
+    if hasattr(source, 'makefile'): # a socket
+        return source.makefile('rb')
+    try:
+        return IterableReader(source)
+    except TypeError:
+        raise JFSError('Need a file-like object, bytes, a socket or an iterable of bytes, not %r' % (source, ))
+
+def seekable(fileobject):
+    'Can we seek in fileobject, to find its length and read it again? Pipes, sockets and stdin usually not'
+    try:
+        if hasattr(fileobject, 'seekable'):
+            return fileobject.seekable()
+        fileobject.tell() # python 2 files
+        return hasattr(fileobject, 'seek')
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+UTC = dateutil.tz.tzutc()
+XML_TIME = re.compile(br' time="([^"]+)"') # when JottaCloud made an xml document, see JFS.xml()
+_timestamps = {} # timestamp string -> datetime.datetime, see parse_timestamp()
+TIMESTAMP_MEMO_SIZE=50000
+
+def parse_timestamp(timestamp):
+    '''Parse a JottaCloud timestamp, e.g. '2014-02-20-T14:03:52Z', to a timezone aware datetime.datetime.
+
+    JottaCloud always uses this format, so we slice it up ourselves, which is a lot faster
+    than dateutil.parser.parse(). Anything else is handed over to dateutil.
+
+    Listings repeat the same timestamps a lot (created == modified, files uploaded together),
+    so we remember the last few thousand, and hand out the same (immutable) datetime object
+    for the same string'''
+    if timestamp is None:
+        return None
+    try:
+        return _timestamps[timestamp]
+    except KeyError:
+        pass
+    if len(timestamp) == 21 and timestamp[10:12] == '-T' and timestamp[20] == 'Z':
+        try:
+            dt = datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                                   int(timestamp[12:14]), int(timestamp[15:17]), int(timestamp[18:20]),
+                                   tzinfo=UTC)
+        except ValueError:
+            dt = dateutil.parser.parse(timestamp)
+    else:
+        dt = dateutil.parser.parse(timestamp)
+    if len(_timestamps) >= TIMESTAMP_MEMO_SIZE:
+        _timestamps.clear()
+    _timestamps[timestamp] = dt
+    return dt
+
+def range_header(start, end=None):
+    '''Get the value of a http Range header for the bytes from `start` to `end` (integers),
+    or to the end of the file, if end is None.
+
+    Note that we deduct 1 from end because in http Range requests, the end value
+    is included in the slice, whereas in python, it is not'''
+    if end is None:
+        return 'bytes=%s-' % start
+    return 'bytes=%s-%s' % (start, end-1)
+
+def byteranges(size, range_size):
+    'Split `size` bytes into a list of (start, end) tuples, each spanning at most `range_size` bytes'
+    return [(start, min(start+range_size, size)) for start in range(0, size, range_size)]
+
+def preallocate(fd, size):
+    '''Make the file at `fd` (a file descriptor) `size` bytes long, and have the file system set
+    aside the blocks up front with posix_fallocate(), where we have it. A big download then runs out
+    of disk before it starts rather than halfway, and isn't scattered all over the disk'''
+    os.ftruncate(fd, size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP): # e.g. ENOSPC
+                raise
+            log.debug('file system can not preallocate (%r), the file is sparse', e)
+
+def fadvise(fd, advice, offset=0, length=0):
+    '''Tell the kernel how we will use the file at `fd`, with posix_fadvise(), where we have it.
+    `advice` is the name of a POSIX_FADV_* constant, e.g. 'SEQUENTIAL' or 'DONTNEED'. It's only a hint'''
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_%s' % advice))
+        except OSError as e:
+            log.debug('posix_fadvise(%s) failed: %r', advice, e)
+
+def rawreader(response):
+    '''Get a readinto() function for the body of `response` (from a Transport), that fills a buffer
+    straight from the socket.
+
+    urllib3 .readinto() reads into bytes of its own and copies those over, so unless the body
+    has a Content-Encoding that urllib3 must decode, we go to the http.client response under it'''
+    fp = getattr(response.raw, '_fp', None)
+    if fp is not None and hasattr(fp, 'readinto') and not response.headers.get('Content-Encoding'):
+        return fp.readinto
+    return response.raw.readinto
+
+READ_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError,
+               http_client.HTTPException, socket.error) # a body that broke off, see JFS.readinto()
+
 # error classes
 
 class JFSError(Exception):
     @staticmethod
-    def raiseError(e, path): # parse object from lxml.objectify and
-        if(e.code) == 404:
-            raise JFSNotFoundError('%s does not exist (%s)' % (path, e.message))
-        elif(e.code) == 401:
-            raise JFSCredentialsError("Your credentials don't match for %s (%s) (probably incorrect password!)" % (path, e.message))
-        elif(e.code) == 403:
-            raise JFSAuthenticationError("You don't have access to %s (%s)" % (path, e.message))
-        elif(e.code) == 416:
-            raise JFSRangeError("Requested Range Not Satisfiable (%s)" % e.message)
-        elif(e.code) == 500:
-            raise JFSServerError("Internal server error: %s (%s)" % (path, e.message))
-        elif(e.code) == 400:
-            raise JFSBadRequestError('Bad request: %s (%s)' % (path, e.message))
+    def raiseError(e, path): # parse <error> object from lxml.objectify or lxml.etree and raise the corresponding exception
+        code = e.findtext('code')
+        code = int(code) if code is not None and code.strip().isdigit() else None
+        message = e.findtext('message')
+        if code == 404:
+            raise JFSNotFoundError('%s does not exist (%s)' % (path, message))
+        elif code == 401:
+            raise JFSCredentialsError("Your credentials don't match for %s (%s) (probably incorrect password!)" % (path, message))
+        elif code == 403:
+            raise JFSAuthenticationError("You don't have access to %s (%s)" % (path, message))
+        elif code == 416:
+            raise JFSRangeError("Requested Range Not Satisfiable (%s)" % message)
+        elif code == 500:
+            raise JFSServerError("Internal server error: %s (%s)" % (path, message))
+        elif code == 400:
+            raise JFSBadRequestError('Bad request: %s (%s)' % (path, message))
         else:
-            raise JFSError('Error accessing %s (%s)' % (path, e.message))
+            raise JFSError('Error accessing %s (%s)' % (path, message))
 
 class JFSBadRequestError(JFSError): # HTTP 400
     pass
@@ -145,6 +326,9 @@ class JFSRangeError(JFSError): # HTTP 416
 class JFSServerError(JFSError): # HTTP 500
     pass
 
+class JFSStallError(JFSError): # a download that stalled or ended early
+    pass
+
 # classes mapping JFS structures
 
 
@@ -153,8 +337,8 @@ class JFSFileDirList(object):
 
        Get a <filedirlist> for any jottafolder by appending ?mode=list to your query
 
-       Then you will get this object, with a .tree property, which is a list of all
-       files and folders.
+       Then you will get this object, with a .tree property, which is a mapping of
+       folder paths to lists of files.
 
        Files will be a namedtuple() with five properties:
          .name - file name
@@ -163,6 +347,12 @@ class JFSFileDirList(object):
          .md5 - jottacloud file hash (str or None): corrupt files have no md5 hash
          .uuid - jottacloud assigned uuid
 
+       Behind .tree, the files are kept in a compact, columnar jottalib.filedirtree.FileDirTree,
+       available as .files, which also has lookups by path and md5 and some handy aggregates,
+       e.g. .files.folder_sizes() and .files.state_counts().
+
+       For really big trees, skip the xml and build a FileDirTree straight from JFS.iterfiledirlist()
+
     <filedirlist time="2015-05-28-T18:57:06Z" host="dn-093.site-000.jotta.no">
         <folders>
           <folder name="Sync">
@@ -173,109 +363,135 @@ class JFSFileDirList(object):
 
 
     def __init__(self, filedirlistobject, jfs, parentpath): # filedirlistobject from lxml.objectify
-        self.filedirlist = filedirlistobject
         self.parentPath = parentpath
         self.jfs = jfs
+        self.files = FileDirTree.fromiter(_treefolder(folder)
+                                          for folder in filedirlistobject.find('folders').iterchildren(tag='folder'))
 
-        treefile = namedtuple('TreeFile', 'name size md5 uuid state')
-
-        self.tree = {}
-        for folder in self.filedirlist.folders.iterchildren():
-            foldername = unicode(folder.attrib.get('name'))
-            path = unicode(folder.path)
-            t = []
-            if hasattr(folder, 'files'):
-                for file_ in folder.files.iterchildren():
-                    if hasattr(file_, 'currentRevision'): # a normal file
-                        t.append(treefile(unicode(file_.attrib['name']),
-                                          int(file_.currentRevision.size),
-                                          unicode(file_.currentRevision.md5),
-                                          unicode(file_.attrib['uuid']),
-                                          unicode(file_.currentRevision.state)
-                                          )
-                                 )
-                    else:
-                        # This is an incomplete or, possibly, corrupt file
-                        #
-                        # Incomplete files have no `size` in a filedirlist, you
-                        # need to fetch the JFSFile explicitly to see that property
-                        try:
-                            # incomplete files carry a md5 hash,
-                            _md5 = unicode(file_.latestRevision.md5)
-                        except AttributeError:
-                            # while other may not
-                            # see discussion in #88
-                            _md5 = None
-                        t.append(treefile(unicode(file_.attrib['name']),
-                                          None, # return size as None
-                                          _md5,
-                                          unicode(file_.attrib['uuid']),
-                                          unicode(file_.latestRevision.state)
-                                          )
-                                 )
-            self.tree[posixpath.join(path, foldername)] = t
+    @property
+    def tree(self):
+        'A read only mapping of folderpath -> [TreeFile, ...]'
+        return self.files.tree()
 
+    @property
+    def filedirlist(self):
+        'Removed in 0.6: we no longer keep the xml around. Use .tree or .files'
+        raise JFSError('JFSFileDirList.filedirlist was removed in 0.6, use .tree or .files instead, '
+                       'or JFS.get(url, params={"mode": "list"}) for the xml')
+
+
+def _treefile(file_):
+    'Decode a <file> element from a <filedirlist> to a TreeFile. Works on both lxml.etree and lxml.objectify elements'
+    revision = file_.find('currentRevision')
+    if revision is not None: # a normal file
+        return TreeFile(unicode(file_.get('name')),
+                        int(revision.findtext('size')),
+                        unicode(revision.findtext('md5')),
+                        unicode(file_.get('uuid')),
+                        unicode(revision.findtext('state'))
+                        )
+    # This is an incomplete or, possibly, corrupt file
+    #
+    # Incomplete files have no `size` in a filedirlist, you
+    # need to fetch the JFSFile explicitly to see that property
+    revision = file_.find('latestRevision')
+    # incomplete files carry a md5 hash, while other may not
+    # see discussion in #88
+    _md5 = revision.findtext('md5')
+    return TreeFile(unicode(file_.get('name')),
+                    None, # return size as None
+                    unicode(_md5) if _md5 is not None else None,
+                    unicode(file_.get('uuid')),
+                    unicode(revision.findtext('state'))
+                    )
+
+def _treefolder(folder):
+    'Decode a <folder> element from a <filedirlist>. Returns a tuple of (folderpath, [TreeFile, ...])'
+    path = posixpath.join(unicode(folder.findtext('path')), unicode(folder.get('name')))
+    files = folder.find('files')
+    if files is None:
+        return path, []
+    return path, [_treefile(f) for f in files.iterchildren(tag='file')]
 
 
 class JFSFolder(object):
-    'OO interface to a folder, for convenient access. Type less, do more.'
+    '''OO interface to a folder, for convenient access. Type less, do more.
+
+    Everything we need is picked out of the xml when the object is created (see .decode()),
+    including the subfolders and files, if the xml lists them. Then the xml is let go.'''
+    __slots__ = ('jfs', 'parentPath', 'synced', 'name', 'deleted', '_folders', '_files')
+
     def __init__(self, folderobject, jfs, parentpath): # folderobject from lxml.objectify
-        self.folder = folderobject
         self.parentPath = parentpath
         self.jfs = jfs
         self.synced = False
-
-    @property
-    def name(self):
-        if self.folder.attrib.has_key('name'):
-            return unicode(self.folder.attrib['name'])
-        return unicode(self.folder.name)
+        self.decode(folderobject)
+
+    def decode(self, folderobject):
+        'Update our metadata, subfolders and files from a <folder> (or <mountPoint>) element'
+        _name = folderobject.get('name')
+        self.name = unicode(_name if _name is not None else folderobject.findtext('name'))
+        self.deleted = parse_timestamp(folderobject.get('deleted')) # datetime.datetime or None if the folder isnt deleted
+        path = '%s/%s' % (self.parentPath, self.name)
+        self._folders = []
+        self._files = []
+        _folders = folderobject.find('folders')
+        if _folders is not None:
+            self._folders = [self.jfs.wrappers['folder'](f, self.jfs, path) for f in _folders.iterchildren(tag='folder')]
+        _files = folderobject.find('files')
+        if _files is not None:
+            for _f in _files.iterchildren(tag='file'):
+                if next(_f.iterchildren('currentRevision'), None) is not None: # a normal file
+                    self._files.append(self.jfs.wrappers['file'](_f, self.jfs, path))
+                else:
+                    self._files.append(self.jfs.wrappers['incompleteFile'](_f, self.jfs, path))
 
     @property
     def path(self):
-        log.debug('path: %r + %r', self.parentPath, self.name)
         return '%s/%s' % (self.parentPath, self.name)
 
     @property
-    def deleted(self):
-        'Return datetime.datetime or None if the file isnt deleted'
-        _d = self.folder.attrib.get('deleted', None)
-        if _d is None: return None
-        return dateutil.parser.parse(str(_d))
+    def folder(self):
+        'Deprecated since 0.6: we no longer keep the xml around, so this fetches it again'
+        warnings.warn('%s.folder is deprecated, it fetches %s again every time' % (type(self).__name__, self.path),
+                      DeprecationWarning, stacklevel=2)
+        return self.jfs.get(self.path)
 
     def sync(self):
         'Update state of folder from Jottacloud server'
         log.info("syncing %r" % self.path)
-        self.folder = self.jfs.get(self.path)
+        self.decode(self.jfs.get(self.path, objectify=False))
         self.synced = True
 
+    def update(self, obj):
+        '''Bring our subfolders and files up to date with obj, a JFSFolder or JFS*File that JottaCloud
+        just gave us for a change we made here, without fetching the whole folder again.
+
+        If we haven't been synced yet, there's nothing to update: we'll get it all on next read'''
+        if not self.synced:
+            return
+        children = self._folders if isinstance(obj, JFSFolder) else self._files
+        for i, child in enumerate(children):
+            if child.name == obj.name:
+                children[i] = obj
+                return
+        children.append(obj)
+
     def is_deleted(self):
         'Return bool based on self.deleted'
         return self.deleted is not None
 
     def files(self):
+        'Get an iterator of the JFSFile and JFSIncompleteFile objects in this folder'
         if not self.synced:
             self.sync()
-        try:
-            #return [JFSFile(f, self.jfs, self.path) for f in self.folder.files.iterchildren()]
-            for _f in self.folder.files.iterchildren():
-                if hasattr(_f, 'currentRevision'): # a normal file
-                    yield JFSFile(_f, self.jfs, self.path)
-                else:
-                    yield JFSIncompleteFile(_f, self.jfs, self.path)
-
-        except AttributeError:
-            while False:
-                yield None
-            #return [x for x in []]
+        return iter(self._files)
 
     def folders(self):
+        'Get a list of JFSFolder objects for the subfolders of this folder'
         if not self.synced:
             self.sync()
-        try:
-            return [JFSFolder(f, self.jfs, self.path) for f in self.folder.folders.iterchildren()]
-        except AttributeError:
-            return [x for x in []]
+        return list(self._folders)
 
     def mkdir(self, foldername):
         'Create a new subfolder and return the new JFSFolder'
@@ -283,7 +499,7 @@ class JFSFolder(object):
         url = posixpath.join(self.path, foldername)
         params = {'mkDir':'true'}
         r = self.jfs.post(url, params)
-        self.sync()
+        self.update(r)
         return r
 
     def restore(self):
@@ -317,7 +533,8 @@ class JFSFolder(object):
         #url = '%s?dlDir=true' % self.path
         params = {'dlDir':'true'}
         r = self.jfs.post(self.path, params)
-        self.sync()
+        self.deleted = r.deleted
+        self.synced = False # what's in the trash may differ. we'll see on next read
         return r
 
     def hard_delete(self):
@@ -328,6 +545,7 @@ class JFSFolder(object):
                 'ts': int(time.time()),
                 'authToken': 0}
         r = self.jfs.post(url, content=data)
+        self.jfs._invalidate(self.path) # .post() invalidated the webrest url, not ours
         return r
 
 
@@ -341,19 +559,19 @@ class JFSFolder(object):
                           params=params)
         return r
 
-    def up(self, fileobj_or_path, filename=None, upload_callback=None):
-        'Upload a file to current folder and return the new JFSFile'
+    def up(self, fileobj_or_path, filename=None, upload_callback=None, md5=None, spool=False):
+        """Upload a file to current folder and return the new JFSFile
+
+        Besides a path or a file, you may upload from a pipe, a socket or a generator of bytes
+        (pass `filename`). See JFS.up() for that, and for `md5` and `spool`"""
         close_on_done = False
 
         if isinstance(fileobj_or_path, six.string_types):
             filename = filename or os.path.basename(fileobj_or_path)
             fileobj_or_path = open(fileobj_or_path, 'rb')
             close_on_done = True
-        elif hasattr(fileobj_or_path, 'read'):  # file like
-            pass
         else:
-            # TODO: handle generators here?
-            raise JFSError("Need filename or file-like object")
+            fileobj_or_path = readable(fileobj_or_path)
 
         if filename is None:
             if hasattr(fileobj_or_path, 'name'):
@@ -363,10 +581,10 @@ class JFSFolder(object):
 
         log.debug('.up %s ->  %s %s', repr(fileobj_or_path), repr(self.path), repr(filename))
         r = self.jfs.up(posixpath.join(self.path, filename), fileobj_or_path,
-            upload_callback=upload_callback)
+            upload_callback=upload_callback, md5=md5, spool=spool)
         if close_on_done:
             fileobj_or_path.close()
-        self.sync()
+        self.update(r)
         return r
 
     def filedirlist(self):
@@ -374,6 +592,10 @@ class JFSFolder(object):
         params = {'mode':'list'}
         return self.jfs.getObject(self.path, params)
 
+    def iterfiledirlist(self, decode=None):
+        'Like .filedirlist(), but parsed as it arrives. See JFS.iterfiledirlist()'
+        return self.jfs.iterfiledirlist(self.path, decode=decode)
+
 class ProtoFile(object):
     'Prototype for different incarnations fo file, e.g. JFSIncompleteFile and JFSFile'
 
@@ -383,41 +605,56 @@ class ProtoFile(object):
     STATE_INCOMPLETE = 'INCOMPLETE' # -> JFSIncompleteFile
     STATE_PROCESSING = 'PROCESSING'
     STATE_CORRUPT = 'CORRUPT' # -> JFSCorruptFile
+    __slots__ = ('jfs', 'parentPath', 'name', 'uuid', 'deleted',
+                 'revisionNumber', 'created', 'modified', 'updated', 'size', 'md5', 'mime', 'state')
+
     @staticmethod
     def factory(fileobject, jfs, parentpath): # fileobject from lxml.objectify
-        'Class method to get the correct file class instatiated'
-        if hasattr(fileobject, 'currentRevision'): # a normal file
-            return JFSFile(fileobject, jfs, parentpath)
-        elif str(fileobject.latestRevision.state) == ProtoFile.STATE_INCOMPLETE:
-            return JFSIncompleteFile(fileobject, jfs, parentpath)
-        elif str(fileobject.latestRevision.state) == ProtoFile.STATE_CORRUPT:
-            return JFSCorruptFile(fileobject, jfs, parentpath)
+        'Class method to get the correct file class instatiated (from jfs.wrappers)'
+        if fileobject.find('currentRevision') is not None: # a normal file
+            return jfs.wrappers['file'](fileobject, jfs, parentpath)
+        state = fileobject.findtext('latestRevision/state')
+        if state == ProtoFile.STATE_INCOMPLETE:
+            return jfs.wrappers['incompleteFile'](fileobject, jfs, parentpath)
+        elif state == ProtoFile.STATE_CORRUPT:
+            return jfs.wrappers['corruptFile'](fileobject, jfs, parentpath)
         else:
-            raise NotImplementedError('No JFS*File support for state %r. Please file a bug!' % fileobject.latestRevision.state)
+            raise NotImplementedError('No JFS*File support for state %r. Please file a bug!' % state)
 
     def __init__(self, fileobject, jfs, parentpath): # fileobject from lxml.objectify
-        self.f = fileobject
         self.jfs = jfs
         self.parentPath = parentpath
+        self.decode(fileobject)
+
+    def decode(self, fileobject):
+        '''Pick our metadata out of a <file> element, from <currentRevision>, or <latestRevision> if
+        the file isn't complete.
+
+        .name, .uuid, .md5, .mime and .state are strings, .revisionNumber and .size are ints, and
+        .deleted, .created, .modified and .updated are timezone aware datetime.datetime objects.
+        Whatever isn't in the xml is None, e.g. .deleted for a file that isn't deleted.'''
+        self.name = unicode(fileobject.get('name'))
+        self.uuid = unicode(fileobject.get('uuid'))
+        self.deleted = parse_timestamp(fileobject.get('deleted'))
+        # (.iterchildren(tag) is a lot quicker than .find(tag), and this is a hot spot in big listings)
+        revision = next(fileobject.iterchildren('currentRevision'), None)
+        if revision is None:
+            revision = next(fileobject.iterchildren('latestRevision'), None)
+        r = {el.tag: el.text for el in revision.iterchildren()} if revision is not None else {}
+        self.revisionNumber = int(r['number']) if 'number' in r else None
+        self.created = parse_timestamp(r.get('created'))
+        self.modified = parse_timestamp(r.get('modified'))
+        self.updated = parse_timestamp(r.get('updated'))
+        # Note that incomplete files only have a size if the file was requested directly,
+        # not if it's part of a folder listing. Then it's the size of what's been transferred this far
+        self.size = int(r['size']) if 'size' in r else None
+        self.md5 = str(r['md5']) if r.get('md5') is not None else None
+        self.mime = unicode(r['mime']) if r.get('mime') is not None else None
+        self.state = unicode(r['state']) if r.get('state') is not None else None
 
     def is_image(self):
         'Return bool based on self.mime'
-        return os.path.dirname(self.mime) == 'image'
-
-    @property
-    def name(self):
-        return unicode(self.f.attrib['name'])
-
-    @property
-    def uuid(self):
-        return unicode(self.f.attrib['uuid'])
-
-    @property
-    def deleted(self):
-        'Return datetime.datetime or None if the file isnt deleted'
-        _d = self.f.attrib.get('deleted', None)
-        if _d is None: return None
-        return dateutil.parser.parse(str(_d))
+        return os.path.dirname(self.mime or '') == 'image'
 
     def is_deleted(self):
         'Return bool based on self.deleted'
@@ -427,6 +664,13 @@ class ProtoFile(object):
     def path(self):
         return posixpath.join(self.parentPath, self.name)
 
+    @property
+    def f(self):
+        'Deprecated since 0.6: we no longer keep the xml around, so this fetches it again'
+        warnings.warn('%s.f is deprecated, it fetches %s again every time' % (type(self).__name__, self.path),
+                      DeprecationWarning, stacklevel=2)
+        return self.jfs.get(self.path)
+
 
 class JFSCorruptFile(ProtoFile):
     'OO interface to a corrupt file.'
@@ -441,38 +685,7 @@ class JFSCorruptFile(ProtoFile):
  25       <md5>2ed82c2b9a78f3fce85b19592fc94581</md5>
  26       <updated>2016-06-14-T19:09:48Z</updated>
  27     </revision>"""
-
-    @property
-    def revisionNumber(self):
-        'return int of current revision'
-        return int(self.f.latestRevision.number)
-
-    @property
-    def created(self):
-        'return datetime.datetime'
-        return dateutil.parser.parse(str(self.f.latestRevision.created))
-
-    @property
-    def modified(self):
-        'return datetime.datetime'
-        return dateutil.parser.parse(str(self.f.latestRevision.modified))
-
-    @property
-    def updated(self):
-        'return datetime.datetime'
-        return dateutil.parser.parse(str(self.f.latestRevision.updated))
-
-    @property
-    def md5(self):
-        return str(self.f.latestRevision.md5)
-
-    @property
-    def mime(self):
-        return unicode(self.f.latestRevision.mime)
-
-    @property
-    def state(self):
-        return unicode(self.f.latestRevision.state)
+    __slots__ = ()
 
 class JFSIncompleteFile(JFSCorruptFile):
     'OO interface to an incomplete file. Like JFSCorruptFile, but adds a .size property and a .resume() method.'
@@ -492,9 +705,14 @@ class JFSIncompleteFile(JFSCorruptFile):
   </latestRevision>
 </file>
 </file>"""
+    __slots__ = ()
+
+    def resume(self, data, md5=None, upload_callback=None):
+        """Resume uploading an incomplete file, after a previous upload was interrupted. Returns new file object
 
-    def resume(self, data):
-        'Resume uploading an incomplete file, after a previous upload was interrupted. Returns new file object'
+        Only what JottaCloud is missing, from byte .size on, is sent. If you already know the md5
+        hash of `data`, pass it as `md5` to avoid reading through it again, e.g. from a
+        jottalib.checkpoint.CheckpointStore"""
         if not hasattr(data, 'read'):
             data = six.BytesIO(data)#StringIO(data)
 
@@ -502,27 +720,17 @@ class JFSIncompleteFile(JFSCorruptFile):
         #If self.size === -1, it means we never got the value from the server.
         #This is perfectly normal if the file was instatiated via e.g. a file listing,
         #and not directly via JFS.getObject()
-        if self.size == -1:
+        if self.size is None:
             log.debug('%r is an incomplete file, but .size is unknown. Refreshing the file object from server', self.path)
-            self.f = self.jfs.get(self.path)
+            self.decode(self.jfs.get(self.path, objectify=False))
 
         #check if what we're asked to upload is actually the right file
-        md5 = calculate_md5(data)
+        if md5 is None:
+            md5 = calculate_md5(data)
         if md5 != self.md5:
             raise JFSError('''MD5 hashes don't match! Are you trying to resume with the wrong file?''')
         log.debug('Resuming %s from offset %s', self.path, self.size)
-        return self.jfs.up(self.path, data, resume_offset=self.size)
-
-    @property
-    def size(self):
-        """Bytes uploaded of the file so far.
-
-        Note that we only have the file size if the file was requested directly,
-        not if it's part of a folder listing.
-        """
-        if hasattr(self.f.latestRevision, 'size'):
-            return int(self.f.latestRevision.size)
-        return None
+        return self.jfs.up(self.path, data, resume_offset=self.size, md5=md5, upload_callback=upload_callback)
 
 class JFSFile(JFSIncompleteFile):
     'OO interface to a file, for convenient access. Type less, do more.'
@@ -551,15 +759,61 @@ class JFSFile(JFSIncompleteFile):
     SMALLTHUMB='WS'
     XLTHUMB='WXL'
 
-    def __init__(self, fileobject, jfs, parentpath): # fileobject from lxml.objectify
-        self.f = fileobject
-        self.jfs = jfs
-        self.parentPath = parentpath
+    __slots__ = ()
+
+    def stream(self, chunk_size=64*1024, workers=1, range_size=DOWNLOAD_RANGE_SIZE, stall_timeout=STALL_TIMEOUT,
+               readahead=None):
+        '''Returns a generator to iterate over the file contents.
 
-    def stream(self, chunk_size=64*1024):
-        'Returns a generator to iterate over the file contents'
+        Set `workers` to fetch byte ranges of `range_size` over that many connections at once.
+        A download that stalls for `stall_timeout` seconds picks up where it stopped, see JFS.iterrange()
+        Set `readahead` to keep that many chunks coming while you work, see JFS.stream()'''
         #return self.jfs.stream(url='%s?mode=bin' % self.path, chunk_size=chunk_size)
-        return self.jfs.stream(url=self.path, params={'mode':'bin'}, chunk_size=chunk_size)
+        return self.jfs.stream(url=self.path, params={'mode':'bin'}, chunk_size=chunk_size,
+                               size=self.size, workers=workers, range_size=range_size,
+                               stall_timeout=stall_timeout, readahead=readahead)
+
+    def download(self, fileobj_or_path, workers=DOWNLOAD_WORKERS, range_size=DOWNLOAD_RANGE_SIZE,
+                 retries=DOWNLOAD_RETRIES, callback=None, stall_timeout=STALL_TIMEOUT):
+        '''Download the file contents to a local path or a writable, seekable file object,
+        fetching byte ranges in parallel. Returns number of bytes written.
+
+        See JFS.download() for details'''
+        if isinstance(fileobj_or_path, six.string_types):
+            with open(fileobj_or_path, 'wb') as fileobject:
+                return self.download(fileobject, workers=workers, range_size=range_size,
+                                     retries=retries, callback=callback, stall_timeout=stall_timeout)
+        return self.jfs.download(self.path, fileobj_or_path, self.size, params={'mode':'bin'},
+                                 workers=workers, range_size=range_size, retries=retries,
+                                 callback=callback, stall_timeout=stall_timeout)
+
+    def download_to(self, path_or_fd, workers=DOWNLOAD_WORKERS, range_size=DOWNLOAD_RANGE_SIZE,
+                    retries=DOWNLOAD_RETRIES, callback=None, stall_timeout=STALL_TIMEOUT, keep_cache=True):
+        '''Download the file contents to a local path, or a file descriptor open for reading and
+        writing, straight from the socket into the preallocated file. Returns number of bytes written.
+
+        See JFS.download_to() for details'''
+        if isinstance(path_or_fd, six.integer_types):
+            return self.jfs.download_to(self.path, path_or_fd, self.size, params={'mode':'bin'},
+                                        workers=workers, range_size=range_size, retries=retries,
+                                        callback=callback, stall_timeout=stall_timeout, keep_cache=keep_cache)
+        fd = os.open(path_or_fd, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            return self.download_to(fd, workers=workers, range_size=range_size, retries=retries,
+                                    callback=callback, stall_timeout=stall_timeout, keep_cache=keep_cache)
+        finally:
+            os.close(fd)
+
+    def readinto(self, buffer, offset=0, stall_timeout=STALL_TIMEOUT):
+        '''Fill `buffer` (a bytearray, mmap, memoryview or the like) with the file contents from
+        byte `offset`, straight from the socket. Returns number of bytes read, which is less than
+        len(buffer) if the file ends first.
+
+        See JFS.readinto() for details'''
+        view = memoryview(buffer)[:max(self.size - offset, 0)] # jottacloud doesn't like reads beyond the end
+        if not len(view):
+            return 0
+        return self.jfs.readinto(self.path, view, offset, params={'mode':'bin'}, stall_timeout=stall_timeout)
 
     def read(self):
         'Get the file contents as string'
@@ -584,16 +838,13 @@ class JFSFile(JFSIncompleteFile):
         'Get a part of the file, from start byte to end byte (integers)'
         #return self.jfs.raw('%s?mode=bin' % self.path,
         return self.jfs.raw(url=self.path, params={'mode':'bin'},
-                            # note that we deduct 1 from end because
-                            # in http Range requests, the end value is included in the slice,
-                            # whereas in python, it is not
-                            extra_headers={'Range':'bytes=%s-%s' % (start, end-1)})
+                            extra_headers={'Range':range_header(start, end)})
 
     def write(self, data):
         'Put, possibly replace, file contents with (new) data'
         if not hasattr(data, 'read'):
             data = six.BytesIO(data)#StringIO(data)
-        self.jfs.up(self.path, data)
+        return self.jfs.up(self.path, data)
 
     def share(self):
         'Enable public access at secret, share only uri, and return that uri'
@@ -650,6 +901,7 @@ class JFSFile(JFSIncompleteFile):
                 'ts': int(time.time()),
                 'authToken': 0}
         r = self.jfs.post(url, content=data)
+        self.jfs._invalidate(self.path) # .post() invalidated the webrest url, not ours
         return r
 
     def delete(self):
@@ -679,48 +931,16 @@ class JFSFile(JFSIncompleteFile):
         return self.jfs.raw(url=self.path,
                             params={'mode':'thumb', 'ts':size})
 
-    @property
-    def revisionNumber(self):
-        'return int of current revision'
-        return int(self.f.currentRevision.number)
-
-    @property
-    def created(self):
-        'return datetime.datetime'
-        return dateutil.parser.parse(str(self.f.currentRevision.created))
-
-    @property
-    def modified(self):
-        'return datetime.datetime'
-        return dateutil.parser.parse(str(self.f.currentRevision.modified))
-
-    @property
-    def updated(self):
-        'return datetime.datetime'
-        return dateutil.parser.parse(str(self.f.currentRevision.updated))
-
-    @property
-    def size(self):
-        'return int of size in bytes'
-        return int(self.f.currentRevision.size)
-
-    @property
-    def md5(self):
-        return str(self.f.currentRevision.md5)
-
-    @property
-    def mime(self):
-        return unicode(self.f.currentRevision.mime)
-
-    @property
-    def state(self):
-        return unicode(self.f.currentRevision.state)
-
 class JFSMountPoint(JFSFolder):
     'OO interface to a mountpoint, for convenient access. Type less, do more.'
-    def __init__(self, mountpointobject, jfs, parentpath): # folderobject from lxml.objectify
-        super(JFSMountPoint, self).__init__(mountpointobject, jfs, parentpath)
-        self.folder = mountpointobject # name it 'folder' because of inheritance
+    __slots__ = ('size', 'modified')
+
+    def decode(self, mountpointobject):
+        'Like JFSFolder.decode(), and add .size (int, bytes) and .modified (datetime.datetime)'
+        super(JFSMountPoint, self).decode(mountpointobject)
+        _size = mountpointobject.findtext('size')
+        self.size = int(_size) if _size is not None else None
+        self.modified = parse_timestamp(mountpointobject.findtext('modified'))
 
     def delete(self):
         "override inherited method that makes no sense here"
@@ -730,20 +950,6 @@ class JFSMountPoint(JFSFolder):
         "override inherited method that makes no sense here"
         raise JFSError('Cant rename a mountpoint')
 
-    @property
-    def name(self):
-        return unicode(self.folder.name)
-
-    @property
-    def size(self):
-        'Return int of size in bytes'
-        return int(self.folder.size)
-
-    @property
-    def modified(self):
-        'Return datetime.datetime'
-        return dateutil.parser.parse(str(self.folder.modified))
-
 class JFSDevice(object):
     '''OO interface to a device, for convenient access. Type less, do more.
 
@@ -796,11 +1002,43 @@ class JFSDevice(object):
   <metadata first="" max="" total="6" num_mountpoints="6"/>
 </device>
 """
+    __slots__ = ('_jfs', 'parentPath', 'name', 'type', 'sid', 'size', 'modified', '_mountPoints')
+
     def __init__(self, deviceobject, jfs, parentpath): # deviceobject from lxml.objectify
-        self.dev = deviceobject
         self._jfs = jfs
         self.parentPath = parentpath
-        self.mountPoints = {unicode(mp.name):mp for mp in self.mountpointobjects()}
+        self.decode(deviceobject)
+        self._mountPoints = None
+        if deviceobject.find('mountPoints') is not None: # we have the full device metadata already
+            self.mountPoints = {mp.name:mp for mp in self._mountpoints(deviceobject)}
+
+    @property
+    def mountPoints(self):
+        'A dict of JFSMountPoint by name, fetched from JottaCloud the first time you ask'
+        if self._mountPoints is None:
+            self._mountPoints = {mp.name:mp for mp in self.mountpointobjects()}
+        return self._mountPoints
+
+    @mountPoints.setter
+    def mountPoints(self, mountpoints):
+        self._mountPoints = mountpoints
+
+    def decode(self, deviceobject):
+        'Pick .name, .type, .sid (strings), .size (int, bytes) and .modified (datetime.datetime) out of a <device> element'
+        self.name = unicode(deviceobject.findtext('name'))
+        self.type = unicode(deviceobject.findtext('type'))
+        self.sid = unicode(deviceobject.findtext('sid'))
+        _size = deviceobject.findtext('size')
+        self.size = int(_size) if _size is not None else None
+        self.modified = parse_timestamp(deviceobject.findtext('modified'))
+
+    def _mountpoints(self, deviceobject):
+        'Get a list of JFSMountPoint from the <mountPoints> of a <device> element'
+        _mps = deviceobject.find('mountPoints')
+        if _mps is None:
+            # there are no mountpoints. this may happen on newly created devices. see github bug#26
+            return []
+        return [self._jfs.wrappers['mountPoint'](obj, self._jfs, self.path) for obj in _mps.iterchildren(tag='mountPoint')]
 
     def contents(self, path=None):
         """Get _all_ metadata for this device.
@@ -813,11 +1051,8 @@ class JFSDevice(object):
         return c
 
     def mountpointobjects(self):
-        try:
-            return [ JFSMountPoint(obj, self._jfs, self.path) for obj in self.contents().mountPoints.iterchildren() ]
-        except AttributeError:
-            # there are no mountpoints. this may happen on newly created devices. see github bug#26
-            return []
+        'Get a fresh list of JFSMountPoint from JottaCloud'
+        return self._mountpoints(self.contents())
 
     def files(self, mountPoint):
         """Get an iterator of JFSFile() from the given mountPoint.
@@ -827,7 +1062,7 @@ class JFSDevice(object):
             # shortcut: pass a mountpoint name
             mountPoint = self.mountPoints[mountPoint]
         try:
-            return [JFSFile(f, self, parentpath='%s/%s' % (self.path, mountPoint.name)) for f in self.contents(mountPoint).files.iterchildren()]
+            return [self._jfs.wrappers['file'](f, self._jfs, parentpath='%s/%s' % (self.path, mountPoint.name)) for f in self.contents(mountPoint).files.iterchildren()]
         except AttributeError as err:
             # no files at all
             return [x for x in []]
@@ -840,7 +1075,7 @@ class JFSDevice(object):
             # shortcut: pass a mountpoint name
             mountPoint = self.mountPoints[mountPoint]
         try:
-            return [JFSFolder(f, self, parentpath='%s/%s' % (self.path, mountPoint.name)) for f in self.contents(mountPoint).folders.iterchildren()]
+            return [self._jfs.wrappers['folder'](f, self._jfs, parentpath='%s/%s' % (self.path, mountPoint.name)) for f in self.contents(mountPoint).folders.iterchildren()]
         except AttributeError as err:
             # no files at all
             return [x for x in []]
@@ -849,33 +1084,19 @@ class JFSDevice(object):
         """Create a new mountpoint"""
         url = posixpath.join(self.path, name)
         r = self._jfs.post(url, extra_headers={'content-type': 'application/x-www-form-urlencoded'})
+        self._mountPoints = None # fetch them again when asked
         return r
 
-    @property
-    def modified(self):
-        'Return datetime.datetime'
-        return dateutil.parser.parse(str(self.dev.modified))
-
     @property
     def path(self):
         return posixpath.join(self.parentPath, self.name)
 
     @property
-    def name(self):
-        return unicode(self.dev.name)
-
-    @property
-    def type(self):
-        return unicode(self.dev.type)
-
-    @property
-    def size(self):
-        'Return int of size in bytes'
-        return int(self.dev.size)
-
-    @property
-    def sid(self):
-        return unicode(self.dev.sid)
+    def dev(self):
+        'Deprecated since 0.6: we no longer keep the xml around, so this fetches it again'
+        warnings.warn('JFSDevice.dev is deprecated, it fetches %s again every time' % self.path,
+                      DeprecationWarning, stacklevel=2)
+        return self._jfs.get(self.path)
 
 class JFSenableSharing(object):
     'wrap enableSharing element in a python class'
@@ -903,9 +1124,9 @@ class JFSenableSharing(object):
 
     def sharedFiles(self):
         'iterate over shared files and get their public URI'
-        for f in self.sharing.files.iterchildren():
-            yield (f.attrib['name'], f.attrib['uuid'],
-                'https://www.jottacloud.com/p/%s/%s' % (self.jfs.username, f.publicURI.text))
+        for f in self.sharing.find('files').iterchildren(tag='file'):
+            yield (f.get('name'), f.get('uuid'),
+                'https://www.jottacloud.com/p/%s/%s' % (self.jfs.username, f.findtext('publicURI')))
 
 class JFSsearchresult(object):
     'wrap searchresult element in a python class'
@@ -935,52 +1156,203 @@ class JFSsearchresult(object):
     @property
     def size(self):
         'Return datetime of search time stamp'
-        return dateutil.parser.parse(str(self.searchresult.attrib['time']))
+        return parse_timestamp(self.searchresult.get('time'))
 
     def files(self):
         'iterate over found files'
-        for _f in self.searchresult.files.iterchildren():
-            yield ProtoFile.factory(_f, jfs=self.jfs, parentpath=unicode(_f.abspath))
+        for _f in self.searchresult.find('files').iterchildren(tag='file'):
+            yield ProtoFile.factory(_f, jfs=self.jfs, parentpath=unicode(_f.findtext('abspath')))
 
 
 
 class JFS(object):
-    def __init__(self, auth=None):
-        from requests.auth import HTTPBasicAuth
+    """The JottaCloud client.
+
+    One JFS may be shared by many threads. Requests to www.jottacloud.com (metadata and
+    downloads) and up.jottacloud.com (uploads) get separate connection pools, sized by
+    `pool_size` and `upload_pool_size`. Size them to the number of threads you run.
+
+    By default, a thread that finds its pool empty opens an extra connection and throws it away
+    afterwards. With `pool_block=True` it waits for a pooled connection instead, so the number of
+    open sockets never exceeds the pool sizes.
+
+    `prewarm=True` opens the pooled connections up front, see .prewarm(). For statistics, see .poolstats()
+
+    With `cache`, .getObject() results are cached in .cache, a jottalib.cache.ObjectCache, and
+    everything we change through .post() is invalidated automatically. Cached objects are shared,
+    so whoever asks for the same path gets the same JFS* object. Pass True for an ObjectCache with
+    the defaults, or your own ObjectCache to tune it. Default: no cache. Paths that turned out not
+    to exist are remembered in .notfound for `notfound_ttl` seconds (0 turns that off), unless we
+    create something there.
+
+    With `httpcache`, the xml behind .get() and .getObject() is also kept on disk, in a
+    jottalib.httpcache.HTTPCache, and revalidated with the server before we use it again, so
+    that what hasn't changed isn't fetched again, even by the next process. Pass True for a
+    cache in ~/.jottalib, the path of a directory, or your own HTTPCache. Default: no cache.
+
+    Failed requests are retried with backoff, as decided by .retry, a jottalib.retry.RetryPolicy,
+    which also pauses everything for a while if JottaCloud starts failing most requests. Pass your
+    own RetryPolicy as `retry` to tune it, or retry=False to turn it off. Connections that break
+    before a request is sent are retried right away by the connection pools, as before.
+
+    Nothing is fetched from JottaCloud until you ask for something, not even the user root, .fs
+    (call .login() to check the credentials up front). So bad credentials raise JFSCredentialsError
+    on the first request, not when the JFS is made, as they did before 0.6. The devices, and their
+    mountpoints, are fetched once, when first asked for. To get to a folder whose path you know,
+    e.g. /Jotta/Sync, use .getObject(path), or .getFolder(path) to skip the request until you read
+    from it.
+
+    Uploads and downloads are kept within `upload_rate` and `download_rate` (bytes per second,
+    default: no limit), through the jottalib.throttle.TokenBuckets .upload_bucket and
+    .download_bucket, and also within the limits for the whole process, in
+    jottalib.throttle.GLOBAL_UPLOAD and GLOBAL_DOWNLOAD. Change the .rate of any of them
+    at any time, e.g. bucket.rate = 100*1024, and transfers under way will follow suit.
+
+    The http is done by .transport, a jottalib.transport.Transport. `transport` is 'requests'
+    (the default), 'urllib3', which has less overhead per request, or one you made yourself.
+    Uploads are sent in chunks of `upload_chunk_size` bytes, see .multipart().
+
+    With `readahead`, .stream() keeps that many chunks coming in a background thread while you
+    work on the ones you got. Waits on either side are counted in .readahead_counter, see
+    jottalib.readahead.WaitCounter. Default: READAHEAD, which is none.
+    """
+    # The JFS* classes we wrap JottaCloud xml in, keyed by xml tag. See .wrap()
+    # A client with different plumbing, like jottalib.aio.AsyncJFS, swaps in its own
+    wrappers = {'device': JFSDevice,
+                'folder': JFSFolder,
+                'mountPoint': JFSMountPoint,
+                'file': JFSFile,
+                'incompleteFile': JFSIncompleteFile,
+                'corruptFile': JFSCorruptFile,
+                'restoredFiles': JFSFile,
+                'deleteFiles': JFSFile,
+                'enableSharing': JFSenableSharing,
+                'filedirlist': JFSFileDirList,
+                'searchresult': JFSsearchresult,
+               }
+    # The transports we know by name, see jottalib.transport
+    transports = TRANSPORTS
+
+    def __init__(self, auth=None, pool_size=POOL_SIZE, upload_pool_size=UPLOAD_POOL_SIZE, pool_block=False, prewarm=False,
+                 cache=False, retry=True, upload_rate=None, download_rate=None, notfound_ttl=NOTFOUND_TTL,
+                 httpcache=None, transport='requests', upload_chunk_size=UPLOAD_CHUNK_SIZE, readahead=READAHEAD):
         self.apiversion = '2.2' # hard coded per october 2014
-        self.session = requests.Session() # create a session for connection pooling, ssl keepalives and cookie jar
-        self.session.mount('https://',requests.adapters.HTTPAdapter(max_retries=10))
-        self.session.stream = True
+        if isinstance(transport, six.string_types):
+            transport = self.transports[transport]()
+        self.transport = transport
+        self.upload_chunk_size = upload_chunk_size
+        self.session = getattr(transport, 'session', None) # the requests.Session, if that's what we use
+        self.mountpool('www', 'https://www.jottacloud.com/', pool_size, pool_block)
+        self.mountpool('up', 'https://up.jottacloud.com/', upload_pool_size, pool_block)
         if not auth:
             auth = get_auth_info()
         self.username, password = auth
-        self.session.auth = HTTPBasicAuth(self.username, password)
-        self.session.verify = certifi.where()
-        self.session.headers =  {'User-Agent':'jottalib %s (https://github.com/havardgulldahl/jottalib)' % (__version__, ),
-                                 'X-JottaAPIVersion': self.apiversion,
-                                }
+        self.transport.configure(self.username, password,
+                                 {'User-Agent':'jottalib %s (https://github.com/havardgulldahl/jottalib)' % (__version__, ),
+                                  'X-JottaAPIVersion': self.apiversion,
+                                 })
         self.rootpath = JFS_ROOT + self.username
+        if cache is True:
+            cache = ObjectCache()
+        elif cache is None or cache is False: # not `not cache`: an empty ObjectCache is falsy
+            cache = ObjectCache(maxentries=0)
+        self.cache = cache
+        self.notfound = ObjectCache(ttl=notfound_ttl) if notfound_ttl else ObjectCache(maxentries=0)
+        if httpcache is True:
+            httpcache = os.path.join(HTTPCACHE_DIR, 'httpcache-%s' % self.username)
+        if isinstance(httpcache, six.string_types):
+            httpcache = HTTPCache(httpcache)
+        self.httpcache = httpcache or None
+        self.flights = SingleFlight()
+        if retry is True:
+            retry = RetryPolicy()
+        self.retry = retry or RetryPolicy(retries=0, breaker=False)
+        self.upload_bucket = TokenBucket(upload_rate)
+        self.download_bucket = TokenBucket(download_rate)
+        self.upload_throttle = Throttle(self.upload_bucket, GLOBAL_UPLOAD)
+        self.download_throttle = Throttle(self.download_bucket, GLOBAL_DOWNLOAD)
+        self.readahead = readahead
+        self.readahead_counter = WaitCounter()
+        self._fs = None # the <user> root, see .login()
+        self._devices = None
+        if prewarm:
+            self.prewarm()
+
+    def login(self):
+        'Fetch the user root, .fs, from JottaCloud, and with it, check our credentials. Returns .fs'
         self.fs = self.get(self.rootpath)
+        return self.fs
+
+    @property
+    def fs(self):
+        'The <user> root, as a lxml.objectify element. Fetched the first time you ask, see .login()'
+        if self._fs is None:
+            self.login()
+        return self._fs
+
+    @fs.setter
+    def fs(self, o):
+        self._fs = o
+        self._devices = None # built from the new .fs when asked for
+
+    def mountpool(self, name, prefix, pool_size, pool_block=False):
+        'Send all requests for urls starting with `prefix` through a connection pool of their own'
+        self.transport.mount(name, prefix, pool_size, pool_block)
+
+    def prewarm(self, connections=None):
+        """Open connections to JottaCloud ahead of time, so early requests don't wait on tcp and tls handshakes.
+
+        Opens `connections` (default: the pool size) connections to each host, in parallel"""
+        go = threading.Event()
+        def touch(prefix):
+            go.wait()
+            try:
+                self.transport.request('HEAD', prefix, timeout=60).content # read it, to put the connection back
+            except requests.exceptions.RequestException as e:
+                log.debug('Could not prewarm connection to %s: %r', prefix, e)
+        threads = []
+        for prefix, pool_size in self.transport.mounts.values():
+            for _ in range(connections or pool_size):
+                t = threading.Thread(target=touch, args=(prefix,))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+        go.set() # all at once, or they would just reuse each other's connections
+        for t in threads:
+            t.join()
+
+    def poolstats(self):
+        """Return connection pool statistics, as a dict per pool name ('www' and 'up'):
+
+        {'maxsize': pool size,
+         'in_use': connections currently checked out by a request,
+         'idle': open connections waiting in the pool,
+         'created': connections opened so far,
+         'requests': requests made so far}"""
+        return self.transport.poolstats()
 
     def close(self):
-        self.session.close()
+        self.transport.close()
 
     def escapeUrl(self, url):
         if isinstance(url, six.text_type):
             url = url.encode('utf-8') # urls have to be bytestrings
         return quote(url, safe=self.rootpath)
 
-    def request(self, url, extra_headers=None, params=None):
-        'Make a GET request for url, with or without caching'
+    def request(self, url, extra_headers=None, params=None, timeout=REQUEST_TIMEOUT):
+        '''Make a GET request for url, with or without caching.
+
+        `timeout` is in seconds, or a (connect, read) tuple, as for requests'''
         if not url.startswith('http'):
             # relative url
             url = self.rootpath + url
         log.debug("getting url: %r, extra_headers=%r, params=%r", url, extra_headers, params)
         if extra_headers is None: extra_headers={}
-        r = self.session.get(url, headers=extra_headers, params=params, timeout=1800) #max retries is set in __init__
+        r = self.retry.call(lambda: self.transport.request('GET', url, headers=extra_headers, params=params, timeout=timeout),
+                            description='GET %s' % url)
 
         if r.status_code in ( 500, ):
-            raise JFSError(r.reason)
+            raise JFSServerError(r.reason)
         return r
 
     def raw(self, url, extra_headers=None, params=None):
@@ -993,13 +1365,47 @@ class JFS(object):
         if not r.ok:
             o = lxml.objectify.fromstring(r.content)
             JFSError.raiseError(o, url)
-        return r.content
-
-    def get(self, url, params=None):
-        'Make a GET request for url and return the response content as a generic lxml.objectify object'
+        return b''.join(self.download_throttle.iterate(r.iter_content(64*1024)))
+
+    def xml(self, url, params=None):
+        '''Get the xml document at url, as bytes, gzipped on the way, and through .httpcache, if we have one.
+
+        Like .raw(), but for metadata'''
+        headers = {'Accept-Encoding': 'gzip'}
+        entry = self.httpcache.get(url, params) if self.httpcache is not None else None
+        if entry is not None:
+            if self.httpcache.fresh(entry):
+                return self.httpcache.hit(entry)
+            headers.update(self.httpcache.conditions(entry))
+        r = self.request(url, extra_headers=headers, params=params)
+        if r.status_code == 304 and entry is not None:
+            return self.httpcache.notmodified(url, params, entry)
+        if not r.ok:
+            o = lxml.objectify.fromstring(r.content)
+            JFSError.raiseError(o, url)
+        content = b''.join(self.download_throttle.iterate(r.iter_content(64*1024)))
+        if self.httpcache is not None:
+            born = XML_TIME.search(content[:1024]) # when the server made this
+            if born is not None:
+                born = calendar.timegm(parse_timestamp(born.group(1).decode('ascii')).utctimetuple())
+            self.httpcache.put(url, params, content, r.headers, born=born)
+        return content
+
+    def get(self, url, params=None, objectify=True):
+        '''Make a GET request for url and return the response content as a generic lxml.objectify object
+
+        With objectify=False, you get a plain lxml.etree element, which is a lot faster to parse and walk.
+
+        Threads asking for the same thing at the same time share one request, see .flights'''
+        return self.flights.do(('get', objectify) + ObjectCache.key(url, params),
+                               self._get, url, params=params, objectify=objectify)[0]
+
+    def _get(self, url, params=None, objectify=True):
+        'Like .get(), but return a tuple of (parsed xml, length of xml)'
+        parser = lxml.objectify if objectify else lxml.etree
         url = self.escapeUrl(url)
 
-        content = six.BytesIO(self.raw(url, params=params))
+        content = six.BytesIO(self.xml(url, params=params))
         # We need to make sure that the xml fits in available memory before we parse
         # with lxml.objectify.fromstring(), or else it will bomb out.
         # If it is too big, we need to buffer it to disk before we run it through objectify. see #87
@@ -1012,50 +1418,159 @@ class JFS(object):
         MAX_BUFFER_SIZE=1024*1024*200 # 200MB. TODO: find a way to compute this
         if contentlen > MAX_BUFFER_SIZE:
             # xml is too big to parse with lxml.objectify.fromstring()
+            # (if you need to list big trees, use .iterfiledirlist())
             contentfile = tempfile.NamedTemporaryFile()
             contentfile.write(content.read())
-            o = lxml.objectify.parse(contentfile)
+            contentfile.flush()
+            contentfile.seek(0)
+            o = parser.parse(contentfile).getroot()
         else:
-            o = lxml.objectify.fromstring(content.getvalue())
+            o = parser.fromstring(content.getvalue())
         if o.tag == 'error':
             JFSError.raiseError(o, url)
-        return o
+        return o, contentlen
 
     def getObject(self, url_or_requests_response, params=None):
-        'Take a url or some xml response from JottaCloud and wrap it up with the corresponding JFS* class'
-        if isinstance(url_or_requests_response, requests.models.Response):
+        '''Take a url or some xml response from JottaCloud and wrap it up with the corresponding JFS* class
+
+        Objects we fetch are kept in .cache for a while, see jottalib.cache.ObjectCache,
+        and so are JFSNotFoundErrors, in .notfound, for a shorter while'''
+        if not isinstance(url_or_requests_response, six.string_types):
             # this is a raw xml response that we need to parse
             url = url_or_requests_response.url
-            o = lxml.objectify.fromstring(url_or_requests_response.content)
-        else:
-            # this is an url that we need to fetch
-            url = url_or_requests_response
-            o = self.get(url, params=params) # (.get() will parse this for us)
-
+            o = lxml.etree.fromstring(url_or_requests_response.content)
+            return self.wrap(o, url)
+        # this is an url that we need to fetch
+        url = url_or_requests_response
+        if not url.startswith('http'):
+            # relative url
+            url = self.rootpath + url
+        obj = self.cache.get(url, params)
+        if obj is None:
+            missing = self.notfound.get(url, params)
+            if missing is not None:
+                raise JFSNotFoundError(missing)
+            # if another thread is fetching this already, we wait for that instead
+            obj = self.flights.do(('getObject', ) + ObjectCache.key(url, params), self._getObject, url, params)
+        return obj
+
+    def getObjects(self, paths):
+        '''Get the JFS* objects for many paths at once, as a dict of path -> object.
+        Paths that don't exist are left out.
+
+        Paths are grouped by their parent folder, and each parent is fetched once (see .getObject()),
+        and the objects are picked out of its listing. Only what the listing can't tell us, like
+        the size of an incomplete file, is fetched on its own. Folders are like the ones from
+        JFSFolder.folders(): their contents are fetched when you first read them.
+        So, n files in one folder cost one round trip, not n'''
+        parents = {} # parent url -> {name: path}
+        for path in paths:
+            url = path if path.startswith('http') else self.rootpath + path
+            parent, name = posixpath.split(url.rstrip('/'))
+            parents.setdefault(parent, {})[name] = path
+        found = {}
+        for parent, names in parents.items():
+            if len(names) == 1:
+                # one file is one round trip anyway, and its listing may be big
+                name, path = names.popitem()
+                try:
+                    found[path] = self.getObject(posixpath.join(parent, name))
+                except JFSNotFoundError:
+                    pass
+                continue
+            try:
+                folder = self.getObject(parent)
+            except JFSNotFoundError:
+                continue
+            if not isinstance(folder, JFSFolder):
+                continue # that's no folder, so there's nothing in it
+            for obj in itertools.chain(folder._folders, folder._files):
+                path = names.get(obj.name)
+                if path is None:
+                    continue
+                if isinstance(obj, ProtoFile) and obj.size is None: # the listing doesn't know
+                    obj = self.getObject(posixpath.join(parent, obj.name))
+                found[path] = obj
+        return found
+
+    def _getObject(self, url, params=None):
+        'Fetch url, wrap it up and cache it. See .getObject()'
+        try:
+            o, contentlen = self._get(url, params=params, objectify=False) # (.get() will parse this for us)
+        except JFSNotFoundError as e:
+            self.notfound.put(url, str(e), params)
+            raise
+        obj = self.wrap(o, url)
+        if o.tag != 'user': # that's .fs
+            self.cache.put(url, obj, params, size=contentlen)
+        return obj
+
+    def wrap(self, o, url):
+        'Wrap a parsed xml response (from lxml.etree or lxml.objectify) from url in the corresponding JFS* class from .wrappers'
         parent = os.path.dirname(url).replace('up.jottacloud.com', 'www.jottacloud.com')
         if o.tag == 'error':
             JFSError.raiseError(o, url)
-        elif o.tag == 'device': return JFSDevice(o, jfs=self, parentpath=parent)
-        elif o.tag == 'folder': return JFSFolder(o, jfs=self, parentpath=parent)
-        elif o.tag == 'mountPoint': return JFSMountPoint(o, jfs=self, parentpath=parent)
-        elif o.tag == 'restoredFiles': return JFSFile(o, jfs=self, parentpath=parent)
-        elif o.tag == 'deleteFiles': return JFSFile(o, jfs=self, parentpath=parent)
         elif o.tag == 'file':
             return ProtoFile.factory(o, jfs=self, parentpath=parent)
-#             try:
-#                 if o.latestRevision.state == 'INCOMPLETE':
-#                     return JFSIncompleteFile(o, jfs=self, parentpath=parent)
-#                 elif o.latestRevision.state == 'CORRUPT':
-#                     return JFSCorruptFile(o, jfs=self, parentpath=parent)
-#             except AttributeError:
-#                 return JFSFile(o, jfs=self, parentpath=parent)
-        elif o.tag == 'enableSharing': return JFSenableSharing(o, jfs=self)
+        elif o.tag in ('enableSharing', 'searchresult'):
+            return self.wrappers[o.tag](o, jfs=self)
         elif o.tag == 'user':
+            if not isinstance(o, lxml.objectify.ObjectifiedElement):
+                o = lxml.objectify.fromstring(lxml.etree.tostring(o))
             self.fs = o
             return self.fs
-        elif o.tag == 'filedirlist': return JFSFileDirList(o, jfs=self, parentpath=parent)
-        elif o.tag == 'searchresult': return JFSsearchresult(o, jfs=self)
-        raise JFSError("invalid object: %s <- %s" % (repr(o), url_or_requests_response))
+        elif o.tag in self.wrappers:
+            return self.wrappers[o.tag](o, jfs=self, parentpath=parent)
+        raise JFSError("invalid object: %s <- %s" % (repr(o), url))
+
+    def iterfiledirlist(self, url, decode=None, retries=DOWNLOAD_RETRIES):
+        '''Get the <filedirlist> of url (a folder) and yield a tuple of (folderpath, [TreeFile, ...])
+        for each folder in it, as soon as it arrives from the server.
+
+        Unlike JFSFileDirList, the xml is parsed incrementally, straight off the network,
+        and thrown away after each folder, so memory use stays flat however big the tree is.
+        The response stays open until the last folder is in, so if you do slow things with each
+        folder, like downloading its files, get them all first, e.g. with list().
+
+        If the listing breaks off, we ask for it again and skip the folders we have yielded.
+        After `retries` failures in a row without a new folder, we raise a JFSError that says
+        the listing is incomplete.
+
+        To get something else than TreeFiles, pass `decode`, a function that takes a
+        <folder> element (lxml.etree) and returns what you want yielded.'''
+        if decode is None:
+            decode = _treefolder
+        url = self.escapeUrl(url)
+        done = set() # paths of the folders we have yielded
+        attempt = 0
+        while True:
+            r = self.request(url, params={'mode':'list'})
+            if not r.ok:
+                o = lxml.objectify.fromstring(r.content)
+                JFSError.raiseError(o, url)
+            r.raw.decode_content = True # let urllib3 take care of gzip et al
+            try:
+                for _, folder in lxml.etree.iterparse(r.raw, events=('end',), tag='folder'):
+                    path = (folder.findtext('path'), folder.get('name'))
+                    if path not in done:
+                        yield decode(folder)
+                        done.add(path)
+                        attempt = 0
+                    # drop what we've parsed so far
+                    folder.clear()
+                    while folder.getprevious() is not None:
+                        del folder.getparent()[0]
+                return
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError,
+                    lxml.etree.XMLSyntaxError, socket.error) as e:
+                # the connection broke, or the xml ended before it should
+                error = e
+            finally:
+                r.close()
+            attempt += 1
+            if attempt > retries:
+                raise JFSError('The listing of %s is incomplete, it broke off after %s folders: %r' % (url, len(done), error))
+            log.warning('Listing of %r broke off after %s folders (%r), asking again (%s/%s)', url, len(done), error, attempt, retries)
 
     def getLatest(self, files=10, sort=None):
         'Yield a list of the n latest files (the server minimum default is 10), optionally sorted by `sort`.'
@@ -1066,42 +1581,457 @@ class JFS(object):
             yield _f
 
 
-    def stream(self, url, params=None, chunk_size=64*1024):
-        'Iterator to get remote content by chunk_size (bytes)'
-        r = self.request(url, params=params)
-        for chunk in r.iter_content(chunk_size):
+    def stream(self, url, params=None, chunk_size=64*1024, size=None, workers=1,
+               range_size=DOWNLOAD_RANGE_SIZE, retries=DOWNLOAD_RETRIES, stall_timeout=STALL_TIMEOUT,
+               readahead=None):
+        '''Iterator to get remote content by chunk_size (bytes)
+
+        If `size` is known and `workers` > 1, the content is fetched as byte ranges of
+        `range_size` over `workers` concurrent connections, and yielded in order.
+
+        With `readahead` (default: .readahead), up to that many chunks are fetched in a background
+        thread while the consumer works on the ones it has, see jottalib.readahead.ReadAhead.
+
+        Downloads that break off or stall are resumed from the last byte we got, see .iterrange()'''
+        if readahead is None:
+            readahead = self.readahead
+        if readahead:
+            with ReadAhead(self.stream(url, params=params, chunk_size=chunk_size, size=size, workers=workers,
+                                       range_size=range_size, retries=retries, stall_timeout=stall_timeout,
+                                       readahead=0),
+                           readahead, counter=self.readahead_counter) as chunks:
+                for chunk in chunks:
+                    yield chunk
+            return
+        if workers > 1 and size:
+            for chunk in self._streamranges(url, size, params=params, chunk_size=chunk_size,
+                                            workers=workers, range_size=range_size, retries=retries,
+                                            stall_timeout=stall_timeout):
+                yield chunk
+            return
+        for chunk in self.iterrange(url, 0, size, params=params, chunk_size=chunk_size,
+                                    retries=retries, stall_timeout=stall_timeout):
             yield chunk
 
-    def post(self, url, content='', files=None, params=None, extra_headers={}, upload_callback=None):
-        'HTTP Post files[] or content (unicode string) to url'
+    def iterrange(self, url, start=0, end=None, params=None, chunk_size=64*1024,
+                  retries=DOWNLOAD_RETRIES, stall_timeout=STALL_TIMEOUT):
+        '''Iterator over the bytes from `start` to `end` (exclusive; None: to the end) of url, by chunk_size.
+
+        We keep an eye on the download, and consider it stalled when the connection is silent
+        for `stall_timeout` seconds (the read timeout of the socket). A slow download that keeps
+        moving is left alone, however long a chunk takes. When a download stalls or breaks off,
+        we reconnect and ask for the rest, with a Range: bytes=<pos>- header, so the consumer
+        gets every byte once, in order. After `retries` failures in a row
+        without any progress, we give up and raise the last error'''
+        pos = start
+        attempt = 0
+        timeout = (stall_timeout, stall_timeout) if stall_timeout else REQUEST_TIMEOUT
+        while end is None or pos < end:
+            progress = pos
+            r = None
+            try:
+                headers = {'Range':range_header(pos, end)} if pos or end is not None else None
+                r = self.request(url, params=params, extra_headers=headers, timeout=timeout)
+                if r.status_code == 200 and pos > 0:
+                    raise JFSRangeError('Server ignored our Range header for %s' % url)
+                elif not r.ok:
+                    o = lxml.objectify.fromstring(r.content)
+                    JFSError.raiseError(o, url)
+                chunks = r.iter_content(chunk_size)
+                while end is None or pos < end:
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        break
+                    if end is not None:
+                        chunk = chunk[:end-pos] # stay within our range, in case we got more
+                    pos += len(chunk)
+                    self.download_throttle.consume(len(chunk))
+                    yield chunk
+                else:
+                    return
+                if end is None:
+                    return # the server says we're done
+                raise JFSStallError('Response ended at %s, expected %s bytes' % (pos, end))
+            except (requests.exceptions.RequestException, JFSServerError, JFSStallError) as e:
+                # .request() raises JFSServerError on http 500, which may well be temporary
+                error = e
+            finally:
+                if r is not None:
+                    r.close()
+            attempt = 1 if pos > progress else attempt + 1
+            if attempt > retries:
+                raise error
+            log.warning('Download of %r broke off at byte %s (%r), resuming (%s/%s)', url, pos, error, attempt, retries)
+
+    def _streamranges(self, url, size, params, chunk_size, workers, range_size, retries, stall_timeout=STALL_TIMEOUT):
+        '''Fetch byte ranges in background threads, keeping at most `workers` in flight, and yield them in order.
+
+        The first range is yielded as it arrives; the ones after it are kept until it's their turn.
+        When we're closed, or something goes wrong, the threads stop at their next chunk'''
+        ranges = iter(byteranges(size, range_size))
+        pending = deque()
+        stop = threading.Event()
+
+        def fetch(start, end, chunks):
+            def write(offset, chunk):
+                if stop.is_set():
+                    raise JFSError('Stopped getting bytes %s-%s of %r' % (start, end, url))
+                chunks.put(chunk)
+            try:
+                self.getrange(url, start, end, write, params=params, retries=retries, chunk_size=chunk_size,
+                              stall_timeout=stall_timeout)
+                chunks.put(None) # the end of the range
+            except Exception as e:
+                chunks.put(e)
+
+        def launch():
+            for start, end in ranges:
+                chunks = queue.Queue()
+                t = threading.Thread(target=fetch, args=(start, end, chunks))
+                t.daemon = True
+                t.start()
+                pending.append(chunks)
+                return
+
+        try:
+            for _ in range(workers):
+                launch()
+            while pending:
+                chunks = pending.popleft()
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+                launch() # keep the pipeline full while the consumer works
+        finally:
+            stop.set()
+
+    def getrange(self, url, start, end, write, params=None, retries=DOWNLOAD_RETRIES, chunk_size=64*1024,
+                 stall_timeout=STALL_TIMEOUT):
+        '''Fetch the bytes from `start` to `end` (exclusive) of url, handing each chunk to write(offset, chunk).
+
+        If the connection breaks or stalls, we retry up to `retries` times, continuing from the last byte
+        we got. See .iterrange(). Returns number of bytes fetched'''
+        pos = start
+        for chunk in self.iterrange(url, start, end, params=params, chunk_size=chunk_size,
+                                    retries=retries, stall_timeout=stall_timeout):
+            write(pos, chunk)
+            pos += len(chunk)
+        return pos - start
+
+    def download(self, url, fileobject, size, params=None, workers=DOWNLOAD_WORKERS,
+                 range_size=DOWNLOAD_RANGE_SIZE, retries=DOWNLOAD_RETRIES, callback=None,
+                 stall_timeout=STALL_TIMEOUT):
+        '''Download `size` bytes from url into fileobject, fetching byte ranges in parallel.
+
+        The file is preallocated to `size` bytes, and `workers` threads fetch ranges of
+        `range_size` bytes concurrently, each writing straight to its offset in fileobject.
+        A range that breaks off or stalls is resumed by itself (see .iterrange()), so one stalled
+        range doesn't restart the whole transfer. With one worker, it's all one request.
+
+        If callback is given, it is called with (bytes_written, size) as data arrives.
+        Returns number of bytes written'''
+        fileobject.seek(0)
+        fileobject.truncate(size)
+        if workers <= 1 and size:
+            range_size = size # all in one request
+        ranges = queue.Queue()
+        for r in byteranges(size, range_size):
+            ranges.put(r)
+        lock = threading.Lock()
+        written = [0]
+        errors = []
+
+        def write(offset, chunk):
+            with lock:
+                fileobject.seek(offset)
+                fileobject.write(chunk)
+                written[0] += len(chunk)
+                if callback is not None:
+                    callback(written[0], size)
+
+        def worker():
+            while not errors:
+                try:
+                    start, end = ranges.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.getrange(url, start, end, write, params=params, retries=retries,
+                                  stall_timeout=stall_timeout)
+                except Exception as e:
+                    log.exception('Failed to get bytes %s-%s of %r', start, end, url)
+                    errors.append(e)
+
+        log.debug('downloading %r (%s bytes) with %s workers', url, size, workers)
+        threads = [threading.Thread(target=worker) for _ in range(min(workers, ranges.qsize()))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return written[0]
+
+    def readinto(self, url, buffer, start=0, params=None, retries=DOWNLOAD_RETRIES, chunk_size=1024*1024,
+                 stall_timeout=STALL_TIMEOUT, progress=None):
+        '''Fill `buffer` with the bytes of url from `start`, straight from the socket.
+
+        `buffer` is anything writable with the buffer protocol, e.g. a bytearray, an mmap or a
+        memoryview of a part of one. The body of a range request is read into it `chunk_size` bytes
+        at a time, without making bytes objects of its own along the way. If given, progress(n) is
+        called as n bytes come in.
+
+        Downloads that break off or stall are resumed from the last byte we got, like in
+        .iterrange(). Returns number of bytes read, which is less than len(buffer) only if the
+        content ends before the buffer does'''
+        view = memoryview(buffer)
+        size = len(view)
+        pos = 0
+        attempt = 0
+        timeout = (stall_timeout, stall_timeout) if stall_timeout else REQUEST_TIMEOUT
+        while pos < size:
+            progress_at = pos
+            r = None
+            try:
+                r = self.request(url, params=params, extra_headers={'Range':range_header(start+pos, start+size)},
+                                 timeout=timeout)
+                if r.status_code == 416: # there's nothing from start+pos
+                    return pos
+                elif r.status_code == 200 and start+pos > 0:
+                    raise JFSRangeError('Server ignored our Range header for %s' % url)
+                elif not r.ok:
+                    o = lxml.objectify.fromstring(r.content)
+                    JFSError.raiseError(o, url)
+                read = rawreader(r)
+                length = r.headers.get('Content-Length')
+                length = int(length) if length is not None and not r.headers.get('Content-Encoding') else None
+                got = 0
+                while pos < size:
+                    n = read(view[pos:min(pos+chunk_size, size)]) # a silent socket times out
+                    if not n:
+                        if length is not None and got < length: # http.client doesn't complain
+                            raise JFSStallError('Response ended at %s, expected %s bytes' % (got, length))
+                        return pos # the server sent all it has
+                    got += n
+                    pos += n
+                    self.download_throttle.consume(n)
+                    if progress is not None:
+                        progress(n)
+                if r.raw.isclosed(): # we got the whole response, the connection may be used again
+                    r.raw.release_conn()
+                    r = None
+                return pos
+            except (READ_ERRORS + (JFSServerError, JFSStallError)) as e:
+                # .request() raises JFSServerError on http 500, which may well be temporary
+                error = e
+            finally:
+                if r is not None:
+                    r.close()
+            attempt = 1 if pos > progress_at else attempt + 1
+            if attempt > retries:
+                raise error
+            log.warning('Download of %r broke off at byte %s (%r), resuming (%s/%s)', url, start+pos, error, attempt, retries)
+        return pos
+
+    def download_to(self, url, fd, size, params=None, workers=DOWNLOAD_WORKERS, range_size=DOWNLOAD_RANGE_SIZE,
+                    retries=DOWNLOAD_RETRIES, callback=None, stall_timeout=STALL_TIMEOUT, keep_cache=True):
+        '''Download `size` bytes from url into the file at `fd`, a file descriptor open for reading
+        and writing, fetching byte ranges in parallel, like .download().
+
+        The file is preallocated (see preallocate()) and mapped into memory, and each range is read
+        from the socket straight into its place in the map, with .readinto(). No chunks are
+        allocated, copied or written on the way, so memory use stays flat, however big the file is.
+        If the file can't be mapped, each worker reads into a buffer of its own, that it reuses.
+
+        With one worker, there's nothing to gain from ranges, and the file is fetched with a single
+        request (written as it comes, if the file can't be mapped).
+
+        Pass keep_cache=False to have the file flushed to disk afterwards, and tell the kernel we
+        won't be reading it anytime soon, so a big download doesn't push everything else out of
+        the page cache (see fadvise()).
+
+        If callback is given, it is called with (bytes_written, size) as data arrives.
+        Returns number of bytes written'''
+        preallocate(fd, size)
+        if not size:
+            return 0
+        try:
+            mapped = mmap.mmap(fd, size)
+        except (IOError, OSError, ValueError, mmap.error) as e:
+            log.debug('could not map fd %s (%r), reading into buffers instead', fd, e)
+            mapped = None
+        if workers <= 1:
+            range_size = size # all in one request
+        ranges = queue.Queue()
+        for r in byteranges(size, range_size):
+            ranges.put(r)
+        lock = threading.Lock()
+        written = [0]
+        errors = []
+
+        def progress(n):
+            with lock:
+                written[0] += n
+                if callback is not None:
+                    callback(written[0], size)
+
+        def fetch(start, end, buf):
+            'Get the bytes from start to end into buf, a part of the map, or our own buffer'
+            view = memoryview(buf)[:end-start]
+            try:
+                got = self.readinto(url, view, start, params=params, retries=retries,
+                                    stall_timeout=stall_timeout, progress=progress)
+                if got < end-start:
+                    raise JFSStallError('Content of %r ended at %s, expected %s bytes' % (url, start+got, size))
+                if mapped is None:
+                    with lock:
+                        os.lseek(fd, start, os.SEEK_SET)
+                        while view:
+                            view = view[os.write(fd, view):]
+            finally:
+                del view # or the map can't be closed
+
+        def fetchstream(start, end):
+            'Get the bytes from start to end, writing them as they come. For one worker, without a map'
+            def write(offset, chunk):
+                os.lseek(fd, offset, os.SEEK_SET)
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view):]
+                progress(len(chunk))
+            self.getrange(url, start, end, write, params=params, retries=retries, chunk_size=1024*1024,
+                          stall_timeout=stall_timeout)
+
+        def worker():
+            buf = None if mapped is None else memoryview(mapped)
+            try:
+                while not errors:
+                    try:
+                        start, end = ranges.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        if mapped is not None:
+                            fetch(start, end, buf[start:end])
+                        elif workers <= 1:
+                            fetchstream(start, end)
+                        else:
+                            if buf is None:
+                                buf = bytearray(min(range_size, size))
+                            fetch(start, end, buf)
+                    except Exception as e:
+                        log.exception('Failed to get bytes %s-%s of %r', start, end, url)
+                        errors.append(e)
+            finally:
+                del buf
+
+        log.debug('downloading %r (%s bytes) to fd %s with %s workers', url, size, fd, workers)
+        threads = [threading.Thread(target=worker) for _ in range(min(workers, ranges.qsize()))]
+        try:
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError: # a traceback in errors holds on to a part of it; it closes when that's gone
+                    pass
+        if errors:
+            raise errors[0]
+        if not keep_cache:
+            os.fsync(fd)
+            fadvise(fd, 'DONTNEED')
+        return written[0]
+
+    def multipart(self, files, upload_callback=None):
+        '''Make the request body for posting `files`, a jottalib.multipart.MultipartBody,
+        sent .upload_chunk_size bytes at a time. upload_callback(body, length) is called as it goes'''
+        m = MultipartBody(files, chunk_size=self.upload_chunk_size)
+        if upload_callback is not None:
+            m.callback = lambda monitor: upload_callback(monitor, m.len)
+        return m
+
+    def _invalidate(self, url, params=None):
+        '''Forget what we know about url, and the destination of a move in `params`, because we are
+        changing it. Cached objects for them and their parents are stale, and what we know doesn't
+        exist may well exist after this. `url` is not escaped'''
+        urls = [url]
+        for move in ('mv', 'mvDir'):
+            if params and move in params: # and so is the destination, if we're moving something
+                urls.append(JFS_ROOT + params[move].lstrip('/'))
+        for url in urls:
+            self.cache.invalidate(url)
+            self.notfound.invalidate(url)
+            if self.httpcache is not None:
+                self.httpcache.invalidate(self.escapeUrl(url)) # it goes by the urls we fetch, see .xml()
+
+    def post(self, url, content='', files=None, params=None, extra_headers={}, upload_callback=None, idempotent=None):
+        '''HTTP Post files[] or content (unicode string) to url
+
+        Failed posts are retried according to .retry, but only the ones that are safe to repeat,
+        i.e. uploads and the IDEMPOTENT_POSTS, unless you say otherwise with `idempotent`'''
         if not url.startswith('http'):
             # relative url
             url = self.rootpath + url
 
         log.debug('posting content (len %s) to url %s', len(content) if content is not None else '?', url)
-        headers = self.session.headers.copy()
-        headers.update(**extra_headers)
-
-        if not files is None:
-            m = requests_toolbelt.MultipartEncoder(fields=files)
-            if upload_callback is not None:
-                m_len = m.len # compute value for callback closure
-                def callback(monitor):
-                    upload_callback(monitor, m_len)
-
-                m = requests_toolbelt.MultipartEncoderMonitor(m, callback)
-            headers['content-type'] = m.content_type
-        else:
-            m = content
+        target = url # unescaped, like the cache keys
+        self._invalidate(target, params)
+        headers = dict(extra_headers)
+        if idempotent is None:
+            # an upload replaces the file with the same contents, however many times we do it
+            idempotent = files is not None or any(p in (params or {}) for p in IDEMPOTENT_POSTS)
+        # where the files start, so we can rewind them for a retry
+        offsets = dict((name, field[1].tell()) for name, field in (files or {}).items() if hasattr(field[1], 'seek'))
+
+        def send():
+            if files is None:
+                return self.transport.request('POST', url, data=content, params=params, headers=headers)
+            for name, offset in offsets.items():
+                files[name][1].seek(offset)
+            m = self.multipart(files, upload_callback)
+            if hasattr(m, '__iter__') and not six.PY2: # httplib on python 2 sends only strings and files
+                body = ThrottledBody(m, self.upload_throttle)
+            else:
+                body = ThrottledReader(m, self.upload_throttle)
+            return self.transport.request('POST', url, data=body, params=params,
+                                          headers=dict(headers, **{'content-type': m.content_type}))
+
         url = self.escapeUrl(url)
-        r = self.session.post(url, data=m, params=params, headers=headers)
+        try:
+            r = self.retry.call(send, idempotent=idempotent, description='POST %s' % url)
+        finally:
+            # a .getObject() that ran while we were posting may have cached what was there before
+            self._invalidate(target, params)
+            self.flights.forget() # whatever is being fetched right now may be from before this
         if not r.ok:
             log.warning('HTTP POST failed: %s', r.text)
             raise JFSError(r.reason)
         return self.getObject(r) # return a JFS* class
 
-    def up(self, path, fileobject, upload_callback=None, resume_offset=None):
-        "Upload a fileobject to path, HTTP POST-ing to up.jottacloud.com, using the JottaCloud API"
+    def up(self, path, fileobject, upload_callback=None, resume_offset=None, md5=None, spool=False):
+        """Upload a fileobject to path, HTTP POST-ing to up.jottacloud.com, using the JottaCloud API
+
+        If you already know the md5 hash of the file contents, pass it as `md5`, and we'll
+        skip reading through the file to calculate it.
+
+        If the hash is unknown and `spool` is True, the file is read only once: we hash it while
+        copying it to a local spool (see spool_and_hash()), and upload from the spool.
+
+        `fileobject` may also be something we can't seek in, like a pipe, stdin or a socket, or a
+        generator of bytes (see readable()). JottaCloud wants the size and hash up front, so
+        those are always spooled, and read once.
+
+        With `resume_offset`, only the bytes from there on are sent, see JFSIncompleteFile.resume()."""
         """
 
         *** WHAT DID I DO?: created file
@@ -1125,11 +2055,32 @@ class JFS(object):
         Accept-Language: nb-NO,en,*
         Host: up.jottacloud.com
         """
-        url = path.replace('www.jottacloud.com', 'up.jottacloud.com')
+        url = path
+        if not url.startswith('http'):
+            # relative url
+            url = self.rootpath + url
+        url = url.replace('www.jottacloud.com', 'up.jottacloud.com')
+        fileobject = readable(fileobject)
+        streaming = not seekable(fileobject)
+        # Get timestamp from the original file, before we possibly swap it for a spool
+        try:
+            mtime = os.path.getmtime(fileobject.name)
+            timestamp = datetime.datetime.fromtimestamp(mtime).isoformat()
+        except Exception as e:
+            if hasattr(fileobject, 'name') and not streaming: # stdin is called <stdin>
+                log.exception('Problems getting mtime from fileobjet: %r', e)
+            timestamp = datetime.datetime.now().isoformat()
+
+        if streaming or (md5 is None and spool):
+            md5, fileobject = spool_and_hash(fileobject)
+
         # Calculate file length
         fileobject.seek(0,2)
         contentlen = fileobject.tell()
 
+        # Calculate file md5 hash, unless we know it already
+        md5hash = md5 if md5 is not None else calculate_md5(fileobject)
+
         # Rewind read head to correct offset
         # If we're resuming an incomplete upload, continue from that offset
         try:
@@ -1144,25 +2095,8 @@ class JFS(object):
                         url)
             fileobject.seek(0)
 
-
-        # Calculate file md5 hash
-        md5hash = calculate_md5(fileobject)
-
         log.debug('posting content (len %s, hash %s) to url %r', contentlen, md5hash, url)
-        try:
-            mtime = os.path.getmtime(fileobject.name)
-            timestamp = datetime.datetime.fromtimestamp(mtime).isoformat()
-        except Exception as e:
-            if hasattr(fileobject, 'name'):
-                log.exception('Problems getting mtime from fileobjet: %r', e)
-            timestamp = datetime.datetime.now().isoformat()
         params = {'cphash': md5hash}
-        m = requests_toolbelt.MultipartEncoder({
-             'md5': ('', md5hash),
-             'modified': ('', timestamp),
-             'created': ('', timestamp),
-             'file': (os.path.basename(url), fileobject, 'application/octet-stream'),
-        })
         headers = {'JMd5':md5hash,
                    'JCreated': timestamp,
                    'JModified': timestamp,
@@ -1170,9 +2104,7 @@ class JFS(object):
                    'JSize': str(contentlen), # headers have to be strings or bytes , cf #122
                    'jx_csid': '',
                    'jx_lisence': '',
-                   'content-type': m.content_type,
                    }
-        fileobject.seek(0) # rewind read index for requests.post
         files = {'md5': ('', md5hash),
                  'modified': ('', timestamp),
                  'created': ('', timestamp),
@@ -1187,13 +2119,28 @@ class JFS(object):
         # and encrypted with a public key in the apk.  The field appears to be optional
         url = posixpath.join(self.rootpath, name)
         r = self.post(url, {'type': type})
+        self._fs = self._devices = None # fetch them again when asked
         return r
 
+    def getFolder(self, path):
+        '''Get a JFSFolder for path, or a JFSMountPoint if path is a mountpoint like /Jotta/Sync,
+        without asking JottaCloud anything. Its files and subfolders are fetched when you first
+        read them, which is also when you'll find out if it doesn't exist'''
+        if not path.startswith('http'):
+            # relative url
+            path = self.rootpath + path
+        path = path.rstrip('/')
+        parent, name = posixpath.split(path)
+        tag = 'mountPoint' if posixpath.dirname(parent) == self.rootpath else 'folder' # /<device>/<mountpoint>
+        return self.wrappers[tag](lxml.etree.Element(tag, name=name), self, parent)
+
     # property overloading
     @property
     def devices(self):
-        'return generator of configured devices'
-        return self.fs is not None and [JFSDevice(d, self, parentpath=self.rootpath) for d in self.fs.devices.iterchildren()] or [x for x in []]
+        'return list of configured devices'
+        if self._devices is None:
+            self._devices = [self.wrappers['device'](d, self, parentpath=self.rootpath) for d in self.fs.devices.iterchildren()] if self.fs is not None else []
+        return list(self._devices)
 
     @property
     def locked(self):
@@ -0,0 +1,468 @@
+# -*- encoding: utf-8 -*-
+'''An asyncio counterpart to jottalib.JFS.JFS, for running lots of requests concurrently from one thread.
+
+    import asyncio
+    from jottalib.aio import AsyncJFS
+
+    async def main():
+        async with AsyncJFS() as jfs:
+            folder = await jfs.getObject('/Jotta/Archive')
+            for f in await folder.files():
+                async for chunk in f.stream():
+                    ...
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+The objects you get back are the familiar JFS* classes, wrapped by the same code as in
+jottalib.JFS. Methods that talk to JottaCloud are coroutines, so you need to `await` them.
+AsyncJFS is not a JFS, though: what JFS has beyond getObject(), stream() and up(), like
+download() and iterfiledirlist(), isn't here.
+
+Requires python 3.5+ and aiohttp (pip install aiohttp).
+'''
+#
+# This file is part of jottafs.
+#
+# jottafs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottafs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import os, os.path, posixpath, logging, datetime, asyncio, ssl, base64
+
+# importing external dependencies (pip these, please!)
+import six
+import certifi
+import lxml, lxml.objectify, lxml.etree
+try:
+    import aiohttp, aiohttp.payload # pip install aiohttp
+    from yarl import URL # comes with aiohttp
+except ImportError:
+    print("jottalib.aio won't work without aiohttp! Please run `pip install aiohttp`.")
+    raise
+
+# import our stuff
+from jottalib import __version__
+from jottalib.JFS import JFS, JFSError, JFSServerError, JFS_ROOT, get_auth_info, calculate_md5, \
+                         JFSFolder, JFSMountPoint, JFSDevice, JFSIncompleteFile, JFSFile
+from jottalib.multipart import UPLOAD_CHUNK_SIZE
+from jottalib.cache import ObjectCache
+
+log = logging.getLogger(__name__)
+
+
+def _notasync(name, instead):
+    'Make a method for what a sync JFS* object does, but ours can\'t, that says what to do `instead`'
+    def method(self, *args, **kwargs):
+        raise JFSError('%s.%s() needs a jottalib.JFS.JFS, not an AsyncJFS. %s' % (type(self).__name__, name, instead))
+    method.__name__ = name
+    return method
+
+
+class AsyncFolderMixin(object):
+    'The parts of JFSFolder that talk to JottaCloud, as coroutines'
+
+    async def sync(self):
+        'Update state of folder from Jottacloud server'
+        log.info("syncing %r" % self.path)
+        self.decode(await self.jfs.get(self.path, objectify=False))
+        self.synced = True
+
+    async def files(self):
+        'Get a list of files in this folder'
+        if not self.synced:
+            await self.sync()
+        return list(JFSFolder.files(self))
+
+    async def folders(self):
+        'Get a list of subfolders'
+        if not self.synced:
+            await self.sync()
+        return JFSFolder.folders(self)
+
+    async def mkdir(self, foldername):
+        'Create a new subfolder and return the new JFSFolder'
+        r = await self.jfs.post(posixpath.join(self.path, foldername), params={'mkDir':'true'})
+        self.update(r)
+        return r
+
+    async def delete(self):
+        'Delete this folder and return a deleted JFSFolder'
+        r = await self.jfs.post(self.path, params={'dlDir':'true'})
+        self.deleted = r.deleted
+        self.synced = False
+        return r
+
+    async def up(self, fileobj_or_path, filename=None, md5=None):
+        'Upload a file to current folder and return the new JFSFile'
+        if isinstance(fileobj_or_path, six.string_types):
+            filename = filename or os.path.basename(fileobj_or_path)
+            with open(fileobj_or_path, 'rb') as fileobject:
+                return await self.up(fileobject, filename, md5=md5)
+        elif not hasattr(fileobj_or_path, 'read'):
+            raise JFSError("Need filename or file-like object")
+        if filename is None:
+            if hasattr(fileobj_or_path, 'name'):
+                filename = os.path.basename(fileobj_or_path.name)
+            else:
+                raise JFSError("Unable to guess filename")
+        r = await self.jfs.up(posixpath.join(self.path, filename), fileobj_or_path, md5=md5)
+        self.update(r)
+        return r
+
+    iterfiledirlist = _notasync('iterfiledirlist', 'Use `await .filedirlist()`')
+
+
+class AsyncJFSFolder(AsyncFolderMixin, JFSFolder):
+    'JFSFolder for AsyncJFS'
+    pass
+
+
+class AsyncJFSMountPoint(AsyncFolderMixin, JFSMountPoint):
+    'JFSMountPoint for AsyncJFS'
+    delete = JFSMountPoint.delete # makes no sense here
+
+
+class AsyncJFSDevice(JFSDevice):
+    '''JFSDevice for AsyncJFS.
+
+    Unlike JFSDevice, we don't go fetching mountpoints when we're created, so unless the xml
+    lists them, the .mountPoints dict is empty until you `await device.mountpointobjects()`'''
+    def __init__(self, deviceobject, jfs, parentpath): # deviceobject from lxml.objectify
+        self._jfs = jfs
+        self.parentPath = parentpath
+        self.decode(deviceobject)
+        self.mountPoints = {mp.name:mp for mp in self._mountpoints(deviceobject)}
+
+    async def contents(self, path=None):
+        'Get _all_ metadata for this device.'
+        if isinstance(path, object) and hasattr(path, 'name'):
+            path = '/%s' % path.name
+        return await self._jfs.get('%s%s' % (self.path, path or '/'))
+
+    async def mountpointobjects(self):
+        'Get a list of JFSMountPoints, and fill in .mountPoints'
+        mps = self._mountpoints(await self.contents())
+        self.mountPoints = {mp.name:mp for mp in mps}
+        return mps
+
+    async def files(self, mountPoint):
+        'Get a list of JFSFile() from the given mountPoint (an object or its .name)'
+        if isinstance(mountPoint, six.string_types):
+            mountPoint = self.mountPoints[mountPoint]
+        c = await self.contents(mountPoint)
+        try:
+            return [self._jfs.wrappers['file'](f, self._jfs, parentpath='%s/%s' % (self.path, mountPoint.name)) for f in c.files.iterchildren()]
+        except AttributeError:
+            return []
+
+    async def folders(self, mountPoint):
+        'Get a list of JFSFolder() from the given mountPoint (an object or its .name)'
+        if isinstance(mountPoint, six.string_types):
+            mountPoint = self.mountPoints[mountPoint]
+        c = await self.contents(mountPoint)
+        try:
+            return [self._jfs.wrappers['folder'](f, self._jfs, parentpath='%s/%s' % (self.path, mountPoint.name)) for f in c.folders.iterchildren()]
+        except AttributeError:
+            return []
+
+
+class AsyncJFSFile(JFSFile):
+    'JFSFile for AsyncJFS. To download it, use `async for chunk in .stream()`'
+    download = _notasync('download', 'Use `async for chunk in .stream()`')
+    download_to = _notasync('download_to', 'Use `async for chunk in .stream()`')
+    readinto = _notasync('readinto', 'Use `async for chunk in .stream()`')
+
+
+class AsyncJFSIncompleteFile(JFSIncompleteFile):
+    'JFSIncompleteFile for AsyncJFS'
+
+    async def resume(self, data, md5=None):
+        'Resume uploading an incomplete file, after a previous upload was interrupted. Returns new file object'
+        if not hasattr(data, 'read'):
+            data = six.BytesIO(data)
+        if self.size is None:
+            log.debug('%r is an incomplete file, but .size is unknown. Refreshing the file object from server', self.path)
+            self.decode(await self.jfs.get(self.path, objectify=False))
+        if md5 is None:
+            md5 = await asyncio.get_event_loop().run_in_executor(None, calculate_md5, data)
+        if md5 != self.md5:
+            raise JFSError('''MD5 hashes don't match! Are you trying to resume with the wrong file?''')
+        log.debug('Resuming %s from offset %s', self.path, self.size)
+        return await self.jfs.up(self.path, data, resume_offset=self.size, md5=md5)
+
+
+class UploadPayload(aiohttp.payload.Payload):
+    '''The file of an upload, sent from where it's at (its .tell()) to the end, `size` bytes.
+
+    It's read `chunk_size` bytes at a time in an executor, so the event loop never waits for the
+    disk. What aiohttp makes of a file by itself may be read right on the loop'''
+    def __init__(self, fileobject, size, chunk_size=UPLOAD_CHUNK_SIZE, **kwargs):
+        super(UploadPayload, self).__init__(fileobject, **kwargs)
+        self._size = size
+        self.chunk_size = chunk_size
+
+    def decode(self, encoding='utf-8', errors='strict'):
+        raise TypeError('An upload is not text')
+
+    async def write(self, writer):
+        await self.write_with_length(writer, None)
+
+    async def write_with_length(self, writer, content_length):
+        loop = asyncio.get_event_loop()
+        left = self._size if content_length is None else min(self._size, content_length)
+        while left > 0:
+            chunk = await loop.run_in_executor(None, self._value.read, min(self.chunk_size, left))
+            if not chunk:
+                raise IOError('%r ended %s bytes early' % (self._value, left))
+            await writer.write(chunk)
+            left -= len(chunk)
+
+
+class AsyncStream(object):
+    '''Async iterator over the body of a GET request, see AsyncJFS.stream().
+
+    The response is released when the body runs out or reading it fails. Stop early with
+    `await .aclose()`; an `async with` block does that for you'''
+    def __init__(self, jfs, url, params, chunk_size):
+        self.jfs = jfs
+        self.url = url
+        self.params = params
+        self.chunk_size = chunk_size
+        self.response = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.response is None:
+            self.response = await self.jfs.request(self.url, params=self.params)
+        try:
+            chunk = await self.response.content.read(self.chunk_size)
+        except BaseException: # including asyncio.CancelledError
+            await self.aclose()
+            raise
+        if not chunk:
+            await self.aclose()
+            raise StopAsyncIteration
+        return chunk
+
+    async def aclose(self):
+        'Stop streaming, and give the connection back to the pool'
+        if self.response is not None:
+            self.response.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class AsyncJFS(object):
+    '''An asyncio version of JFS, built on aiohttp.
+
+    Call `await .login()` (or use `async with AsyncJFS() as jfs:`) before anything else.
+
+    We share the xml -> JFS* object mapping with JFS (.wrappers, .wrap()), but nothing else.
+
+    `max_connections` caps the number of simultaneous connections to JottaCloud. `cache` is as
+    for JFS: pass True, or an ObjectCache, to cache .getObject() results. Default: no cache.'''
+    wrappers = dict(JFS.wrappers,
+                    folder=AsyncJFSFolder,
+                    mountPoint=AsyncJFSMountPoint,
+                    device=AsyncJFSDevice,
+                    file=AsyncJFSFile,
+                    incompleteFile=AsyncJFSIncompleteFile,
+                    restoredFiles=AsyncJFSFile,
+                    deleteFiles=AsyncJFSFile)
+
+    fs = None # the <user> root. Unlike JFS, we can't fetch it when asked, so see .login()
+
+    wrap = JFS.wrap
+    escapeUrl = JFS.escapeUrl
+
+    def __init__(self, auth=None, max_connections=100, cache=False):
+        self.apiversion = '2.2' # hard coded per october 2014
+        if not auth:
+            auth = get_auth_info()
+        self.username, password = auth
+        self.rootpath = JFS_ROOT + self.username
+        self.fs = None
+        if cache is True:
+            cache = ObjectCache()
+        elif cache is None or cache is False: # not `not cache`: an empty ObjectCache is falsy
+            cache = ObjectCache(maxentries=0)
+        self.cache = cache
+        credentials = base64.b64encode(('%s:%s' % (self.username, password)).encode('utf-8')).decode('ascii')
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_connections,
+                                           ssl=ssl.create_default_context(cafile=certifi.where())),
+            headers={'User-Agent':'jottalib %s (https://github.com/havardgulldahl/jottalib)' % (__version__, ),
+                     'X-JottaAPIVersion': self.apiversion,
+                     'Authorization': 'Basic %s' % credentials, # aiohttp.BasicAuth is deprecated
+                    },
+            timeout=aiohttp.ClientTimeout(total=1800))
+
+    async def login(self):
+        'Get the user root from JottaCloud, checking our credentials'
+        self.fs = await self.get(self.rootpath)
+        return self.fs
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _url(self, url):
+        'Get an absolute, escaped URL that aiohttp wont escape again'
+        if not url.startswith('http'):
+            # relative url
+            url = self.rootpath + url
+        return URL(self.escapeUrl(url), encoded=True)
+
+    async def request(self, url, extra_headers=None, params=None):
+        'Make a GET request for url, and return the aiohttp response. Remember to .release() it'
+        log.debug("getting url: %r, extra_headers=%r, params=%r", url, extra_headers, params)
+        r = await self.session.get(self._url(url), headers=extra_headers, params=params)
+        if r.status in ( 500, ):
+            r.release()
+            raise JFSServerError(r.reason)
+        return r
+
+    async def raw(self, url, extra_headers=None, params=None):
+        'Make a GET request for url and return whatever content we get'
+        r = await self.request(url, extra_headers=extra_headers, params=params)
+        try:
+            content = await r.read()
+        finally:
+            r.release()
+        if r.status >= 400:
+            o = lxml.objectify.fromstring(content)
+            JFSError.raiseError(o, url)
+        return content
+
+    async def get(self, url, params=None, objectify=True):
+        'Make a GET request for url and return the response content as a generic lxml.objectify (or, with objectify=False, lxml.etree) object'
+        o = (lxml.objectify if objectify else lxml.etree).fromstring(await self.raw(url, params=params))
+        if o.tag == 'error':
+            JFSError.raiseError(o, url)
+        return o
+
+    async def getObject(self, url, params=None):
+        'Get url from JottaCloud and wrap it up with the corresponding JFS* class, caching it in .cache'
+        if not url.startswith('http'):
+            # relative url
+            url = self.rootpath + url
+        obj = self.cache.get(url, params)
+        if obj is None:
+            content = await self.raw(url, params=params)
+            o = lxml.etree.fromstring(content)
+            if o.tag == 'error':
+                JFSError.raiseError(o, url)
+            obj = self.wrap(o, url)
+            if o.tag != 'user':
+                self.cache.put(url, obj, params, size=len(content))
+        return obj
+
+    async def getLatest(self, files=10, sort=None):
+        'Get a list of the n latest files (the server minimum default is 10)'
+        params = {'sort': 'updated', 'max':files, 'web':'true'}
+        result = await self.getObject('/Jotta/Latest', params=params)
+        return list(result.files())
+
+    def stream(self, url, params=None, chunk_size=64*1024, **kwargs):
+        '''Get an async iterator over remote content by chunk_size (bytes)
+
+        The parallel, ranged download options of JFS.stream() are ignored here; run several
+        streams concurrently instead'''
+        return AsyncStream(self, url, params, chunk_size)
+
+    async def post(self, url, content='', files=None, params=None, extra_headers={}):
+        'HTTP Post files (an aiohttp.FormData) or content to url'
+        log.debug('posting content (len %s) to url %s', len(content) if content is not None else '?', url)
+        data = files if files is not None else content
+        target = url if url.startswith('http') else self.rootpath + url
+        self._invalidate(target, params)
+        try:
+            async with self.session.post(self._url(url), data=data, params=params, headers=extra_headers) as r:
+                body = await r.read()
+        finally:
+            # and again, in case someone fetched it while we were posting
+            self._invalidate(target, params)
+        if r.status in ( 500, ):
+            log.warning('HTTP POST failed: %s', body)
+            raise JFSServerError(r.reason)
+        elif r.status >= 400:
+            log.warning('HTTP POST failed: %s', body)
+            raise JFSError(r.reason)
+        return self.wrap(lxml.etree.fromstring(body), str(r.url))
+
+    def _invalidate(self, url, params=None):
+        'Forget cached objects for url, and the destination of a move in `params`, see JFS._invalidate()'
+        self.cache.invalidate(url)
+        for move in ('mv', 'mvDir'):
+            if params and move in params:
+                self.cache.invalidate(JFS_ROOT + params[move].lstrip('/'))
+
+    async def up(self, path, fileobject, resume_offset=None, md5=None):
+        "Upload a fileobject to path, HTTP POST-ing to up.jottacloud.com, using the JottaCloud API"
+        url = path
+        if not url.startswith('http'):
+            url = self.rootpath + url
+        url = url.replace('www.jottacloud.com', 'up.jottacloud.com')
+        try:
+            mtime = os.path.getmtime(fileobject.name)
+            timestamp = datetime.datetime.fromtimestamp(mtime).isoformat()
+        except Exception:
+            timestamp = datetime.datetime.now().isoformat()
+        if md5 is None:
+            # hashing is blocking disk i/o, so keep it out of the event loop
+            md5 = await asyncio.get_event_loop().run_in_executor(None, calculate_md5, fileobject)
+        fileobject.seek(0, 2)
+        contentlen = fileobject.tell()
+        fileobject.seek(resume_offset or 0)
+        log.debug('posting content (len %s, hash %s) to url %r', contentlen, md5, url)
+        data = aiohttp.FormData()
+        data.add_field('md5', md5)
+        data.add_field('modified', timestamp)
+        data.add_field('created', timestamp)
+        data.add_field('file', UploadPayload(fileobject, contentlen - (resume_offset or 0),
+                                             content_type='application/octet-stream'),
+                       filename=os.path.basename(path))
+        headers = {'JMd5': md5,
+                   'JCreated': timestamp,
+                   'JModified': timestamp,
+                   'X-Jfs-DeviceName': 'Jotta',
+                   'JSize': str(contentlen),
+                   'jx_csid': '',
+                   'jx_lisence': '',
+                   }
+        return await self.post(url, files=data, params={'cphash': md5}, extra_headers=headers)
+
+    @property
+    def devices(self):
+        'return list of configured devices. Remember to `await device.mountpointobjects()`'
+        if self.fs is None:
+            return []
+        return [self.wrappers['device'](d, self, parentpath=self.rootpath) for d in self.fs.devices.iterchildren()]
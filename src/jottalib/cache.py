@@ -0,0 +1,223 @@
+# -*- encoding: utf-8 -*-
+'''A bounded, thread safe cache of JFS* objects, keyed by url, and a way to share
+requests that are under way between threads. See JFS.getObject()'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import sys, time, bisect, threading, logging
+from collections import OrderedDict
+
+import six
+
+log = logging.getLogger(__name__)
+
+# defaults
+CACHE_MAX_ENTRIES=10000 # number of objects to keep
+CACHE_MAX_BYTES=64*1024*1024 # total size of the xml behind the objects we keep
+CACHE_TTL=60 # seconds an object stays fresh
+
+
+class ObjectCache(object):
+    '''A least-recently-used cache of objects, keyed by (url, params).
+
+    Bounded by number of entries and by total `size` (whatever unit you put() them with;
+    JFS uses the length of the xml), and every entry expires after `ttl` seconds.
+
+    Keys are also kept in a sorted list, so that .invalidate() can drop a whole subtree
+    with a binary search instead of looking at every entry.
+
+    Set maxentries=0 to disable caching altogether.'''
+
+    def __init__(self, maxentries=CACHE_MAX_ENTRIES, maxbytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self._entries = OrderedDict() # (url, params) -> (value, expires, size), oldest first
+        self._keys = [] # sorted list of (url, params)
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(url, params=None):
+        'Make a cache key from url and request parameters'
+        url = url.replace('up.jottacloud.com', 'www.jottacloud.com').rstrip('/')
+        return (url, tuple(sorted((k, str(v)) for k, v in (params or {}).items())))
+
+    def get(self, url, params=None):
+        'Return the cached object for url and params, or None'
+        k = self.key(url, params)
+        with self._lock:
+            try:
+                value, expires, size = self._entries[k]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self._remove(k)
+                self.misses += 1
+                return None
+            # move to the young end
+            del self._entries[k]
+            self._entries[k] = (value, expires, size)
+            self.hits += 1
+            return value
+
+    def put(self, url, value, params=None, size=0, ttl=None):
+        'Cache value for url and params'
+        if self.maxentries <= 0 or size > self.maxbytes:
+            return
+        k = self.key(url, params)
+        with self._lock:
+            if k in self._entries:
+                self._remove(k)
+            self._entries[k] = (value, time.time() + (self.ttl if ttl is None else ttl), size)
+            bisect.insort(self._keys, k)
+            self._bytes += size
+            while len(self._entries) > self.maxentries or self._bytes > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, url, subtree=True, parents=True):
+        '''Forget everything cached for url.
+
+        With `subtree`, everything below it goes too, and with `parents`, the folders above it'''
+        url, _ = self.key(url)
+        with self._lock:
+            doomed = []
+            i = bisect.bisect_left(self._keys, (url, ))
+            while i < len(self._keys):
+                k = self._keys[i]
+                if k[0] == url or (subtree and k[0].startswith(url + '/')):
+                    doomed.append(k)
+                elif not k[0].startswith(url):
+                    break
+                i += 1
+            if parents:
+                parent = url.rsplit('/', 1)[0]
+                while parent.count('/') > 2: # stop at scheme://host
+                    i = bisect.bisect_left(self._keys, (parent, ))
+                    while i < len(self._keys) and self._keys[i][0] == parent:
+                        doomed.append(self._keys[i])
+                        i += 1
+                    parent = parent.rsplit('/', 1)[0]
+            for k in doomed:
+                self._remove(k)
+            self.invalidations += len(doomed)
+        if doomed:
+            log.debug('invalidated %s cached objects for %r', len(doomed), url)
+
+    def clear(self):
+        'Forget everything'
+        with self._lock:
+            self._entries.clear()
+            del self._keys[:]
+            self._bytes = 0
+
+    def stats(self):
+        'Return a dict of cache statistics'
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                   }
+
+    def _remove(self, k):
+        'Remove key k. Call with the lock held'
+        value, expires, size = self._entries.pop(k)
+        self._bytes -= size
+        i = bisect.bisect_left(self._keys, k)
+        if i < len(self._keys) and self._keys[i] == k:
+            del self._keys[i]
+
+
+class _Flight(object):
+    'A call under way, see SingleFlight'
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None # sys.exc_info() of the call, if it raised
+
+
+class SingleFlight(object):
+    '''Coalesce identical calls that happen at the same time.
+
+    When a thread calls .do(key, fn) while another thread is already running .do() for the
+    same key, it doesn't call fn itself, but waits for the first call to finish, and gets its
+    result (or its exception). Nothing is kept once the call is done; that's for the ObjectCache.
+
+    .calls counts the calls that were made, and .shared the ones that were saved.'''
+
+    def __init__(self):
+        self._flights = {} # key -> _Flight
+        self._lock = threading.Lock()
+        self.calls = self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        'Call fn(*args, **kwargs), unless a call for key is under way already; then wait for that'
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                six.reraise(*flight.error)
+            return flight.result
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except Exception:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def forget(self):
+        '''Let the calls from now on start afresh, instead of waiting for the ones under way.
+        E.g. after a change, when what those will return may be out of date'''
+        with self._lock:
+            self._flights.clear()
+
+    def stats(self):
+        'Return a dict of statistics'
+        with self._lock:
+            return {'calls': self.calls,
+                    'shared': self.shared,
+                    'in flight': len(self._flights),
+                   }
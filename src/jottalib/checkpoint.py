@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+'''Checkpoints of uploads in flight, in SQLite, so an interrupted upload resumes without hashing the file again. See CheckpointStore'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import sys, os, os.path, time, sqlite3, threading, logging
+from collections import namedtuple
+
+import six
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = os.path.join(os.path.expanduser('~'), '.jottalib') # where the default checkpoint file lives
+
+Checkpoint = namedtuple('Checkpoint', 'path jottapath size mtime inode md5 started')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS checkpoints (
+    path TEXT PRIMARY KEY, -- the local file, absolute
+    jottapath TEXT NOT NULL, -- where it is going
+    size INTEGER NOT NULL, -- what the file looked like when we hashed it
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    started REAL NOT NULL -- time.time() when the upload started
+);
+'''
+
+def _text(path):
+    'Local paths are stored as unicode'
+    if isinstance(path, six.binary_type):
+        return path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    return path
+
+
+class CheckpointStore(object):
+    '''What we know about the local files we are uploading, kept in a SQLite database on disk.
+
+    Before an upload starts, .record() the local file with its md5 hash and where it's going.
+    When it's done, .done() it. If the upload is interrupted, the checkpoint stays, and
+    .lookup() hands out the md5 again, without reading the file, as long as the file hasn't
+    changed since: same size, mtime and inode. The upload can then go straight on from where
+    JottaCloud says it broke off, see jottalib.jottacloud.resume().
+
+    Like jottalib.index.RemoteIndex, it's safe to share between processes and threads, so
+    jotta-scanner, jotta-monitor and jotta-upload may all use the default file.'''
+
+    def __init__(self, dbpath=None):
+        if dbpath is None:
+            if not os.path.isdir(CHECKPOINT_DIR):
+                os.makedirs(CHECKPOINT_DIR)
+            dbpath = os.path.join(CHECKPOINT_DIR, 'checkpoints.sqlite')
+        self.dbpath = dbpath
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(dbpath, timeout=60, check_same_thread=False)
+        if dbpath != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self.hits = 0 # hashes we didn't have to calculate
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def identity(path):
+        'Get (size, mtime, inode) of a local file'
+        st = os.stat(path)
+        return st.st_size, st.st_mtime, st.st_ino
+
+    def record(self, path, jottapath, md5):
+        'Remember that we are uploading the local file at path, with md5 hash `md5`, to jottapath'
+        path = os.path.abspath(path)
+        size, mtime, inode = self.identity(path)
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (_text(path), jottapath, size, mtime, inode, md5, time.time()))
+
+    def get(self, path):
+        'Get the Checkpoint for the local file at path, whether it has changed or not, or None'
+        with self._lock:
+            row = self._db.execute('SELECT * FROM checkpoints WHERE path = ?',
+                                   (_text(os.path.abspath(path)), )).fetchone()
+        return Checkpoint(*row) if row is not None else None
+
+    def lookup(self, path):
+        '''Get the md5 hash of the local file at path, if we are uploading it and it hasn't
+        changed since we hashed it. Otherwise, None, and the checkpoint is dropped'''
+        checkpoint = self.get(path)
+        if checkpoint is None:
+            return None
+        try:
+            unchanged = self.identity(path) == (checkpoint.size, checkpoint.mtime, checkpoint.inode)
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            log.debug('%r has changed since we started uploading it, forgetting its checkpoint', path)
+            self.done(path)
+            return None
+        with self._lock:
+            self.hits += 1
+        return checkpoint.md5
+
+    def done(self, path):
+        'Forget the checkpoint of the local file at path, e.g. when it is uploaded'
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM checkpoints WHERE path = ?', (_text(os.path.abspath(path)), ))
+
+    def pending(self):
+        'Get a list of Checkpoints of uploads that are in flight, or were interrupted, oldest first'
+        with self._lock:
+            return [Checkpoint(*row) for row in self._db.execute('SELECT * FROM checkpoints ORDER BY started')]
@@ -34,9 +34,12 @@ import re
 from clint.textui import progress, colored, puts
 from functools import partial
 import codecs
+import signal
 
 # import our stuff
 from jottalib import JFS, __version__
+from jottalib import throttle, jottacloud
+from jottalib.checkpoint import CheckpointStore
 from .scanner import filescanner
 
 # helper functions
@@ -71,15 +74,14 @@ else:
 def get_jfs_device(jfs,device='Jotta'): #Default device is Jotta but can be changed
     jottadev = None
     for j in jfs.devices: # find Jotta/Shared folder
-        if j.name == 'Jotta':
+        if j.name == device:
             jottadev = j
     return jottadev
 
 
 def get_root_dir(jfs,device='Jotta',mountpoint='Sync'): #Default device is Jotta and mountpoint is Sync but can be changed
-    jottadev = get_jfs_device(jfs,device)
-    root_dir = jottadev.mountPoints[mountpoint]
-    return root_dir
+    # no need to look at the devices for this, it's a well known path
+    return jfs.getFolder(posixpath.join('/', device, mountpoint))
 
 def parse_args_and_apply_logging_level(parser, argv):
     args = parser.parse_args(argv)
@@ -107,6 +109,34 @@ def is_dir(path):
         raise argparse.ArgumentTypeError('%s is not a valid directory' % path)
     return path.decode(sys.getfilesystemencoding())
 
+def add_limit_arguments(parser):
+    'Add --upload-limit and --download-limit to an argparse parser'
+    parser.add_argument('--upload-limit',
+                        type=int,
+                        metavar='KiB/s',
+                        help='Keep uploads below this many KiB per second')
+    parser.add_argument('--download-limit',
+                        type=int,
+                        metavar='KiB/s',
+                        help='Keep downloads below this many KiB per second')
+
+def apply_limits(args):
+    '''Set the bandwidth limits for this process from the command line.
+
+    Where we have signals, SIGUSR1 lifts the limits, and puts them back again, without a restart'''
+    limits = (args.upload_limit and args.upload_limit*1024, args.download_limit and args.download_limit*1024)
+    throttle.GLOBAL_UPLOAD.rate, throttle.GLOBAL_DOWNLOAD.rate = limits
+    if not any(limits) or not hasattr(signal, 'SIGUSR1'):
+        return
+    def toggle(signum, frame):
+        if throttle.GLOBAL_UPLOAD.rate or throttle.GLOBAL_DOWNLOAD.rate:
+            logging.info('Lifting bandwidth limits')
+            throttle.GLOBAL_UPLOAD.rate = throttle.GLOBAL_DOWNLOAD.rate = None
+        else:
+            logging.info('Bandwidth limits back on: %r bytes/s', limits)
+            throttle.GLOBAL_UPLOAD.rate, throttle.GLOBAL_DOWNLOAD.rate = limits
+    signal.signal(signal.SIGUSR1, toggle)
+
 ## UTILITIES, ONE PER FUNCTION ##
 
 
@@ -157,21 +187,35 @@ def fuse(argv=None):
 def upload(argv=None):
     if argv is None:
         argv = sys.argv[1:]
-    parser = argparse.ArgumentParser(description='Upload a file to JottaCloud.')
+    parser = argparse.ArgumentParser(description='Upload a file to JottaCloud.',
+                                     epilog='To upload the output of a program, pipe it to "jotta-upload - --name <filename>".')
     parser.add_argument('localfile',
-                        help='The local file that you want to upload',
-                        type=argparse.FileType('r'))
+                        help='The local file that you want to upload, or - to read it from stdin',
+                        type=argparse.FileType('rb'))
     parser.add_argument('remote_dir',
                         help='The remote directory to upload the file to',
                         nargs='?',
                         type=commandline_text)
+    parser.add_argument('--name',
+                        type=commandline_text,
+                        help='The file name on JottaCloud. Default: the name of the local file. Needed with -')
+    parser.add_argument('--spool-dir',
+                        type=commandline_text,
+                        help='Where to keep what we read from stdin while we hash it. Default: the temp dir of the system')
     parser.add_argument('-l', '--loglevel',
                         help='Logging level. Default: %(default)s.',
                         choices=('debug', 'info', 'warning', 'error'),
                         default='warning')
     jfs = JFS.JFS()
     args = parse_args_and_apply_logging_level(parser, argv)
-    decoded_filename = commandline_text(args.localfile.name)
+    stdin = args.localfile in (sys.stdin, getattr(sys.stdin, 'buffer', None))
+    if stdin and not args.name:
+        parser.error('--name is needed to upload from stdin')
+    if args.spool_dir:
+        if not os.path.isdir(args.spool_dir):
+            parser.error('%s is not a valid directory' % args.spool_dir)
+        JFS.SPOOL_DIR = args.spool_dir
+    decoded_filename = args.name or commandline_text(args.localfile.name)
     progress_bar = ProgressBar()
     callback = lambda monitor, size: progress_bar.show(monitor.bytes_read, size)
     root_folder = get_root_dir(jfs)
@@ -180,7 +224,15 @@ def upload(argv=None):
         target_dir = jfs.getObject(target_dir_path)
     else:
         target_dir = root_folder
-    upload = target_dir.up(args.localfile, os.path.basename(decoded_filename), upload_callback=callback)
+    if stdin: # spooled and hashed as it comes in, see JFS.up()
+        upload = target_dir.up(args.localfile, decoded_filename, upload_callback=callback)
+        print('%s uploaded successfully' % decoded_filename)
+        return True
+    jottapath = posixpath.join(target_dir.path, os.path.basename(decoded_filename))
+    args.localfile.close() # we read it ourselves
+    # an interrupted upload of the same contents is resumed, see jottacloud.new()
+    upload = jottacloud.new(args.localfile.name, jottapath, jfs, checkpoints=CheckpointStore(),
+                            upload_callback=callback)
     print('%s uploaded successfully' % decoded_filename)
     return True # TODO: check return value
 
@@ -200,8 +252,7 @@ def share(argv=None):
                         type=argparse.FileType('r'))
     args = parse_args_and_apply_logging_level(parser, argv)
     jfs = JFS.JFS()
-    jottadev = get_jfs_device(jfs)
-    jottashare = jottadev.mountPoints['Shared']
+    jottashare = get_root_dir(jfs, mountpoint='Shared')
     upload = jottashare.up(args.localfile)  # upload file
     public = upload.share() # share file
     logging.debug('Shared %r and got: %r (%s)', args.localfile, public, dir(public))
@@ -271,7 +322,7 @@ def ls(argv=None):
 
 def download(argv=None):
 
-    def download_jfsfile(remote_object, tofolder=None, checksum=False):
+    def download_jfsfile(remote_object, tofolder=None, checksum=False, workers=1, stall_timeout=JFS.STALL_TIMEOUT):
         'Helper function to get a jfsfile and store it in a local folder, optionally checksumming it. Returns boolean'
         if tofolder is None:
             tofolder = '.' # with no arguments, store in current dir
@@ -280,15 +331,12 @@ def download(argv=None):
             puts(colored.red('%s was NOT downloaded successfully - Incomplete file' % remote_file.name))
             return False
         topath = os.path.join(tofolder, remote_object.name)
-        with open(topath, 'wb') as fh:
-            bytes_read = 0
-            puts(colored.white('Downloading: %s, size: %s \t' % (remote_object.name, 
-                                                                 print_size(total_size, humanize=True))))   
-            with ProgressBar(expected_size=total_size) as bar:
-                for chunk_num, chunk in enumerate(remote_object.stream()):
-                    fh.write(chunk)
-                    bytes_read += len(chunk)
-                    bar.show(bytes_read)
+        puts(colored.white('Downloading: %s, size: %s \t' % (remote_object.name, 
+                                                             print_size(total_size, humanize=True))))   
+        with ProgressBar(expected_size=total_size) as bar:
+            # straight into the preallocated file, fetching byte ranges in parallel if workers > 1
+            remote_object.download_to(topath, workers=workers, stall_timeout=stall_timeout,
+                                      callback=lambda bytes_read, size: bar.show(bytes_read))
         if checksum:
             md5_lf = JFS.calculate_md5(open(topath, 'rb'))
             md5_jf = remote_object.md5
@@ -315,6 +363,14 @@ def download(argv=None):
     parser.add_argument('-c', '--checksum',
                         help='Verify checksum of file after download',
                         action='store_true' )
+    parser.add_argument('-w', '--workers',
+                        help='Number of parallel connections to download each file with. Default: %(default)s.',
+                        type=int,
+                        default=1)
+    parser.add_argument('--stall-timeout',
+                        help='Seconds without progress before a download is resumed on a new connection. Default: %(default)s.',
+                        type=int,
+                        default=JFS.STALL_TIMEOUT)
     #parser.add_argument('-r', '--resume',
     #                    help='Will not download the files again if it exist in path',
     #                    action='store_true' )
@@ -334,7 +390,8 @@ def download(argv=None):
     logging.info('Jotta path to object: %s' % item_path)
     remote_object = jfs.getObject(item_path)
     if isinstance(remote_object, JFS.JFSFile):
-        if download_jfsfile(remote_object, checksum=args.checksum):
+        if download_jfsfile(remote_object, checksum=args.checksum, workers=args.workers,
+                            stall_timeout=args.stall_timeout):
             logging.info('%r downloaded successfully', remote_object.path)
             return True
         else:
@@ -347,13 +404,12 @@ def download(argv=None):
         zero_files = [] #Create an list where we can store zero files
         long_path = [] #Create an list where we can store skipped files and folders because of long path
         puts(colored.blue("Getting index for folder: %s" % remote_object.name))
-        fileTree = remote_object.filedirlist().tree #Download the folder tree
-        puts(colored.blue('Total number of folders to download: %d' % len(fileTree)))
         topdir = os.path.dirname(item_path)
         logging.info("topdir: %r", topdir)
 
-        #Iterate through each folder
-        for folder in fileTree:
+        #Get the whole index before we download anything, so the listing isn't left hanging while we do
+        tree = list(remote_object.iterfiledirlist())
+        for folder, folder_files in tree:
             #We need to strip the path to the folder path from account,device and mountpoint details
             logging.debug("folder: %r", folder)
 
@@ -369,7 +425,10 @@ def download(argv=None):
                 logging.info('Entering a new folder: %s' % _rel_folder_path)
                 if not os.path.exists(_rel_folder_path): #Create the folder locally if it doesn't exist
                     os.makedirs(_rel_folder_path)
-                for _file in fileTree[folder]: #Enter the folder and download the files within
+                #Look up all the files in the folder at once
+                remote_files = jfs.getObjects([posixpath.join(topdir, _rel_folder_path, _file.name) for _file in folder_files
+                                               if _file.state not in (JFS.ProtoFile.STATE_CORRUPT, JFS.ProtoFile.STATE_INCOMPLETE)])
+                for _file in folder_files: #Enter the folder and download the files within
                     logging.info("file: %r", _file)
                     #This is the absolute path to the file that is going to be downloaded
                     abs_path_to_object = posixpath.join(topdir, _rel_folder_path, _file.name)
@@ -379,7 +438,7 @@ def download(argv=None):
                         puts(colored.red('%s was NOT downloaded successfully - Incomplete or corrupt file' % _file.name))
                         incomplete_files.append(posixpath.join(_rel_folder_path,_file.name))
                         continue
-                    remote_object = jfs.getObject(abs_path_to_object)
+                    remote_object = remote_files.get(abs_path_to_object) or jfs.getObject(abs_path_to_object)
                     remote_file = remote_object
                     total_size = remote_file.size
                     if total_size == 0: # Indicates an zero file
@@ -391,7 +450,8 @@ def download(argv=None):
                         long_path.append(posixpath.join(_rel_folder_path,remote_file.name))
                         continue
                     #TODO: implement args.resume:
-                    if not download_jfsfile(remote_file, tofolder=_rel_folder_path, checksum=args.checksum):
+                    if not download_jfsfile(remote_file, tofolder=_rel_folder_path, checksum=args.checksum,
+                                            workers=args.workers, stall_timeout=args.stall_timeout):
                         # download failed
                         puts(colored.red("Download failed: %r" % remote_file.path))
         #Incomplete files
@@ -506,6 +566,10 @@ def cat(argv=None):
     parser.add_argument('file',
                         type=commandline_text,
                         help='The path to the file that you want to show')
+    parser.add_argument('--readahead',
+                        type=int,
+                        default=16,
+                        help='Chunks of 64KiB to fetch ahead of the terminal, in the background (0: none). Default: %(default)s.')
     parser.add_argument('-l', '--loglevel',
                         help='Logging level. Default: %(default)s.',
                         choices=('debug', 'info', 'warning', 'error'),
@@ -523,7 +587,7 @@ def cat(argv=None):
         print("%r is not a file (it's a %s), so we can't show it" % (args.file, type(item)))
         sys.exit(1)
     s = ''
-    for chunk in item.stream():
+    for chunk in item.stream(readahead=args.readahead):
         print(chunk.encode(sys.getdefaultencoding()))
         s = s + chunk
     return s
@@ -571,7 +635,13 @@ def scanner(argv=None):
     parser.add_argument('jottapath',
                         type=commandline_text,
                         help='The path at JottaCloud where the tree shall be synced (must exist)')
+    parser.add_argument('--http-cache',
+                        dest='http_cache',
+                        action='store_true',
+                        help='Keep what JottaCloud tells us about folders in ~/.jottalib, and only fetch what has changed on the next run')
+    add_limit_arguments(parser)
     args = parse_args_and_apply_logging_level(parser, argv)
+    apply_limits(args)
     if args.prune_all:
         args.prune_files = True
         args.prune_folders = True
@@ -580,10 +650,11 @@ def scanner(argv=None):
     fh.setLevel(logging.ERROR)
     logging.getLogger('').addHandler(fh)
 
-    jfs = JFS.JFS()
+    jfs = JFS.JFS(httpcache=args.http_cache)
 
     logging.info('args: topdir %r, jottapath %r', args.topdir, args.jottapath)
-    filescanner(args.topdir, args.jottapath, jfs, args.errorfile, args.exclude, args.dry_run, args.prune_files, args.prune_folders)
+    filescanner(args.topdir, args.jottapath, jfs, args.errorfile, args.exclude, args.dry_run, args.prune_files, args.prune_folders,
+                CheckpointStore())
 
 
 def monitor(argv=None):
@@ -622,11 +693,13 @@ def monitor(argv=None):
                         type=commandline_text,
                         help='Mode of operation: ARCHIVE, SYNC or SHARE. See README.md',
                         choices=( 'archive', 'sync', 'share') )
+    add_limit_arguments(parser)
     args = parse_args_and_apply_logging_level(parser, argv)
+    apply_limits(args)
     fh = logging.FileHandler(args.errorfile)
     fh.setLevel(logging.ERROR)
     logging.getLogger('').addHandler(fh)
 
     jfs = JFS.JFS()
 
-    filemonitor(args.topdir, args.mode, jfs)
+    filemonitor(args.topdir, args.mode, jfs, CheckpointStore())
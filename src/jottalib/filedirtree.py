@@ -0,0 +1,293 @@
+# -*- encoding: utf-8 -*-
+'''A compact, columnar store for big <filedirlist> trees. See JFSFileDirList'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import binascii, posixpath, uuid, logging
+from array import array
+from collections import namedtuple, Counter
+try:
+    from collections.abc import Mapping # py3
+except ImportError:
+    from collections import Mapping # py2
+
+import six
+
+log = logging.getLogger(__name__)
+
+TreeFile = namedtuple('TreeFile', 'name size md5 uuid state')
+
+try:
+    array('q')
+    SIZE_TYPECODE = INDEX_TYPECODE = 'q' # signed 64 bit
+except ValueError: # python 2 has no 'q'
+    SIZE_TYPECODE = 'd' # doubles are exact up to 2**53 bytes, which will do
+    INDEX_TYPECODE = 'l'
+
+NO_MD5 = b'\0' * 16
+
+
+class FileDirTree(object):
+    '''All the files of a <filedirlist>, stored column by column instead of as one object per file.
+
+    Per file, we keep
+      - the name, utf-8 encoded, in one big bytearray, with offsets into it in an array('q')
+      - the size in an array('q') (and a flag in a bytearray if the size is unknown)
+      - the md5 as a packed 16 byte digest, in one big bytearray
+      - the uuid as 16 packed bytes, in one big bytearray
+      - the state as an index into .statenames, in an array('B')
+
+    Folders are kept in order, each path once, with the index of its first file. Whatever
+    doesn't pack (e.g. a missing md5) is kept as is, in a small side table.
+
+    That's a handful of python objects in total, however many files there are.
+
+    Lookups by path go through the folder and scan its files, unless you .build_indexes(),
+    which adds hash indexes by full path and by md5.
+
+    Fill it with .append(folderpath, [TreeFile, ...]), e.g. from JFS.iterfiledirlist():
+
+        tree = FileDirTree.fromiter(jfs.iterfiledirlist('/Jotta/Archive'))
+    '''
+
+    def __init__(self):
+        self.folders = [] # folder paths, in order
+        self._folderindex = {} # folder path -> index in .folders
+        self._folderstart = array(INDEX_TYPECODE, [0]) # file index where each folder starts, and the end
+        self._names = bytearray()
+        self._nameoffsets = array(INDEX_TYPECODE, [0])
+        self.sizes = array(SIZE_TYPECODE)
+        self._nosize = bytearray() # 1 where size is None
+        self._md5s = bytearray()
+        self._uuids = bytearray()
+        self.states = array('B')
+        self.statenames = [] # state code -> state name
+        self._statecodes = {} # state name -> state code
+        self._oddities = {} # (file index, field) -> value, for values that we can't pack
+        self._pathindex = None
+        self._md5index = None
+
+    @classmethod
+    def fromiter(cls, folders):
+        'Build a FileDirTree from an iterable of (folderpath, [TreeFile, ...]), like JFS.iterfiledirlist()'
+        tree = cls()
+        for folderpath, files in folders:
+            tree.append(folderpath, files)
+        return tree
+
+    def __len__(self):
+        'Number of files'
+        return len(self.sizes)
+
+    def append(self, folderpath, files):
+        'Add a folder and its files, an iterable of TreeFile'
+        if folderpath in self._folderindex:
+            raise ValueError('Folder %r is in the tree already' % folderpath)
+        self._folderindex[folderpath] = len(self.folders)
+        self.folders.append(folderpath)
+        for f in files:
+            self._appendfile(f)
+        self._folderstart.append(len(self.sizes))
+        self._pathindex = self._md5index = None # stale
+
+    def _appendfile(self, f):
+        i = len(self.sizes)
+        self._names.extend(f.name.encode('utf-8'))
+        self._nameoffsets.append(len(self._names))
+        self.sizes.append(f.size or 0)
+        self._nosize.append(f.size is None)
+        try:
+            digest = binascii.unhexlify(f.md5)
+            if len(digest) != 16 or digest == NO_MD5:
+                raise ValueError
+        except (TypeError, ValueError, binascii.Error):
+            digest = NO_MD5
+            self._oddities[(i, 'md5')] = f.md5
+        self._md5s.extend(digest)
+        try:
+            packed = uuid.UUID(f.uuid)
+            if str(packed) != f.uuid:
+                raise ValueError
+            packed = packed.bytes
+        except (TypeError, ValueError, AttributeError):
+            packed = b'\0' * 16
+            self._oddities[(i, 'uuid')] = f.uuid
+        self._uuids.extend(packed)
+        try:
+            code = self._statecodes[f.state]
+        except KeyError:
+            code = self._statecodes[f.state] = len(self.statenames)
+            self.statenames.append(f.state)
+        self.states.append(code)
+
+    # getting files back
+
+    def file(self, i):
+        'Get file number i as a TreeFile'
+        o = self._nameoffsets
+        name = bytes(self._names[o[i]:o[i+1]]).decode('utf-8')
+        size = None if self._nosize[i] else int(self.sizes[i])
+        if (i, 'md5') in self._oddities:
+            md5 = self._oddities[(i, 'md5')]
+        else:
+            md5 = six.text_type(binascii.hexlify(bytes(self._md5s[16*i:16*i+16])).decode('ascii'))
+        if (i, 'uuid') in self._oddities:
+            uuid_ = self._oddities[(i, 'uuid')]
+        else:
+            uuid_ = six.text_type(uuid.UUID(bytes=bytes(self._uuids[16*i:16*i+16])))
+        return TreeFile(name, size, md5, uuid_, self.statenames[self.states[i]])
+
+    def files(self, folderpath):
+        'Get a list of TreeFile in folderpath'
+        start, end = self._span(folderpath)
+        return [self.file(i) for i in range(start, end)]
+
+    def iterfiles(self):
+        'Yield (folderpath, TreeFile) for every file'
+        for f, folderpath in enumerate(self.folders):
+            for i in range(self._folderstart[f], self._folderstart[f+1]):
+                yield folderpath, self.file(i)
+
+    def _span(self, folderpath):
+        'Return (start, end) file indexes of folderpath'
+        f = self._folderindex[folderpath]
+        return self._folderstart[f], self._folderstart[f+1]
+
+    def _name(self, i):
+        o = self._nameoffsets
+        return bytes(self._names[o[i]:o[i+1]])
+
+    # lookups
+
+    def build_indexes(self, paths=True, md5s=True):
+        '''Build hash indexes for .lookup() by full path and .by_md5().
+
+        The path index keys on hash(path) rather than the path itself, so it costs
+        an int per file and not a string. Collisions are checked for on lookup.'''
+        if paths:
+            self._pathindex = {}
+            for f, folderpath in enumerate(self.folders):
+                for i in range(self._folderstart[f], self._folderstart[f+1]):
+                    h = hash(posixpath.join(folderpath, self._name(i).decode('utf-8')))
+                    # -1 marks a collision, and we fall back to scanning the folder
+                    self._pathindex[h] = -1 if h in self._pathindex else i
+        if md5s:
+            self._md5index = {}
+            for i in range(len(self)):
+                digest = bytes(self._md5s[16*i:16*i+16])
+                if digest == NO_MD5:
+                    continue
+                # most hashes are unique, so save a list unless we need one
+                hit = self._md5index.get(digest)
+                if hit is None:
+                    self._md5index[digest] = i
+                elif isinstance(hit, list):
+                    hit.append(i)
+                else:
+                    self._md5index[digest] = [hit, i]
+
+    def lookup(self, path):
+        'Get the TreeFile at path, or None'
+        folderpath, name = posixpath.split(path)
+        if folderpath not in self._folderindex:
+            return None
+        start, end = self._span(folderpath)
+        if self._pathindex is not None:
+            i = self._pathindex.get(hash(path))
+            if i is None:
+                return None
+            if i >= 0 and start <= i < end and self._name(i) == name.encode('utf-8'):
+                return self.file(i)
+        name = name.encode('utf-8')
+        for i in range(start, end):
+            if self._name(i) == name:
+                return self.file(i)
+        return None
+
+    def by_md5(self, md5):
+        'Get a list of (folderpath, TreeFile) with the md5 hash `md5` (hex string)'
+        digest = binascii.unhexlify(md5)
+        if self._md5index is not None:
+            hits = self._md5index.get(digest, [])
+            if not isinstance(hits, list):
+                hits = [hits]
+        else:
+            hits = [i for i in range(len(self)) if self._md5s[16*i:16*i+16] == digest]
+        return [(self._folderof(i), self.file(i)) for i in hits]
+
+    def _folderof(self, i):
+        'Get the folder path of file number i'
+        # binary search in the folder start offsets
+        lo, hi = 0, len(self.folders)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._folderstart[mid+1] <= i:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.folders[lo]
+
+    # aggregates
+
+    def total_size(self):
+        'Total size of all files, in bytes'
+        return int(sum(self.sizes))
+
+    def folder_sizes(self, recursive=False):
+        '''Get a dict of folderpath -> total size in bytes of the files in it.
+
+        With `recursive`, the sizes of subfolders in the tree are included'''
+        sizes = dict((folderpath, int(sum(self.sizes[self._folderstart[f]:self._folderstart[f+1]])))
+                     for f, folderpath in enumerate(self.folders))
+        if recursive:
+            for folderpath, size in list(sizes.items()):
+                child, parent = folderpath, posixpath.dirname(folderpath)
+                while parent in sizes and parent != child:
+                    sizes[parent] += size
+                    child, parent = parent, posixpath.dirname(parent)
+        return sizes
+
+    def state_counts(self):
+        'Get a dict of file state -> number of files, e.g. {"COMPLETED": 1200, "INCOMPLETE": 2}'
+        return dict((self.statenames[code], count) for code, count in Counter(self.states).items())
+
+    def tree(self):
+        'Get a FileDirTreeView, a read only mapping of folderpath -> [TreeFile, ...], like JFSFileDirList.tree always was'
+        return FileDirTreeView(self)
+
+
+class FileDirTreeView(Mapping):
+    'A read only mapping of folderpath -> [TreeFile, ...], made on the fly from a FileDirTree'
+    def __init__(self, filedirtree):
+        self._tree = filedirtree
+
+    def __getitem__(self, folderpath):
+        return self._tree.files(folderpath)
+
+    def __iter__(self):
+        return iter(self._tree.folders)
+
+    def __len__(self):
+        return len(self._tree.folders)
+
+    def __contains__(self, folderpath):
+        return folderpath in self._tree._folderindex
@@ -0,0 +1,184 @@
+# -*- encoding: utf-8 -*-
+'''A cache of JottaCloud xml responses on disk, that we check with the server before we use. See HTTPCache'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import os, os.path, time, json, zlib, shutil, hashlib, tempfile, threading, logging
+import six
+from six.moves.urllib.parse import urlsplit, quote
+
+log = logging.getLogger(__name__)
+
+HTTPCACHE_TTL=300 # seconds a response without validators is used without asking the server
+HTTPCACHE_DIR = os.path.join(os.path.expanduser('~'), '.jottalib') # where the default caches live, see JFS.__init__()
+
+
+class HTTPCache(object):
+    '''Keep the xml JottaCloud sends us in `directory`, to spare us fetching it again.
+
+    If the server sent validators (ETag or Last-Modified) with a response, we keep asking it
+    whether it has changed (If-None-Match/If-Modified-Since), and only fetch what has. If not,
+    we use what we have until it's `ttl` seconds old, counting from the `time` attribute of the
+    document (or from when we got it, if that's earlier).
+
+    Entries live in a tree of folders that mirrors the paths on JottaCloud, so that .invalidate()
+    can drop a folder, everything below it and the folders above it without looking at anything
+    else. Each entry is a file of its own, with a line of json (url, validators and times) and
+    the zlib compressed xml. Entries are written to a temporary file and renamed into place, so
+    several processes may share a directory: readers see either the old entry or the new one.'''
+
+    def __init__(self, directory, ttl=HTTPCACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock() # for the counters
+        self.hits = self.revalidated = self.misses = self.stores = 0
+
+    def _folder(self, url):
+        '''Get the folder that keeps entries for url. Urls are taken as they are sent, escaped, so
+        that names which only look escaped, like a folder called %41, get folders of their own'''
+        parts = [urlsplit(url).netloc.replace('up.jottacloud.com', 'www.jottacloud.com')]
+        for segment in urlsplit(url).path.strip('/').split('/'):
+            if isinstance(segment, six.text_type):
+                segment = segment.encode('utf-8')
+            segment = quote(segment, safe='') # a file name, whatever is in it
+            if len(segment) > 200 or segment in ('.', '..'): # stay within file system limits
+                segment = hashlib.sha1(segment.encode('ascii')).hexdigest()
+            parts.append(segment)
+        return os.path.join(self.directory, *parts)
+
+    def _file(self, url, params=None):
+        'Get the file that keeps the entry for url and params'
+        key = json.dumps(sorted((k, str(v)) for k, v in (params or {}).items()))
+        return os.path.join(self._folder(url), '%s.entry' % hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+    def get(self, url, params=None):
+        'Get the entry for url and params, as a dict with "content", validators and times, or None'
+        try:
+            with open(self._file(url, params), 'rb') as f:
+                entry = json.loads(f.readline().decode('utf-8'))
+                entry['content'] = zlib.decompress(f.read())
+        except (IOError, OSError, ValueError, zlib.error):
+            # not there, or half of something we can't make sense of
+            with self._lock:
+                self.misses += 1
+            return None
+        return entry
+
+    def fresh(self, entry):
+        'Can we use entry without asking the server?'
+        if entry.get('etag') or entry.get('last_modified'):
+            return False
+        return time.time() < min(entry['born'] or entry['stored'], entry['stored']) + self.ttl
+
+    def hit(self, entry):
+        'Count a use of entry without asking the server, and return its content'
+        with self._lock:
+            self.hits += 1
+        return entry['content']
+
+    def conditions(self, entry):
+        'Get the http headers that ask the server whether entry has changed'
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def notmodified(self, url, params, entry):
+        'The server says entry is still good. Returns its content'
+        with self._lock:
+            self.revalidated += 1
+        return entry['content']
+
+    def put(self, url, params, content, headers, born=None):
+        '''Keep content (bytes) for url and params, with the validators from the response `headers`.
+        `born` is when the server made content, in seconds since epoch, if we know'''
+        entry = {'url': url,
+                 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified'),
+                 'born': born,
+                 'stored': time.time(),
+                }
+        path = self._file(url, params)
+        folder = os.path.dirname(path)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        except OSError: # somebody else made it, or we can't
+            pass
+        try:
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(entry).encode('utf-8') + b'\n')
+                f.write(zlib.compress(content))
+            try:
+                os.rename(tmp, path)
+            except OSError: # windows won't rename over an existing file
+                os.remove(path)
+                os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            log.debug('could not cache %r: %r', url, e)
+            return
+        with self._lock:
+            self.stores += 1
+
+    def invalidate(self, url, subtree=True, parents=True):
+        '''Forget everything cached for url.
+
+        With `subtree`, everything below it goes too, and with `parents`, the folders above it'''
+        folder = self._folder(url)
+        if subtree:
+            shutil.rmtree(folder, ignore_errors=True)
+        else:
+            self._forget(folder)
+        if parents:
+            parent = os.path.dirname(folder)
+            while len(parent) > len(self.directory):
+                self._forget(parent)
+                parent = os.path.dirname(parent)
+
+    def _forget(self, folder):
+        'Remove the entries in folder, but not the folders below it'
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.entry'):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError: # somebody else got there first
+                    pass
+
+    def clear(self):
+        'Forget everything'
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        'Return a dict of cache statistics'
+        with self._lock:
+            return {'hits': self.hits,
+                    'revalidated': self.revalidated,
+                    'misses': self.misses,
+                    'stores': self.stores,
+                   }
@@ -0,0 +1,295 @@
+# -*- encoding: utf-8 -*-
+'''A persistent, local index of a remote JottaCloud tree, in SQLite. See RemoteIndex'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import os, os.path, time, calendar, datetime, posixpath, sqlite3, threading, logging
+from collections import namedtuple
+
+import six
+
+# import our stuff
+from jottalib.JFS import JFSNotFoundError, parse_timestamp, UTC
+
+log = logging.getLogger(__name__)
+
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.jottalib') # where the default index files live
+
+IndexedFile = namedtuple('IndexedFile', 'path size md5 uuid state created modified updated')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, -- e.g. /Jotta/Sync/folder/file.txt
+    folder TEXT NOT NULL,
+    size INTEGER, -- NULL for incomplete files
+    md5 TEXT,
+    uuid TEXT,
+    state TEXT,
+    created INTEGER, -- seconds since epoch, utc
+    modified INTEGER,
+    updated INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+CREATE INDEX IF NOT EXISTS files_modified ON files (modified);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    path TEXT PRIMARY KEY, -- the root of a subtree that was fetched in one go
+    refreshed REAL NOT NULL -- time.time() when we fetched it
+);
+'''
+
+def _epoch(timestamp):
+    'Turn a JottaCloud timestamp (string), a datetime or a number into seconds since epoch (int), or None'
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, six.string_types):
+        timestamp = parse_timestamp(timestamp)
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=UTC) # naive datetimes are taken to be utc, like jottacloud's
+        return calendar.timegm(timestamp.utctimetuple())
+    return int(timestamp)
+
+def _datetime(epoch):
+    if epoch is None:
+        return None
+    return datetime.datetime.fromtimestamp(epoch, UTC)
+
+def _subtree(path):
+    'Get the (low, high) bounds of paths strictly below `path`, for a range query'
+    # '0' is the character after '/', so everything starting with path + '/' sorts in between
+    path = path.rstrip('/')
+    return path + '/', path + '0'
+
+
+class RemoteIndex(object):
+    '''A snapshot of (parts of) the remote tree, kept in a SQLite database on disk.
+
+    Fill it with .refresh(path), which fetches the <filedirlist> of `path` (one request,
+    however deep the tree is) and replaces everything the index knew below it. Refresh the
+    subtrees you care about, as often as you like; the rest of the index is left alone.
+
+    Then query it without touching the network:
+
+        index = RemoteIndex(jfs)
+        index.refresh('/Jotta/Archive/Photos')
+        index.lookup('/Jotta/Archive/Photos/2015/beach.jpg')
+        index.files('/Jotta/Archive', md5='125073533339a616b99bc53efc509561')
+        index.files('/Jotta/Archive', minsize=1024**3, since=datetime.datetime(2016, 1, 1))
+
+    Paths are like the ones you give JFS.getObject(), i.e. /<device>/<mountpoint>/..., and
+    timestamps in query results are timezone aware datetimes, in utc.
+
+    The database is safe to share between processes (it runs in WAL mode, so readers
+    see the old snapshot until a refresh is done) and between threads of one process.'''
+
+    def __init__(self, jfs, dbpath=None):
+        self.jfs = jfs
+        if dbpath is None:
+            if not os.path.isdir(INDEX_DIR):
+                os.makedirs(INDEX_DIR)
+            dbpath = os.path.join(INDEX_DIR, 'index-%s.sqlite' % jfs.username)
+        self.dbpath = dbpath
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(dbpath, timeout=60, check_same_thread=False)
+        if dbpath != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self.refreshes = 0 # number of listings fetched from the server
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _path(self, path):
+        'Normalize a remote path or url to /<device>/<mountpoint>/...'
+        if path.startswith(self.jfs.rootpath):
+            path = path[len(self.jfs.rootpath):]
+        userprefix = '/%s/' % self.jfs.username
+        if path.startswith(userprefix): # <filedirlist> paths are prefixed with the username
+            path = path[len(userprefix)-1:]
+        if not path.startswith('/'):
+            path = '/' + path
+        return path.rstrip('/') or '/'
+
+    def _decodefolder(self, folder):
+        'Decode a <folder> element from a <filedirlist> to (folderpath, [row, ...]). See JFS.iterfiledirlist()'
+        folderpath = self._path(posixpath.join(six.text_type(folder.findtext('path')),
+                                               six.text_type(folder.get('name'))))
+        rows = []
+        files = folder.find('files')
+        if files is not None:
+            for f in files.iterchildren(tag='file'):
+                revision = f.find('currentRevision')
+                if revision is None: # incomplete or corrupt, see JFS._treefile()
+                    revision = f.find('latestRevision')
+                r = dict((el.tag, el.text) for el in revision.iterchildren())
+                rows.append((posixpath.join(folderpath, six.text_type(f.get('name'))),
+                             folderpath,
+                             int(r['size']) if r.get('size') is not None else None,
+                             r.get('md5'),
+                             f.get('uuid'),
+                             r.get('state'),
+                             _epoch(r.get('created')),
+                             _epoch(r.get('modified')),
+                             _epoch(r.get('updated')),
+                             ))
+        return folderpath, rows
+
+    def refresh(self, path):
+        '''Fetch the remote tree below path and replace what we have indexed there.
+
+        The subtree is replaced in one transaction, so a failed refresh leaves the old
+        snapshot in place. If path is gone from JottaCloud, it is dropped from the index.
+
+        Returns the number of files indexed.'''
+        path = self._path(path)
+        low, high = _subtree(path)
+        count = 0
+        started = time.time()
+        with self._lock:
+            try:
+                with self._db: # one transaction
+                    self._db.execute('DELETE FROM files WHERE folder = ? OR (folder >= ? AND folder < ?)', (path, low, high))
+                    self._db.execute('DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+                    self._db.execute('DELETE FROM refreshes WHERE path >= ? AND path < ?', (low, high))
+                    self.refreshes += 1
+                    try:
+                        for folderpath, rows in self.jfs.iterfiledirlist(path, decode=self._decodefolder):
+                            self._db.execute('INSERT OR REPLACE INTO folders (path) VALUES (?)', (folderpath, ))
+                            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                            count += len(rows)
+                    except JFSNotFoundError:
+                        log.debug('%r is gone from jottacloud, dropping it from the index', path)
+                        self._db.execute('DELETE FROM refreshes WHERE path = ?', (path, ))
+                        return 0
+                    self._db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (path, started))
+            except sqlite3.Error:
+                log.exception('could not refresh %r in %r', path, self.dbpath)
+                raise
+        log.debug('indexed %s files below %r in %.2fs', count, path, time.time() - started)
+        return count
+
+    def refreshed(self, path):
+        '''Get the time (a utc datetime) that the snapshot of path was taken, or None if
+        path is not indexed'''
+        path = self._path(path)
+        with self._lock:
+            # the closest refreshed subtree that path is part of
+            rows = self._db.execute('SELECT path, refreshed FROM refreshes WHERE path <= ? ORDER BY path DESC',
+                                    (path, )).fetchall()
+        for root, refreshed in rows:
+            if root == path or path.startswith(root + '/') or root == '/':
+                return datetime.datetime.fromtimestamp(refreshed, UTC)
+        return None
+
+    def stale(self, maxage):
+        'Get a list of the indexed subtrees that were refreshed more than `maxage` seconds ago'
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT path FROM refreshes WHERE refreshed < ? ORDER BY path',
+                                                       (time.time() - maxage, ))]
+
+    def refresh_stale(self, maxage):
+        'Refresh every subtree that is older than `maxage` seconds. Returns the number of files indexed'
+        count, done = 0, []
+        for path in self.stale(maxage): # sorted, so a subtree comes after the one it's part of
+            if any(path.startswith(root.rstrip('/') + '/') for root in done):
+                continue # we just got it
+            count += self.refresh(path)
+            done.append(path)
+        return count
+
+    # queries
+
+    def lookup(self, path):
+        'Get the IndexedFile at path, or None'
+        with self._lock:
+            row = self._db.execute('SELECT path, size, md5, uuid, state, created, modified, updated FROM files WHERE path = ?',
+                                   (self._path(path), )).fetchone()
+        return self._row(row) if row is not None else None
+
+    def files(self, prefix='/', md5=None, minsize=None, maxsize=None, since=None, until=None, state=None):
+        '''Get a list of IndexedFile below prefix, ordered by path, and optionally filtered by
+
+            md5 - the md5 hash (hex string)
+            minsize, maxsize - the size in bytes, inclusive
+            since, until - the modification time (datetime or seconds since epoch), inclusive
+            state - the file state, e.g. JFSFile.STATE_COMPLETED'''
+        where, args = [], []
+        prefix = self._path(prefix)
+        if prefix != '/':
+            where.append('path >= ? AND path < ?')
+            args.extend(_subtree(prefix))
+        for clause, value in (('md5 = ?', md5),
+                              ('size >= ?', minsize),
+                              ('size <= ?', maxsize),
+                              ('modified >= ?', _epoch(since)),
+                              ('modified <= ?', _epoch(until)),
+                              ('state = ?', state)):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        sql = 'SELECT path, size, md5, uuid, state, created, modified, updated FROM files'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            rows = self._db.execute(sql + ' ORDER BY path', args).fetchall()
+        return [self._row(row) for row in rows]
+
+    def folders(self, prefix='/'):
+        'Get a sorted list of the folder paths below prefix (and prefix itself, if it is indexed)'
+        prefix = self._path(prefix)
+        low, high = _subtree(prefix)
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT path FROM folders WHERE path = ? OR (path >= ? AND path < ?) ORDER BY path',
+                                                       (prefix, low, high))]
+
+    def total_size(self, prefix='/'):
+        'Get the total size in bytes of the files below prefix'
+        prefix = self._path(prefix)
+        low, high = _subtree(prefix)
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE path >= ? AND path < ?',
+                                    (low, high)).fetchone()[0]
+
+    def stats(self):
+        'Return a dict of index statistics'
+        with self._lock:
+            return {'files': self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+                    'folders': self._db.execute('SELECT COUNT(*) FROM folders').fetchone()[0],
+                    'subtrees': self._db.execute('SELECT COUNT(*) FROM refreshes').fetchone()[0],
+                    'refreshes': self.refreshes,
+                   }
+
+    @staticmethod
+    def _row(row):
+        path, size, md5, uuid, state, created, modified, updated = row
+        return IndexedFile(path, size, md5, uuid, state, _datetime(created), _datetime(modified), _datetime(updated))
@@ -195,41 +195,82 @@ def _encode_filename_to_filesystem(f):
     except UnicodeEncodeError:
         raise
 
-def new(localfile, jottapath, JFS):
+def new(localfile, jottapath, JFS, md5=None, checkpoints=None, upload_callback=None):
     """Upload a new file from local disk (doesn't exist on JottaCloud).
 
+    Pass the `md5` hash of localfile if you know it. If not, the file is hashed where it is,
+    before it's sent. Only a file we can't seek in, like a named pipe, is spooled (see JFS.up()).
+
+    With `checkpoints`, a jottalib.checkpoint.CheckpointStore, the upload is checkpointed
+    while it's in flight, so that it can be resumed without hashing the file again (see resume()).
+    And if an earlier upload of the file to jottapath was interrupted, it is resumed.
+
     Returns JottaFile object"""
-    with open(localfile) as lf:
-        _new = JFS.up(jottapath, lf)
+    if checkpoints is not None and md5 is None:
+        md5 = checkpoints.lookup(localfile)
+        if md5 is not None: # we have been here before
+            try:
+                jf = JFS.getObject(jottapath)
+            except JFSNotFoundError:
+                jf = None
+            if type(jf) == JFSIncompleteFile and jf.md5 == md5:
+                log.debug("Upload of %s was interrupted, continue", localfile)
+                return resume(localfile, jf, JFS, md5=md5, checkpoints=checkpoints, upload_callback=upload_callback)
+    with open(localfile, 'rb') as lf:
+        if checkpoints is not None:
+            if md5 is None:
+                md5 = calculate_md5(lf) # we need it for the checkpoint, before we start
+            checkpoints.record(localfile, jottapath, md5)
+        _new = JFS.up(jottapath, lf, md5=md5, upload_callback=upload_callback)
+    if checkpoints is not None:
+        checkpoints.done(localfile)
     return _new
 
-def resume(localfile, jottafile, JFS):
-    """Continue uploading a new file from local file (already exists on JottaCloud"""
-    with open(localfile) as lf:
-        _complete = jottafile.resume(lf)
+def resume(localfile, jottafile, JFS, md5=None, checkpoints=None, upload_callback=None):
+    """Continue uploading a new file from local file (already exists on JottaCloud.
+
+    Pass the `md5` hash of localfile if you know it, to avoid reading it through once more.
+    Or pass `checkpoints`, a jottalib.checkpoint.CheckpointStore, that may know it from when
+    the upload started. Then only the bytes JottaCloud is missing are read"""
+    if md5 is None and checkpoints is not None:
+        md5 = checkpoints.lookup(localfile)
+    with open(localfile, 'rb') as lf:
+        if md5 is None:
+            md5 = calculate_md5(lf)
+        if checkpoints is not None:
+            checkpoints.record(localfile, jottafile.path, md5)
+        _complete = jottafile.resume(lf, md5=md5, upload_callback=upload_callback)
+    if checkpoints is not None:
+        checkpoints.done(localfile)
     return _complete
 
-def replace_if_changed(localfile, jottapath, JFS):
+def replace_if_changed(localfile, jottapath, JFS, jf=None, checkpoints=None):
     """Compare md5 hash to determine if contents have changed.
     Upload a file from local disk and replace file on JottaCloud if the md5s differ,
     or continue uploading if the file is incompletely uploaded.
 
+    Pass the JottaFile object as `jf` if you have it already, e.g. from JFS.getObjects(),
+    and a jottalib.checkpoint.CheckpointStore as `checkpoints` to checkpoint uploads (see new()).
+
     Returns the JottaFile object"""
-    jf = JFS.getObject(jottapath)
+    if jf is None:
+        jf = JFS.getObject(jottapath)
     lf_hash = getxattrhash(localfile) # try to read previous hash, stored in xattr
+    if lf_hash is None and checkpoints is not None:
+        lf_hash = checkpoints.lookup(localfile) # or from an upload that was interrupted
     if lf_hash is None:               # no valid hash found in xattr,
-        with open(localfile) as lf:
+        with open(localfile, 'rb') as lf:
             lf_hash = calculate_md5(lf) # (re)calculate it
     if type(jf) == JFSIncompleteFile:
         log.debug("Local file %s is incompletely uploaded, continue", localfile)
-        return resume(localfile, jf, JFS)
+        return resume(localfile, jf, JFS, md5=lf_hash, checkpoints=checkpoints)
     elif jf.md5 == lf_hash: # hashes are the same
         log.debug("hash match (%s), file contents haven't changed", lf_hash)
         setxattrhash(localfile, lf_hash)
         return jf         # return the version from jottaclouds
     else:
         setxattrhash(localfile, lf_hash)
-        return new(localfile, jottapath, JFS)
+        return new(localfile, jottapath, JFS, md5=lf_hash, checkpoints=checkpoints)
 
 def deleteDir(jottapath, JFS):
     """Remove folder from JottaCloud because it is no longer present on local disk.
@@ -250,13 +291,18 @@ def mkdir(jottapath, JFS):
     return instanceof(jf, JFSFolder)
 
 def iter_tree(jottapath, JFS):
-    """Get a tree of of files and folders. use as an iterator, you get something like os.walk"""
-    filedirlist = JFS.getObject('%s?mode=list' % jottapath)
-    log.debug("got tree: %s", filedirlist)
-    if not isinstance(filedirlist, JFSFileDirList):
-        yield ( '', tuple(), tuple() )
-    for path in filedirlist.tree:
-        yield path
+    """Get a tree of of files and folders. use as an iterator, you get something like os.walk:
+    the path of each folder in the tree. To get the files too, see iter_tree_files()"""
+    for folderpath, files in iter_tree_files(jottapath, JFS):
+        yield folderpath
+
+def iter_tree_files(jottapath, JFS):
+    """Like iter_tree(), but you get a tuple of (folderpath, [TreeFile, ...]) for each folder.
+
+    The tree is parsed while it streams in from JottaCloud, see JFS.iterfiledirlist()"""
+    for folderpath, files in JFS.iterfiledirlist(jottapath):
+        log.debug("got folder from tree: %r (%s files)", folderpath, len(files))
+        yield folderpath, files
 
 def setxattrhash(filename, md5hash):
     log.debug('set xattr hash for %s', filename)
@@ -38,7 +38,6 @@ log = logging.getLogger(__name__)
 
 # import jotta
 from jottalib import JFS, __version__
-from jottalib.contrib.mwt import Memoize
 
 # import dependenceis (get them with pip!)
 try:
@@ -72,7 +71,7 @@ class JottaFuse(LoggingMixIn, Operations):
 
 
     def __init__(self, auth, path='.'):
-        self.client = JFS.JFS(auth)
+        self.client = JFS.JFS(auth, cache=True) # see ._dirty()
         self.__newfiles = {} # a dict of stringio objects
         self.__newfolders = []
         self.ino = 0
@@ -103,8 +102,8 @@ class JottaFuse(LoggingMixIn, Operations):
         return self.client.getObject(path)
 
     def _dirty(self, path):
-        'Remove path from cache'
-        return Memoize().yank_path(path)
+        'Forget what the JFS knows about path, its parents and anything below it, as when it posts there'
+        self.client._invalidate(self.client.rootpath + path)
 
     #
     # some methods are expected to always work on a rw filesystem, so let's make them work
@@ -133,7 +132,6 @@ class JottaFuse(LoggingMixIn, Operations):
         self.ino += 1
         return self.ino
 
-    @Memoize(timeout=60) # remember every result for 60 seconds
     def getattr(self, path, fh=None):
         if is_blacklisted(path):
             raise OSError(errno.ENOENT)
@@ -270,7 +268,6 @@ class JottaFuse(LoggingMixIn, Operations):
         self._dirty(new)
         return ESUCCESS
 
-    @Memoize(timeout=60)
     def statfs(self, path):
         "Return a statvfs(3) structure, for stat and df and friends"
         # from fuse.py source code:
@@ -335,8 +332,9 @@ class JottaFuse(LoggingMixIn, Operations):
             raise OSError(errno.ENOENT, '')
         if isinstance(f, (JFS.JFSFile, JFS.JFSFolder)) and f.is_deleted():
             raise OSError(errno.ENOENT)
-        data = StringIO(f.read())
-        data.truncate(length)
+        buf = bytearray(min(length, f.size)) # only fetch what we keep
+        del buf[f.readinto(buf):]
+        data = StringIO(bytes(buf))
         try:
             self.client.up(path, data) # replace file contents
             self._dirty(path)
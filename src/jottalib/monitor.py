@@ -69,10 +69,11 @@ class ArchiveEventHandler(FileSystemEventHandler):
     '''
     mode = 'Archive'
 
-    def __init__(self, jfs, topdir, jottaroot=None):
+    def __init__(self, jfs, topdir, jottaroot=None, checkpoints=None):
         super(ArchiveEventHandler, self).__init__()
         self.jfs = jfs
         self.topdir = topdir
+        self.checkpoints = checkpoints # a jottalib.checkpoint.CheckpointStore, or None
         self.jottaroot = jottaroot and jottaroot or ('/Jotta/%s' % self.mode)
 
     def get_jottapath(self, p, filename=None):
@@ -148,7 +149,7 @@ class ArchiveEventHandler(FileSystemEventHandler):
 
             log.info('Uploading file %s to %s', sourcefile, jottapath)
             if not dry_run:
-                if not jottacloud.new(sourcefile, jottapath, self.jfs):
+                if not jottacloud.new(sourcefile, jottapath, self.jfs, checkpoints=self.checkpoints):
                     log.error('Uploading file %s failed', sourcefile)
                     raise
             if remove_uploaded:
@@ -185,7 +186,7 @@ def humanizeFileSize(size):
     return "%.3f%s" % (size/math.pow(1024,p),units[int(p)])
 
 
-def filemonitor(topdir, mode, jfs):
+def filemonitor(topdir, mode, jfs, checkpoints=None):
     errors = {}
     def saferun(cmd, *args):
         log.debug('running %s with args %s', cmd, args)
@@ -198,7 +199,7 @@ def filemonitor(topdir, mode, jfs):
             return False
 
     if mode == 'archive':
-        event_handler = ArchiveEventHandler(jfs, topdir)
+        event_handler = ArchiveEventHandler(jfs, topdir, checkpoints=checkpoints)
     elif mode == 'sync':
         event_handler = SyncEventHandler(jfs, topdir)
         #event_handler = LoggingEventHandler()
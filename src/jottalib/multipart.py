@@ -0,0 +1,161 @@
+# -*- encoding: utf-8 -*-
+'''Multipart upload bodies that send files in large chunks, straight out of memory maps. See MultipartBody'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import mmap, uuid, logging
+import six
+
+from requests.packages.urllib3.fields import RequestField
+
+log = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE=1024*1024 # bytes we hand to the socket at a time, see MultipartBody
+
+
+class MultipartBody(object):
+    '''A multipart/form-data request body, for an upload, that is sent by iterating over it,
+    or by .read()ing it, for http libraries that only send files, like httplib on python 2.
+
+    `fields` are like those of requests_toolbelt.MultipartEncoder, a dict of
+    name -> (filename, data) or (filename, data, content type), and the parts look the same
+    on the wire. Data may be text, bytes or a file, which is sent from where it's at (its
+    .tell()) to the end.
+
+    The small stuff (part headers, short fields and the closing boundary) is put together up
+    front, and files are handed out in `chunk_size` pieces, as memoryviews of the file mapped
+    into memory, or of a BytesIO, so that the bytes go from the page cache to the socket without
+    being copied in python. Files we can't map are .readinto() a buffer that is reused for every
+    chunk, which is safe because http.client sends each chunk before it asks for the next.
+    .read() copies what it returns, so it doesn't care.
+
+    Like MultipartEncoderMonitor, .bytes_read counts what has been sent so far, and `callback`,
+    if given, is called with the body after every chunk. Length is in .len and len()'''
+
+    def __init__(self, fields, boundary=None, chunk_size=UPLOAD_CHUNK_SIZE, callback=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.bytes_read = 0
+        self.segments = [] # bytes, or (file, offset, length)
+        self._chunks = None # what .read() is reading from, and
+        self._pending = b'' # what is left of the chunk it's in
+        head = b''
+        for name, field in fields.items():
+            filename, data = field[0], field[1]
+            rf = RequestField(name=name, data=data, filename=filename)
+            rf.make_multipart(content_type=field[2] if len(field) > 2 else None)
+            head += b'--' + self.boundary.encode('ascii') + b'\r\n' + rf.render_headers().encode('utf-8')
+            if hasattr(data, 'read'):
+                offset = data.tell()
+                data.seek(0, 2)
+                length = data.tell() - offset
+                data.seek(offset)
+                self.segments.extend([head, (data, offset, length)])
+                head = b'\r\n'
+            else:
+                if isinstance(data, six.text_type):
+                    data = data.encode('utf-8')
+                head += data + b'\r\n'
+        self.segments.append(head + b'--' + self.boundary.encode('ascii') + b'--\r\n')
+        self.len = sum(len(s) if isinstance(s, bytes) else s[2] for s in self.segments)
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                chunks = [segment]
+            else:
+                chunks = self._filechunks(*segment)
+            for chunk in chunks:
+                self.bytes_read += len(chunk)
+                yield chunk
+                if self.callback is not None:
+                    self.callback(self)
+
+    def read(self, size=-1):
+        'Return the next `size` bytes of the body (or all that is left, if size < 0), b"" at the end'
+        if self._chunks is None:
+            self._chunks = iter(self)
+        out = []
+        got = 0
+        while size < 0 or got < size:
+            if not len(self._pending):
+                self._pending = next(self._chunks, None)
+                if self._pending is None: # the end
+                    self._pending = b''
+                    break
+            take = len(self._pending) if size < 0 else min(size - got, len(self._pending))
+            piece = self._pending[:take]
+            out.append(piece.tobytes() if isinstance(piece, memoryview) else piece)
+            self._pending = self._pending[take:]
+            got += take
+        return b''.join(out)
+
+    def _filechunks(self, fileobject, offset, length):
+        'Yield memoryviews of `length` bytes of fileobject, from offset'
+        if not length:
+            return
+        if hasattr(fileobject, 'getbuffer'): # a BytesIO
+            view = fileobject.getbuffer()
+            try:
+                for start in range(offset, offset + length, self.chunk_size):
+                    yield view[start:min(start + self.chunk_size, offset + length)]
+            finally:
+                del view # or the BytesIO can't be changed or closed
+            return
+        try:
+            mapped = mmap.mmap(fileobject.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, IOError, OSError, ValueError, OverflowError, mmap.error) as e:
+            log.debug('could not map %r (%r), reading it instead', fileobject, e)
+            mapped = None
+        if mapped is not None and len(mapped) >= offset + length:
+            view = memoryview(mapped)
+            try:
+                for start in range(offset, offset + length, self.chunk_size):
+                    yield view[start:min(start + self.chunk_size, offset + length)]
+            finally:
+                view.release()
+                try:
+                    mapped.close()
+                except BufferError: # the last chunk is still out there; the map closes when it's gone
+                    pass
+            return
+        if mapped is not None: # the file shrunk under us, let .readinto() find out how much
+            mapped.close()
+        fileobject.seek(offset)
+        buf = bytearray(min(self.chunk_size, length))
+        view = memoryview(buf)
+        left = length
+        while left > 0:
+            n = fileobject.readinto(view[:min(left, len(buf))]) if hasattr(fileobject, 'readinto') else None
+            if n is None: # no readinto()
+                data = fileobject.read(min(left, len(buf)))
+                n = len(data)
+                buf[:n] = data
+            if not n:
+                raise IOError('%r ended %s bytes early' % (fileobject, left))
+            left -= n
+            yield view[:n]
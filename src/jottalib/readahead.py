@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+'''Read downloads ahead of their consumer, in a background thread. See ReadAhead'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import sys, time, threading, logging
+import six
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+POLL=0.1 # seconds between looks at whether the consumer has gone away, when the queue is full
+
+_END = object() # what the reader puts in the queue when it's done
+
+
+class _Failure(object):
+    'What the reader puts in the queue when it fails: the sys.exc_info() to raise in the consumer'
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class WaitCounter(object):
+    '''How often, and for how long, the two sides of read-aheads waited for each other.
+
+    The consumer waits when the queue is empty: the network is the bottleneck. The reader waits
+    when the queue is full: the consumer is. One WaitCounter may be shared by many ReadAheads,
+    in many threads, like JFS.readahead_counter'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chunks = 0 # that went through the queue
+        self.consumer_waits = self.reader_waits = 0
+        self.consumer_waited = self.reader_waited = 0.0 # seconds
+
+    def waited(self, side, seconds):
+        'Count a wait of `side` ("consumer" or "reader"), that took `seconds`'
+        with self._lock:
+            setattr(self, '%s_waits' % side, getattr(self, '%s_waits' % side) + 1)
+            setattr(self, '%s_waited' % side, getattr(self, '%s_waited' % side) + seconds)
+
+    def chunk(self):
+        with self._lock:
+            self.chunks += 1
+
+    def stats(self):
+        'Return a dict of the counters'
+        with self._lock:
+            return {'chunks': self.chunks,
+                    'consumer_waits': self.consumer_waits,
+                    'consumer_waited': self.consumer_waited,
+                    'reader_waits': self.reader_waits,
+                    'reader_waited': self.reader_waited,
+                   }
+
+
+class ReadAhead(object):
+    '''Iterate over `iterable`, e.g. the chunks of JFS.stream(), in a background thread, and keep
+    up to `depth` chunks ready in a queue for whoever iterates over us.
+
+    The network then keeps receiving while the consumer writes to disk, decompresses or
+    whatever it does with a chunk. When the queue is full, the reader waits for the consumer,
+    so no more than `depth` chunks are held in memory, however slow the consumer is. Errors
+    in the reader are raised in the consumer, after the chunks that came before them.
+
+    Waits are counted in .counter, a WaitCounter (pass one to share it). Stop early with
+    .close(); a `with` block does that for you'''
+
+    def __init__(self, iterable, depth, counter=None):
+        self.depth = depth
+        self.counter = counter if counter is not None else WaitCounter()
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._read, args=(iter(iterable), ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, chunks):
+        'Fill the queue from chunks, until they run out, fail or we are closed'
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+            self._put(_END)
+        except Exception:
+            self._put(_Failure(sys.exc_info()))
+        finally:
+            if hasattr(chunks, 'close'): # a generator, let it clean up in this thread
+                chunks.close()
+
+    def _put(self, item):
+        'Put item in the queue, waiting for room as long as we are open. Returns False if we were closed'
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        waiting = time.time()
+        try:
+            while not self._closed.is_set():
+                try:
+                    self._queue.put(item, timeout=POLL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.counter.waited('reader', time.time() - waiting)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            waiting = time.time()
+            item = self._queue.get()
+            self.counter.waited('consumer', time.time() - waiting)
+        if item is _END:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._done = True
+            six.reraise(*item.exc_info)
+        self.counter.chunk()
+        return item
+
+    next = __next__ # py2
+
+    def close(self):
+        '''Stop reading ahead, and drop what was read. The reader thread ends after the chunk it's
+        getting, if any, without waiting for us; it closes `iterable` if it's a generator'''
+        self._done = True
+        self._closed.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
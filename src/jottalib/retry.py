@@ -0,0 +1,252 @@
+# -*- encoding: utf-8 -*-
+'''Retries with backoff, and a circuit breaker, for requests to JottaCloud. See RetryPolicy'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import time, random, threading, logging
+import email.utils
+from collections import deque
+
+import requests
+
+log = logging.getLogger(__name__)
+
+# defaults
+RETRIES=5 # attempts after the first one
+BACKOFF=0.5 # seconds to wait before the first retry, doubled for each one after that
+MAX_BACKOFF=60 # seconds, at most, between two attempts
+MAX_RETRY_AFTER=300 # seconds, at most, that we honor a Retry-After header for
+RETRY_STATUSES=(429, 500, 502, 503, 504) # http statuses worth another try
+BREAKER_WINDOW=20 # number of recent outcomes the circuit breaker looks at
+BREAKER_THRESHOLD=0.5 # share of failures in the window that opens the circuit
+BREAKER_PAUSE=30 # seconds the circuit stays open
+BREAKER_PROBE_TIMEOUT=1800 # seconds we wait for a probe to report back before another caller probes
+
+
+class CircuitBreaker(object):
+    '''Stop everyone from sending requests for a while, when too many of them fail.
+
+    Keeps the outcome of the last `window` requests. When at least `threshold` of them failed,
+    the circuit opens: everybody who calls .wait() is held back for `pause` seconds. Then one
+    request is let through as a probe. If it goes well, the circuit closes, and traffic resumes.
+    If not, it opens again. A probe that hasn't told us how it went after `probe_timeout` seconds
+    is given up on, and the next caller probes instead.'''
+
+    def __init__(self, window=BREAKER_WINDOW, threshold=BREAKER_THRESHOLD, pause=BREAKER_PAUSE,
+                 probe_timeout=BREAKER_PROBE_TIMEOUT):
+        self.window = window
+        self.threshold = threshold
+        self.pause = pause
+        self.probe_timeout = probe_timeout
+        self._outcomes = deque(maxlen=window)
+        self._cond = threading.Condition()
+        self._openuntil = 0 # time.time() when the circuit may be probed
+        self._probing = False
+        self._probestarted = 0 # time.time() when the probe was let through
+        self.trips = 0 # times the circuit opened
+        self.waited = 0.0 # seconds callers spent in .wait()
+
+    @property
+    def state(self):
+        'One of "closed", "open" or "probing"'
+        with self._cond:
+            if self._probing:
+                return 'probing'
+            return 'open' if self._openuntil else 'closed'
+
+    def wait(self):
+        'Block while the circuit is open, and make one caller the probe when it is time to try again'
+        started = None
+        with self._cond:
+            while self._openuntil:
+                if started is None:
+                    started = time.time()
+                now = time.time()
+                if self._probing and now - self._probestarted >= self.probe_timeout:
+                    log.warning('no word from the probe in %ss, probing again', self.probe_timeout)
+                    self._probing = False
+                if now >= self._openuntil and not self._probing:
+                    self._probing = True # our turn
+                    self._probestarted = now
+                    break
+                if self._probing:
+                    self._cond.wait(max(self._probestarted + self.probe_timeout - now, 0.05))
+                else:
+                    self._cond.wait(max(self._openuntil - now, 0.05))
+            if started is not None:
+                self.waited += time.time() - started
+
+    def record(self, ok):
+        'Record the outcome of a request'
+        with self._cond:
+            if self._probing:
+                self._probing = False
+                if ok:
+                    log.info('circuit closed, resuming requests')
+                    self._openuntil = 0
+                    self._outcomes.clear()
+                else:
+                    self._openuntil = time.time() + self.pause
+                self._cond.notify_all()
+                return
+            self._outcomes.append(ok)
+            if (not self._openuntil and len(self._outcomes) == self.window and
+                    self._outcomes.count(False) >= self.threshold * self.window):
+                log.warning('%s of the last %s requests failed, pausing all requests for %ss',
+                            self._outcomes.count(False), self.window, self.pause)
+                self._openuntil = time.time() + self.pause
+                self.trips += 1
+                self._cond.notify_all()
+
+
+class RetryPolicy(object):
+    '''Decides whether, and when, to try a request again. See .call()
+
+    A request is retried up to `retries` times, when it fails with one of `statuses` (by default:
+    429, and 5xx statuses that are likely to be temporary), or with a connection error or timeout.
+
+    Requests that aren't idempotent (e.g. a move) are only retried if the server can't have
+    acted on them: if we never got through to it, or it told us to come back later (429 and 503).
+
+    Between attempts we wait, with exponential backoff from `backoff` seconds up to `max_backoff`,
+    and "full jitter" (a random wait up to the backoff), so that many workers don't retry in
+    lockstep. A Retry-After header from the server overrides this (up to `max_retry_after`).
+
+    All requests go through a shared CircuitBreaker, `breaker`, that pauses all workers when the
+    error rate spikes. Pass breaker=False to go without.
+
+    Counters (see .stats()): attempts, retries, giveups, and time spent waiting in backoff and
+    in the circuit breaker.
+
+    Set retries=0 to turn retrying off altogether.'''
+
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF, max_retry_after=MAX_RETRY_AFTER,
+                 statuses=RETRY_STATUSES, breaker=None, sleep=time.sleep):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.statuses = frozenset(statuses)
+        self.breaker = CircuitBreaker() if breaker is None else breaker or None
+        self.sleep = sleep
+        self.random = random.Random()
+        self._lock = threading.Lock()
+        self.attempts = self.retries_made = self.giveups = 0
+        self.backoff_time = 0.0
+
+    def delay(self, attempt, response=None):
+        'Get the number of seconds to wait before retry number `attempt` (counting from 0)'
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return retry_after
+        return self.random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retry_after(self, response):
+        'Get the seconds to wait from the Retry-After header of response, or None'
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError: # a http date
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return None
+            seconds = email.utils.mktime_tz(date) - time.time()
+        return min(max(seconds, 0), self.max_retry_after)
+
+    def retryable(self, response=None, error=None, idempotent=True):
+        'Is this outcome worth another try?'
+        if error is not None:
+            if isinstance(error, requests.exceptions.ConnectTimeout):
+                return True # never got through
+            if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                                  requests.exceptions.ChunkedEncodingError)):
+                return idempotent
+            return False
+        if response.status_code in (429, 503):
+            return response.status_code in self.statuses # come back later, the server says
+        return idempotent and response.status_code in self.statuses
+
+    def call(self, send, idempotent=True, description='request'):
+        '''Call send() until it returns a response that we shouldn't retry, and return that.
+
+        send() should make the request from scratch every time (e.g. rewind files it uploads),
+        and return a requests.Response or raise a requests.exceptions.RequestException.
+        When we give up, the last response is returned, or the last exception is raised.'''
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.wait()
+            with self._lock:
+                self.attempts += 1
+            response = error = None
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                error = e
+            finally:
+                if response is None and error is None and self.breaker is not None:
+                    # send() raised something else, even a KeyboardInterrupt. Let the next one
+                    # probe, if we were the probe
+                    self.breaker.record(False)
+            failed = error is not None or response.status_code in self.statuses
+            if self.breaker is not None:
+                self.breaker.record(not failed)
+            if not failed:
+                return response
+            if attempt >= self.retries or not self.retryable(response, error, idempotent):
+                if attempt > 0:
+                    with self._lock:
+                        self.giveups += 1
+                    log.warning('giving up on %s after %s attempts: %r', description, attempt + 1,
+                                error or response)
+                if error is not None:
+                    raise error
+                return response
+            wait = self.delay(attempt, response)
+            log.debug('%s failed (%r), retrying in %.2fs (%s/%s)', description, error or response,
+                      wait, attempt + 1, self.retries)
+            if response is not None:
+                response.close() # give the connection back to the pool
+            self.sleep(wait)
+            with self._lock:
+                self.retries_made += 1
+                self.backoff_time += wait
+            attempt += 1
+
+    def stats(self):
+        'Return a dict of retry statistics'
+        s = {'attempts': self.attempts,
+             'retries': self.retries_made,
+             'giveups': self.giveups,
+             'backoff_time': self.backoff_time,
+             'breaker_trips': 0,
+             'breaker_time': 0.0,
+             'breaker_state': 'closed',
+            }
+        if self.breaker is not None:
+            s.update(breaker_trips=self.breaker.trips, breaker_time=self.breaker.waited,
+                     breaker_state=self.breaker.state)
+        return s
@@ -53,7 +53,8 @@ def humanizeFileSize(size):
     p = math.floor(math.log(size, 2)/10)
     return "%.3f%s" % (size/math.pow(1024,p),units[int(p)])
 
-def filescanner(topdir, jottapath, jfs, errorfile, exclude=None, dry_run=False, prune_files=True, prune_folders=True ):
+def filescanner(topdir, jottapath, jfs, errorfile, exclude=None, dry_run=False, prune_files=True, prune_folders=True,
+                checkpoints=None):
 
     errors = {}
     def saferun(cmd, *args):
@@ -80,7 +81,7 @@ def filescanner(topdir, jottapath, jfs, errorfile, exclude=None, dry_run=False,
                         continue
                     log.debug("uploading new file: %s", f)
                     if not dry_run:
-                        if saferun(jottacloud.new, f.localpath, f.jottapath, jfs) is not False:
+                        if saferun(jottacloud.new, f.localpath, f.jottapath, jfs, None, checkpoints) is not False:
                             _uploadedbytes += os.path.getsize(f.localpath)
                             _files += 1
                 _end = time.time()
@@ -94,10 +95,13 @@ def filescanner(topdir, jottapath, jfs, errorfile, exclude=None, dry_run=False,
                         if saferun(jottacloud.delete, f.jottapath, jfs) is not False:
                             _files += 1
             if len(bothplaces):
+                # look them all up at once, through the folder listing
+                remote = {} if dry_run else saferun(jfs.getObjects, [f.jottapath for f in bothplaces]) or {}
                 for f in progress.bar(bothplaces, label="comparing %s existing files: " % len(bothplaces)):
                     log.debug("checking whether file contents has changed: %s", f)
                     if not dry_run:
-                        if saferun(jottacloud.replace_if_changed, f.localpath, f.jottapath, jfs) is not False:
+                        if saferun(jottacloud.replace_if_changed, f.localpath, f.jottapath, jfs,
+                                   remote.get(f.jottapath), checkpoints) is not False:
                             _files += 1
             if prune_folders and len(onlyremotefolders):
                 puts(colored.red("Deleting %s folders from JottaCloud because they no longer exist locally " % len(onlyremotefolders)))
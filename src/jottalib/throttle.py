@@ -0,0 +1,164 @@
+# -*- encoding: utf-8 -*-
+'''Token buckets, to keep uploads and downloads within a bandwidth budget. See TokenBucket'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import time, threading, logging
+
+log = logging.getLogger(__name__)
+
+BURST=0.25 # seconds worth of bytes a bucket holds, when it's full
+BITE=64*1024 # bytes we take at a time from a limited budget, see ThrottledBody
+
+
+class TokenBucket(object):
+    '''A bandwidth budget of `rate` bytes per second, shared by everyone who .consume()s from it.
+
+    Tokens (bytes) trickle into the bucket at `rate`, up to `burst` bytes (by default, BURST
+    seconds worth). Taking more than is there puts the bucket in debt, and the taker waits
+    until the debt is paid. As every taker queues up behind the debt of those who came before,
+    parallel transfers get turns in the order they ask, and share the rate fairly, as long as
+    they take small bites (which they do: a chunk at a time).
+
+    Set .rate at any time, from any thread; rate=None means no limit.'''
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = self.burst
+        self._last = time.time()
+        self.consumed = 0 # bytes
+        self.waited = 0.0 # seconds takers spent waiting
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+            self._tokens = min(self._tokens, self.burst)
+        log.debug('bandwidth limit is now %s bytes/s', rate)
+
+    @property
+    def burst(self):
+        if self._burst is not None:
+            return self._burst
+        return self._rate * BURST if self._rate else 0
+
+    def _refill(self):
+        'Add the tokens that have trickled in since last time. Call with the lock held'
+        now = time.time()
+        if self._rate:
+            self._tokens = min(self._tokens + (now - self._last) * self._rate, self.burst)
+        self._last = now
+
+    def consume(self, n):
+        'Take n bytes from the budget, and wait until we can afford them. Returns the seconds we waited'
+        with self._lock:
+            self.consumed += n
+            if not self._rate:
+                return 0.0
+            self._refill()
+            self._tokens -= n
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        'Return a dict of bucket statistics'
+        return {'rate': self._rate, 'consumed': self.consumed, 'waited': self.waited}
+
+
+# budgets shared by every JFS in this process. See JFS.limit()
+GLOBAL_UPLOAD = TokenBucket()
+GLOBAL_DOWNLOAD = TokenBucket()
+
+
+class Throttle(object):
+    'Take bytes from all of a number of TokenBuckets, e.g. one for this JFS and one for the whole process'
+    def __init__(self, *buckets):
+        self.buckets = buckets
+
+    def consume(self, n):
+        for bucket in self.buckets:
+            bucket.consume(n)
+
+    @property
+    def limited(self):
+        'Is any of our buckets limited?'
+        return any(bucket.rate for bucket in self.buckets)
+
+    def iterate(self, chunks):
+        'Pass on chunks (of bytes) from an iterable, e.g. requests.Response.iter_content(), within budget'
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
+
+
+class ThrottledReader(object):
+    '''Wrap a readable file-like object (e.g. a requests_toolbelt.MultipartEncoder) so that
+    .read()ing from it stays within the budget of a Throttle. For uploads'''
+    def __init__(self, fileobject, throttle):
+        self.fileobject = fileobject
+        self.throttle = throttle
+        self.len = len(fileobject) if hasattr(fileobject, '__len__') else fileobject.len # for requests
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        data = self.fileobject.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
+class ThrottledBody(object):
+    '''Wrap an iterable request body (e.g. a jottalib.multipart.MultipartBody) so that
+    sending it stays within the budget of a Throttle. For uploads.
+
+    When there is a limit, big chunks are sent in bites of BITE bytes, so the transfer
+    keeps a steady pace'''
+    def __init__(self, body, throttle):
+        self.body = body
+        self.throttle = throttle
+        self.len = len(body) # for requests
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        for chunk in self.body:
+            if not self.throttle.limited:
+                self.throttle.consume(len(chunk))
+                yield chunk
+                continue
+            chunk = memoryview(chunk)
+            for start in range(0, len(chunk), BITE):
+                bite = chunk[start:start+BITE]
+                self.throttle.consume(len(bite))
+                yield bite
@@ -0,0 +1,294 @@
+# -*- encoding: utf-8 -*-
+'''The http plumbing under JFS, behind a small interface, so it can be swapped. See Transport'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# importing stdlib
+import socket, logging
+from collections import OrderedDict
+import six
+from six.moves.urllib.parse import urlencode
+
+import requests
+from requests.auth import HTTPBasicAuth
+from requests.utils import requote_uri
+from requests.packages import urllib3
+from requests.packages.urllib3.util.retry import Retry
+import certifi
+try: # urllib3 1.x (on python 2.7) has it only here
+    from requests.packages.urllib3._collections import HTTPHeaderDict
+except ImportError: # a urllib3 that keeps it only at the top level
+    HTTPHeaderDict = urllib3.HTTPHeaderDict
+
+log = logging.getLogger(__name__)
+
+
+def pool_retries():
+    '''Get the urllib3 Retry for our connection pools: connections that break before the request
+    is sent are retried right away. Anything else (http errors, Retry-After, timeouts) is up to JFS.retry'''
+    return Retry(total=10, read=False, redirect=False, respect_retry_after_header=False)
+
+
+class Transport(object):
+    '''How JFS talks http. Pick one with JFS(transport=...), by name (see TRANSPORTS) or as an instance.
+
+    A transport sends requests to JottaCloud through connection pools that JFS sets up with
+    .mount(), one per host, and returns responses that look like a streamed requests.Response:
+    .status_code, .ok, .reason, .headers, .url, .content, .text, .raw, .iter_content() and .close().
+    Network errors are raised as requests.exceptions, whatever the transport, so that
+    jottalib.retry and JFS.iterrange() can tell what went wrong.
+
+    Request bodies (`data`) are bytes or text, a dict of form fields, or a file-like object with
+    a length (.len or len()) that is .read() as it is sent, like the multipart encoder of an upload.
+    On python 3, uploads are sent as an iterable of chunks with a length instead, a
+    jottalib.throttle.ThrottledBody.'''
+
+    name = None
+
+    def configure(self, username, password, headers):
+        'Send the credentials and `headers` (a dict) with every request'
+        raise NotImplementedError
+
+    def mount(self, name, prefix, pool_size, pool_block=False):
+        'Send all requests for urls starting with `prefix` through a connection pool of their own, called `name`'
+        raise NotImplementedError
+
+    def request(self, method, url, params=None, headers=None, data=None, timeout=None):
+        '''Send a request, and return the response as soon as the headers are in. Read the body
+        with .content or .iter_content(). `timeout` is in seconds, or a (connect, read) tuple'''
+        raise NotImplementedError
+
+    def poolstats(self):
+        'Return connection pool statistics, as a dict per pool name. See JFS.poolstats()'
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class RequestsTransport(Transport):
+    '''Talk http through a requests.Session. This is how jottalib always did it, and the default.
+
+    The session is .session, if you need to get at it'''
+
+    name = 'requests'
+
+    def __init__(self):
+        self.session = requests.Session() # create a session for connection pooling, ssl keepalives and cookie jar
+        self.session.mount('https://',requests.adapters.HTTPAdapter(max_retries=10))
+        self.session.stream = True
+        self.session.verify = certifi.where()
+        self.mounts = OrderedDict() # name -> (url prefix, pool size)
+        self.adapters = {} # name -> requests.adapters.HTTPAdapter
+
+    def configure(self, username, password, headers):
+        self.session.auth = HTTPBasicAuth(username, password)
+        self.session.headers = dict(headers)
+
+    def mount(self, name, prefix, pool_size, pool_block=False):
+        adapter = self.adapter(pool_size, pool_block)
+        self.session.mount(prefix, adapter)
+        self.mounts[name] = (prefix, pool_size)
+        self.adapters[name] = adapter
+
+    def adapter(self, pool_size, pool_block=False):
+        'Make a requests transport adapter, with a connection pool of `pool_size`. See pool_retries()'
+        return requests.adapters.HTTPAdapter(pool_connections=1,
+                                             pool_maxsize=pool_size,
+                                             pool_block=pool_block,
+                                             max_retries=pool_retries())
+
+    def request(self, method, url, params=None, headers=None, data=None, timeout=None):
+        return self.session.request(method, url, params=params, headers=headers, data=data, timeout=timeout)
+
+    def poolstats(self):
+        return dict((name, _poolstats(self.mounts[name][1], _pools(adapter.poolmanager)))
+                    for name, adapter in self.adapters.items())
+
+    def close(self):
+        self.session.close()
+
+
+def _pools(manager):
+    'Get the connection pools of a urllib3.PoolManager, without iterating over them, which newer urllib3 forbids'
+    pools = manager.pools
+    return [pools.get(key) for key in pools.keys()]
+
+
+def _poolstats(maxsize, pools):
+    'Add up the statistics of some urllib3 connection pools'
+    s = {'maxsize': maxsize, 'in_use': 0, 'idle': 0, 'created': 0, 'requests': 0}
+    for pool in pools:
+        if pool is None or pool.pool is None: # gone or closed
+            continue
+        with pool.pool.mutex:
+            s['in_use'] += pool.pool.maxsize - len(pool.pool.queue)
+            s['idle'] += sum(1 for conn in pool.pool.queue if conn is not None)
+        s['created'] += pool.num_connections
+        s['requests'] += pool.num_requests
+    return s
+
+
+class Urllib3Response(object):
+    'A urllib3 response, dressed up as much like a streamed requests.Response as JFS needs. See Transport'
+
+    def __init__(self, raw, url):
+        self.raw = raw # the urllib3.HTTPResponse
+        self.url = url
+        self.status_code = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers # case insensitive, like requests
+        self._content = None
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def iter_content(self, chunk_size=1):
+        if self._content is not None:
+            for i in range(0, len(self._content), chunk_size):
+                yield self._content[i:i+chunk_size]
+            return
+        try:
+            for chunk in self.raw.stream(chunk_size, decode_content=True):
+                yield chunk
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except urllib3.exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        self.raw.release_conn()
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b''.join(self.iter_content(64*1024))
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def close(self):
+        if self._content is None:
+            self.raw.close()
+        self.raw.release_conn()
+
+
+class Urllib3Transport(Transport):
+    '''Talk http through urllib3 connection pools, without requests on top.
+
+    Skips what a requests.Session does for every request that we don't need (merging settings
+    and headers, looking through the environment for proxies and .netrc, cookies, hooks), and
+    the headers we send are put together once, in .configure(). Urls that no pool was
+    .mount()ed for go through a urllib3.PoolManager.
+
+    Redirects are not followed; JottaCloud doesn't send them'''
+
+    name = 'urllib3'
+
+    def __init__(self):
+        self.headers = {}
+        self.mounts = OrderedDict() # name -> (url prefix, pool size)
+        self.pools = OrderedDict() # url prefix -> urllib3 connection pool
+        self.manager = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where(),
+                                           retries=pool_retries())
+
+    def configure(self, username, password, headers):
+        self.headers = urllib3.util.make_headers(basic_auth='%s:%s' % (username, password))
+        self.headers.update(headers)
+
+    def mount(self, name, prefix, pool_size, pool_block=False):
+        self.pools[prefix] = self.connectionpool(prefix, pool_size, pool_block)
+        self.mounts[name] = (prefix, pool_size)
+
+    def connectionpool(self, prefix, pool_size, pool_block=False):
+        'Make a urllib3 connection pool of `pool_size` for the host in prefix. See pool_retries()'
+        return urllib3.connection_from_url(prefix, maxsize=pool_size, block=pool_block, retries=pool_retries(),
+                                           cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+
+    def request(self, method, url, params=None, headers=None, data=None, timeout=None):
+        url = requote_uri(url)
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode([(k, _utf8(v)) for k, v in params.items()])
+        _headers = HTTPHeaderDict(self.headers)
+        if headers:
+            _headers.update(headers)
+        body = data
+        if isinstance(data, dict):
+            body = urlencode([(k, _utf8(v)) for k, v in data.items()])
+            _headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        if body is not None and 'Content-Length' not in _headers:
+            length = body.len if hasattr(body, 'len') else len(body)
+            _headers['Content-Length'] = str(length) # or urllib3 sends file-like bodies chunked
+        if isinstance(timeout, tuple):
+            timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+        else:
+            timeout = urllib3.Timeout(connect=timeout, read=timeout)
+        for prefix, pool in self.pools.items():
+            if url.startswith(prefix):
+                opener, target = pool.urlopen, url[len(prefix)-1:]
+                break
+        else:
+            opener, target = self.manager.urlopen, url
+        try:
+            raw = opener(method, target, body=body, headers=_headers, timeout=timeout, redirect=False,
+                         preload_content=False, decode_content=True)
+        except urllib3.exceptions.MaxRetryError as e:
+            if isinstance(e.reason, urllib3.exceptions.ConnectTimeoutError):
+                raise requests.exceptions.ConnectTimeout(e)
+            if isinstance(e.reason, urllib3.exceptions.SSLError):
+                raise requests.exceptions.SSLError(e)
+            raise requests.exceptions.ConnectionError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except urllib3.exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ClosedPoolError, socket.error) as e:
+            raise requests.exceptions.ConnectionError(e)
+        return Urllib3Response(raw, url)
+
+    def poolstats(self):
+        return dict((name, _poolstats(pool_size, [self.pools[prefix]]))
+                    for name, (prefix, pool_size) in self.mounts.items())
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.manager.clear()
+
+
+def _utf8(value):
+    'Make value fit for urlencode(), on python 2 too'
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+# transports by name, for JFS(transport=...)
+TRANSPORTS = {'requests': RequestsTransport,
+              'urllib3': Urllib3Transport,
+             }
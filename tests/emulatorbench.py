@@ -0,0 +1,181 @@
+# -*- encoding: utf-8 -*-
+'''Benchmark jottalib against the offline JottaCloud emulator in jfsemulator.py
+
+Counts requests and bytes, which don't depend on the network, and times what does.
+
+    PYTHONPATH=src python tests/emulatorbench.py [benchmark ...]
+'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# import standardlib
+import os, sys, time, zlib, tempfile, argparse, logging
+import six
+import requests_toolbelt
+
+from jottalib.JFS import calculate_md5
+from jfsemulator import Emulator, EmulatedJFS
+
+cputime = time.thread_time if hasattr(time, 'thread_time') else time.clock # the emulator runs in other threads of this process
+processtime = time.process_time if hasattr(time, 'process_time') else time.clock
+
+
+def folder_uploads(sizes=(10, 100, 1000)):
+    '''Upload n small files into one folder with JFSFolder.up(), and count the requests it takes.
+
+    "sync" is the way it used to be, fetching the whole folder again after every upload'''
+    print('%-24s %6s %9s %12s %8s' % ('folder uploads', 'files', 'requests', 'bytes out', 'seconds'))
+    for n in sizes:
+        for resync in (True, False):
+            with Emulator() as emu:
+                jfs = emu.client()
+                folder = jfs.getObject('/Jotta/Archive').mkdir('bench')
+                list(folder.files())
+                emu.reset_stats()
+                started = time.time()
+                for i in range(n):
+                    folder.up(six.BytesIO(b'x'), 'file%s.txt' % i)
+                    if resync:
+                        folder.sync()
+                print('%-24s %6s %9s %12s %8.2f' % ('with sync' if resync else 'in memory', n,
+                                                    emu.stats['requests'], emu.stats['bytes out'],
+                                                    time.time() - started))
+
+def transports(n=1000):
+    '''Fetch the metadata of a small file n times through each transport (see jottalib.transport),
+    with no caching, and time it, to see what each of them adds to a request.
+
+    "request" is just the http, "getObject" is with parsing the xml and wrapping it up'''
+    print('%-24s %6s %9s %14s' % ('transports', 'calls', 'seconds', 'ms per call'))
+    for name in ('requests', 'urllib3'):
+        with Emulator() as emu:
+            emu.add_file('/Jotta/Archive/small.txt', b'x')
+            jfs = emu.client(transport=name, cache=False, notfound_ttl=0)
+            url = jfs.rootpath + '/Jotta/Archive/small.txt'
+            jfs.getObject(url) # connect
+            for what, fetch in (('request', lambda: jfs.request(url).content),
+                                ('getObject', lambda: jfs.getObject(url))):
+                started = time.time()
+                for i in range(n):
+                    fetch()
+                elapsed = time.time() - started
+                print('%-24s %6s %9.2f %14.3f' % ('%s %s' % (name, what), n, elapsed, 1000 * elapsed / n))
+
+class ToolbeltJFS(EmulatedJFS):
+    'How uploads were encoded before jottalib.multipart'
+    def multipart(self, files, upload_callback=None):
+        m = requests_toolbelt.MultipartEncoder(fields=files)
+        if upload_callback is not None:
+            m = requests_toolbelt.MultipartEncoderMonitor(m, lambda monitor: upload_callback(monitor, m.len))
+        return m
+
+def upload_throughput(size=256*1024*1024):
+    '''Upload a file of `size` bytes from local disk, with requests_toolbelt's MultipartEncoder
+    and with jottalib.multipart.MultipartBody at some chunk sizes, and time it.
+
+    "cpu s/GB" is the cpu time of the uploading thread only, not the emulator's'''
+    print('%-24s %10s %9s %10s %10s' % ('upload throughput', 'MB', 'seconds', 'MB/s', 'cpu s/GB'))
+    with tempfile.NamedTemporaryFile() as f:
+        block = b'0123456789abcdef' * 65536
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.flush()
+        md5 = calculate_md5(f)
+        for name, chunk_size in (('toolbelt', None), ('multipart 64KiB', 64*1024),
+                                 ('multipart 1MiB', 1024*1024), ('multipart 4MiB', 4*1024*1024)):
+            with Emulator() as emu:
+                if chunk_size is None:
+                    jfs = ToolbeltJFS(emu, auth=(emu.username, emu.password))
+                else:
+                    jfs = emu.client(upload_chunk_size=chunk_size)
+                jfs.up('/Jotta/Archive/warmup', six.BytesIO(b'x')) # connect
+                f.seek(0)
+                started, cpu = time.time(), cputime()
+                jfs.up('/Jotta/Archive/big.bin', f, md5=md5, upload_callback=lambda monitor, length: None)
+                elapsed, cpu = time.time() - started, cputime() - cpu
+                print('%-24s %10d %9.2f %10.1f %10.2f' % (name, size / 2**20, elapsed, size / 2**20 / elapsed,
+                                                          cpu * 2**30 / size))
+
+def download_throughput(size=256*1024*1024):
+    '''Download a file of `size` bytes to local disk, by writing what JFSFile.stream() yields,
+    with JFSFile.download() and with JFSFile.download_to(), and time it.
+
+    "cpu s/GB" is the cpu time of the whole process, the emulator's too, which is about
+    the same for all of them'''
+    print('%-24s %10s %9s %10s %10s' % ('download throughput', 'MB', 'seconds', 'MB/s', 'cpu s/GB'))
+    block = b'0123456789abcdef' * 65536
+    with Emulator() as emu, tempfile.NamedTemporaryFile() as target:
+        emu.add_file('/Jotta/Archive/big.bin', block * (size // len(block)))
+        jfs = emu.client()
+        f = jfs.getObject('/Jotta/Archive/big.bin')
+        def stream():
+            with open(target.name, 'wb') as fh:
+                for chunk in f.stream():
+                    fh.write(chunk)
+        for name, download in (('stream + write', stream),
+                               ('download', lambda: f.download(target.name, workers=1)),
+                               ('download_to', lambda: f.download_to(target.name, workers=1)),
+                               ('download, 4 workers', lambda: f.download(target.name, workers=4)),
+                               ('download_to, 4 workers', lambda: f.download_to(target.name, workers=4))):
+            started, cpu = time.time(), processtime()
+            download()
+            elapsed, cpu = time.time() - started, processtime() - cpu
+            print('%-24s %10d %9.2f %10.1f %10.2f' % (name, size / 2**20, elapsed, size / 2**20 / elapsed,
+                                                      cpu * 2**30 / size))
+
+def stream_readahead(size=64*1024*1024, bandwidth=64*1024*1024):
+    '''Stream a file of `size` bytes over a link of `bandwidth` bytes/s to a consumer that
+    compresses what it gets, with and without read-ahead, and time it'''
+    print('%-24s %10s %9s %10s %14s %12s' % ('stream read-ahead', 'MB', 'seconds', 'MB/s',
+                                              'consumer waits', 'reader waits'))
+    block = os.urandom(1024) * 64
+    with Emulator(bandwidth=bandwidth) as emu:
+        emu.add_file('/Jotta/Archive/big.bin', block * (size // len(block)))
+        for readahead in (0, 4, 16, 64):
+            jfs = emu.client()
+            f = jfs.getObject('/Jotta/Archive/big.bin')
+            compressor = zlib.compressobj(6)
+            started = time.time()
+            for chunk in f.stream(readahead=readahead):
+                compressor.compress(chunk) # zlib lets go of the GIL while it works
+            compressor.flush()
+            elapsed = time.time() - started
+            stats = jfs.readahead_counter.stats()
+            print('%-24s %10d %9.2f %10.1f %14d %12d' % ('readahead=%s' % readahead, size / 2**20, elapsed,
+                                                          size / 2**20 / elapsed, stats['consumer_waits'],
+                                                          stats['reader_waits']))
+
+BENCHMARKS = {'folder_uploads': folder_uploads,
+              'transports': transports,
+              'upload_throughput': upload_throughput,
+              'download_throughput': download_throughput,
+              'stream_readahead': stream_readahead,
+             }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', nargs='*', choices=sorted(BENCHMARKS) + [[]],
+                        help='Benchmarks to run. Default: all of them')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for name in args.benchmark or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+        print('')
@@ -0,0 +1,1021 @@
+# -*- encoding: utf-8 -*-
+'''An offline, in-process emulator of the JottaCloud JFS api, for tests and benchmarks.
+
+Runs a local http server that speaks the parts of the JFS xml protocol that jottalib uses,
+backed by an in-memory tree, with configurable latency, bandwidth caps and injected failures:
+
+    with Emulator(latency=0.02, bandwidth=10*1024*1024) as emu:
+        jfs = emu.client() # a jottalib.JFS.JFS, talking to the emulator (emu.async_client() for jottalib.aio)
+        jfs.up('/Jotta/Archive/test.txt', six.BytesIO(b'hello'))
+        emu.fail(method='GET', path='test.txt', status=500) # the next GET of test.txt gets a http 500
+        print(emu.stats) # Counter of requests, by kind
+
+What is emulated
+  - GET of the <user>, <device>, <mountPoint>, <folder> and <file> documents
+  - GET ?mode=list (<filedirlist>), ?mode=bin (with Range), /<device>/Latest and ?search=<text>
+  - POST multipart uploads to the up host, with ?cphash, JMd5 and JSize, and resuming of incomplete files
+  - POST ?mkDir, ?dl, ?dlDir, ?mv, ?mvDir, new devices and mountpoints
+  - http basic auth, and <error> documents for everything that goes wrong
+  - gzip for xml, when asked for, and ETag/If-None-Match, if you turn on .etags
+
+jottalib has no search call, so ?search=<text> (on any folder) is our own take on it.
+'''
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# import standardlib
+import re, gzip, time, uuid, base64, hashlib, random, mimetypes, posixpath, threading, logging
+from collections import OrderedDict, Counter
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit, parse_qs, unquote
+
+import requests
+from requests.packages import urllib3
+import lxml.etree
+import dateutil.parser
+
+# import jotta
+from jottalib import JFS, transport
+try:
+    from jottalib import aio
+except (ImportError, SyntaxError): # no aiohttp, or a python without async def
+    aio = None
+
+log = logging.getLogger(__name__)
+
+HOSTS = {'www': 'https://www.jottacloud.com/',
+         'up': 'https://up.jottacloud.com/'}
+CHUNK_SIZE = 16*1024 # bytes we send or receive between checks of bandwidth and failures
+MOUNTPOINTS = ('Archive', 'Shared', 'Sync') # on the built in Jotta device
+
+STATE_COMPLETED = JFS.ProtoFile.STATE_COMPLETED
+STATE_INCOMPLETE = JFS.ProtoFile.STATE_INCOMPLETE
+STATE_CORRUPT = JFS.ProtoFile.STATE_CORRUPT
+
+
+def gzip_compress(data):
+    buf = six.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+def timestamp(t):
+    'Format seconds since epoch like JottaCloud does, e.g. 2015-07-26-T22:26:54Z'
+    return time.strftime('%Y-%m-%d-T%H:%M:%SZ', time.gmtime(t))
+
+def _text(s):
+    if isinstance(s, six.binary_type):
+        return s.decode('utf-8')
+    return s
+
+
+class EmulatorError(Exception):
+    'Raised inside a request handler to answer with an <error> document'
+    def __init__(self, code, message, reason=None, headers=None):
+        super(EmulatorError, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.headers = headers or {}
+        self.reason = reason or BaseHTTPServer.BaseHTTPRequestHandler.responses.get(code, ('Error', ))[0]
+
+
+class Hangup(Exception):
+    'Raised inside a request handler to drop the connection, like a network failure'
+
+
+class Failure(object):
+    '''A failure to inject, for requests matching `method` and `path` (a regex, searched for in
+    the unquoted url path). See Emulator.fail()'''
+    def __init__(self, method=None, path=None, status=None, after=None, stall=None, times=1, retry_after=None):
+        self.method = method
+        self.path = re.compile(path) if path is not None else None
+        self.status = status
+        self.retry_after = retry_after
+        self.after = after
+        self.stall = stall
+        self.times = times
+
+    def matches(self, method, path):
+        return (self.times != 0 and
+                (self.method is None or self.method == method) and
+                (self.path is None or self.path.search(path) is not None))
+
+    def __repr__(self):
+        return '<Failure method=%r path=%r status=%r after=%r stall=%r times=%r>' % (
+            self.method, self.path and self.path.pattern, self.status, self.after, self.stall, self.times)
+
+
+class Revision(object):
+    def __init__(self, number, size, md5, created, modified, mime):
+        self.number = number
+        self.size = size # what the client told us, in JSize
+        self.md5 = md5 # ditto, JMd5
+        self.created = created
+        self.modified = modified
+        self.updated = time.time()
+        self.mime = mime
+        self.data = bytearray()
+        self.state = STATE_INCOMPLETE
+
+    def check(self):
+        'Update .state from what we have received'
+        if len(self.data) < self.size:
+            self.state = STATE_INCOMPLETE
+        elif len(self.data) == self.size and hashlib.md5(self.data).hexdigest() == self.md5:
+            self.state = STATE_COMPLETED
+        else:
+            self.state = STATE_CORRUPT
+        self.updated = time.time()
+
+
+class File(object):
+    def __init__(self, name):
+        self.name = name
+        self.uuid = str(uuid.uuid4())
+        self.revisions = []
+        self.deleted = None
+
+    @property
+    def latest(self):
+        return self.revisions[-1] if self.revisions else None
+
+    @property
+    def current(self):
+        'The newest completed revision, or None'
+        for rev in reversed(self.revisions):
+            if rev.state == STATE_COMPLETED:
+                return rev
+        return None
+
+
+class Folder(object):
+    def __init__(self, name):
+        self.name = name
+        self.folders = OrderedDict()
+        self.files = OrderedDict()
+        self.deleted = None
+        self.modified = time.time()
+
+    def walk(self, path):
+        'Yield (path, folder) for this folder and every live folder below it'
+        yield path, self
+        for name, folder in self.folders.items():
+            if folder.deleted is None:
+                for sub in folder.walk('%s/%s' % (path, name)):
+                    yield sub
+
+    def size(self):
+        return sum(len(f.current.data) for _, folder in self.walk('') for f in folder.files.values()
+                   if f.deleted is None and f.current is not None)
+
+
+class Device(object):
+    def __init__(self, name, type_):
+        self.name = name
+        self.type = type_
+        self.sid = str(uuid.uuid4())
+        self.modified = time.time()
+        self.mountpoints = OrderedDict()
+
+
+class Emulator(object):
+    '''The emulated JottaCloud, served from two local http servers, one for www.jottacloud.com
+    and one for up.jottacloud.com.
+
+    Knobs, which may be changed at any time:
+      .latency - seconds to wait before answering each request
+      .bandwidth - bytes/s for each response body (None: as fast as we can)
+      .upload_bandwidth - bytes/s for each request body
+      .error_rate - share of requests (0.0-1.0) that get a http 500, drawn from .random,
+                    which is seeded with `seed` for reproducible runs
+      .etags - send ETags with xml documents, and answer If-None-Match with 304 Not Modified
+    and .fail(), to inject failures in particular requests.
+
+    What happened is counted in .stats, a Counter, e.g. stats['GET folder'], stats['POST up'],
+    stats['bytes out'] and stats['requests'], and every request is appended to .log as
+    (method, host, path, query). See .reset_stats()'''
+
+    def __init__(self, username='jottatest', password='secret', latency=0.0, bandwidth=None,
+                 upload_bandwidth=None, error_rate=0.0, seed=None):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.upload_bandwidth = upload_bandwidth
+        self.error_rate = error_rate
+        self.etags = False
+        self.random = random.Random(seed)
+        self.failures = []
+        self.stats = Counter()
+        self.log = []
+        self.lock = threading.RLock()
+        self.devices = OrderedDict()
+        self.contents = {} # md5 -> bytes, for ?cphash
+        self.servers = {}
+        jotta = self.devices['Jotta'] = Device('Jotta', 'JOTTA')
+        for name in MOUNTPOINTS:
+            jotta.mountpoints[name] = Folder(name)
+
+    # running
+
+    def start(self):
+        'Start serving, on two free ports on localhost'
+        for name in HOSTS:
+            server = _Server(('127.0.0.1', 0), _Handler)
+            server.emulator = self
+            server.hostname = name
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+            self.servers[name] = server
+        log.debug('emulating jottacloud at %r', self.urls())
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        self.servers = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def urls(self):
+        'Get a dict of real url prefix -> the local url prefix we serve it from'
+        return dict((prefix, 'http://127.0.0.1:%s/' % self.servers[name].server_address[1])
+                    for name, prefix in HOSTS.items())
+
+    def client(self, **kwargs):
+        'Get a JFS that talks to us. Keyword arguments go to JFS.JFS()'
+        kwargs.setdefault('auth', (self.username, self.password))
+        return EmulatedJFS(self, **kwargs)
+
+    def async_client(self, **kwargs):
+        'Get a jottalib.aio.AsyncJFS that talks to us. Keyword arguments go to AsyncJFS(). Needs aiohttp'
+        kwargs.setdefault('auth', (self.username, self.password))
+        return EmulatedAsyncJFS(self, **kwargs)
+
+    # knobs and counters
+
+    def fail(self, method=None, path=None, status=None, after=None, stall=None, times=1, retry_after=None):
+        '''Make the next `times` requests (-1 for all of them) that match `method` and `path`
+        (a regex, searched for in the unquoted url path) fail:
+
+          status - answer with this http status and an <error> document
+          retry_after - and with this Retry-After header
+          after - send (for GET) or receive (for POST) only this many bytes of the body, then hang up
+          stall - wait this many seconds, after `after` bytes of the body (or none), then go on
+
+        Returns the Failure, which you may change or .remove() from .failures'''
+        failure = Failure(method, path, status, after, stall, times, retry_after)
+        with self.lock:
+            self.failures.append(failure)
+        return failure
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+            del self.log[:]
+
+    def _failure(self, method, path):
+        with self.lock:
+            for failure in self.failures:
+                if failure.matches(method, path):
+                    failure.times -= 1
+                    return failure
+            if self.error_rate and self.random.random() < self.error_rate:
+                return Failure(status=500)
+        return None
+
+    # the tree. Paths are like in JFS.getObject(), i.e. /<device>/<mountpoint>/...
+
+    def _split(self, path):
+        return [p for p in _text(path).split('/') if p]
+
+    def lookup(self, path):
+        'Get the Device, Folder (or mountpoint) or File at path, or None'
+        parts = self._split(path)
+        node = self.devices.get(parts[0]) if parts else None
+        if node is None or len(parts) == 1:
+            return node
+        node = node.mountpoints.get(parts[1])
+        for name in parts[2:]:
+            if not isinstance(node, Folder):
+                return None
+            node = node.folders.get(name) or node.files.get(name)
+        return node
+
+    def mkdirs(self, path):
+        'Create the folder at path, and the ones above it, and return it'
+        parts = self._split(path)
+        with self.lock:
+            device = self.devices.get(parts[0])
+            if device is None or len(parts) < 2 or parts[1] not in device.mountpoints:
+                raise EmulatorError(404, 'no.jotta.backup.errors.NoSuchPathException: %s' % path)
+            folder = device.mountpoints[parts[1]]
+            for name in parts[2:]:
+                if name in folder.files:
+                    raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: %s is a file' % path)
+                if name not in folder.folders:
+                    folder.folders[name] = Folder(name)
+                    folder.modified = time.time()
+                folder = folder.folders[name]
+                folder.deleted = None
+            return folder
+
+    def add_file(self, path, data, modified=None):
+        'Put a complete file with `data` (bytes) at path, straight into the tree, and return it'
+        with self.lock:
+            folder = self.mkdirs(posixpath.dirname(path))
+            name = posixpath.basename(path)
+            f = folder.files.get(name) or File(name)
+            t = modified or time.time()
+            rev = Revision(len(f.revisions) + 1, len(data), hashlib.md5(data).hexdigest(), t, t,
+                           mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            rev.data[:] = data
+            rev.check()
+            f.revisions.append(rev)
+            f.deleted = None
+            folder.files[name] = f
+            self.contents[rev.md5] = bytes(data)
+            return f
+
+    # xml
+
+    def _abs(self, parts):
+        'The path of a node, as jottacloud puts it in <path>, i.e. starting with the username'
+        return '/' + '/'.join([self.username] + list(parts))
+
+    def _error(self, e):
+        doc = lxml.etree.Element('error')
+        for tag, text in (('code', str(e.code)), ('message', e.message), ('reason', e.reason),
+                          ('cause', ''), ('hostname', 'emulator'), ('x-id', str(uuid.uuid4()))):
+            lxml.etree.SubElement(doc, tag).text = text
+        return doc
+
+    def _root(self, tag, **attrs):
+        doc = lxml.etree.Element(tag, time=timestamp(time.time()), host='emulator')
+        for k, v in attrs.items():
+            doc.set(k, v)
+        return doc
+
+    def _revisionxml(self, parent, tag, rev, size=True):
+        el = lxml.etree.SubElement(parent, tag)
+        for name, value in (('number', str(rev.number)),
+                            ('state', rev.state),
+                            ('created', timestamp(rev.created)),
+                            ('modified', timestamp(rev.modified)),
+                            ('mime', rev.mime),
+                            ('mstyle', rev.mime.upper().replace('/', '_')),
+                            ('size', str(len(rev.data)) if size else None),
+                            ('md5', rev.md5),
+                            ('updated', timestamp(rev.updated))):
+            if value is not None:
+                lxml.etree.SubElement(el, name).text = value
+        return el
+
+    def _filexml(self, parent, f):
+        'Add a <file> to parent (None for a document of its own)'
+        if parent is None:
+            el = self._root('file', name=f.name, uuid=f.uuid)
+        else:
+            el = lxml.etree.SubElement(parent, 'file', name=f.name, uuid=f.uuid)
+        if f.deleted is not None:
+            el.set('deleted', timestamp(f.deleted))
+        return el
+
+    def _filerevisions(self, el, f, size=True):
+        current = f.current
+        if current is not None and current is f.latest:
+            self._revisionxml(el, 'currentRevision', current)
+        else:
+            # incomplete files only tell their size when asked directly, like the real thing
+            self._revisionxml(el, 'latestRevision', f.latest, size=size)
+        return el
+
+    def _filesxml(self, parent, folder):
+        files = lxml.etree.SubElement(parent, 'files')
+        for f in folder.files.values():
+            if f.latest is not None:
+                self._filerevisions(self._filexml(files, f), f, size=False)
+        return files
+
+    def _metadata(self, parent, folder):
+        lxml.etree.SubElement(parent, 'metadata', first='', max='',
+                              total=str(len(folder.folders) + len(folder.files)),
+                              num_folders=str(len(folder.folders)), num_files=str(len(folder.files)))
+
+    def _folderlisting(self, el, parts, folder):
+        lxml.etree.SubElement(el, 'path').text = self._abs(parts[:-1])
+        lxml.etree.SubElement(el, 'abspath').text = self._abs(parts[:-1])
+        folders = lxml.etree.SubElement(el, 'folders')
+        for sub in folder.folders.values():
+            s = lxml.etree.SubElement(folders, 'folder', name=sub.name)
+            if sub.deleted is not None:
+                s.set('deleted', timestamp(sub.deleted))
+        self._filesxml(el, folder)
+        self._metadata(el, folder)
+
+    def userxml(self):
+        doc = self._root('user')
+        for tag, text in (('username', self.username), ('account-type', 'unlimited'), ('locked', 'false'),
+                          ('capacity', '-1'), ('max-devices', '-1'), ('max-mobile-devices', '-1'),
+                          ('usage', str(sum(mp.size() for d in self.devices.values() for mp in d.mountpoints.values()))),
+                          ('read-locked', 'false'), ('write-locked', 'false'), ('quota-write-locked', 'false'),
+                          ('enable-sync', 'true'), ('enable-foldershare', 'true')):
+            lxml.etree.SubElement(doc, tag).text = text
+        devices = lxml.etree.SubElement(doc, 'devices')
+        for device in self.devices.values():
+            self._devicexml(lxml.etree.SubElement(devices, 'device'), device)
+        return doc
+
+    def _devicexml(self, el, device):
+        lxml.etree.SubElement(el, 'name').text = device.name
+        lxml.etree.SubElement(el, 'type').text = device.type
+        lxml.etree.SubElement(el, 'sid').text = device.sid
+        lxml.etree.SubElement(el, 'size').text = str(sum(mp.size() for mp in device.mountpoints.values()))
+        lxml.etree.SubElement(el, 'modified').text = timestamp(device.modified)
+        return el
+
+    def devicexml(self, device):
+        doc = self._devicexml(self._root('device'), device)
+        lxml.etree.SubElement(doc, 'user').text = self.username
+        mps = lxml.etree.SubElement(doc, 'mountPoints')
+        for mp in device.mountpoints.values():
+            el = lxml.etree.SubElement(mps, 'mountPoint')
+            lxml.etree.SubElement(el, 'name').text = mp.name
+            lxml.etree.SubElement(el, 'size').text = str(mp.size())
+            lxml.etree.SubElement(el, 'modified').text = timestamp(mp.modified)
+        lxml.etree.SubElement(doc, 'metadata', first='', max='', total=str(len(device.mountpoints)),
+                              num_mountpoints=str(len(device.mountpoints)))
+        return doc
+
+    def mountpointxml(self, parts, mp):
+        doc = self._root('mountPoint')
+        lxml.etree.SubElement(doc, 'name').text = mp.name
+        self._folderlisting(doc, parts, mp)
+        # mountpoints have a few more bits, in between <abspath> and <folders>
+        folders = doc.find('folders')
+        for tag, text in (('size', str(mp.size())), ('modified', timestamp(mp.modified)),
+                          ('device', parts[0]), ('user', self.username)):
+            el = lxml.etree.Element(tag)
+            el.text = text
+            folders.addprevious(el)
+        return doc
+
+    def folderxml(self, parts, folder):
+        doc = self._root('folder', name=folder.name)
+        if folder.deleted is not None:
+            doc.set('deleted', timestamp(folder.deleted))
+        self._folderlisting(doc, parts, folder)
+        return doc
+
+    def filexml(self, parts, f):
+        doc = self._filexml(None, f)
+        lxml.etree.SubElement(doc, 'path').text = self._abs(parts[:-1])
+        lxml.etree.SubElement(doc, 'abspath').text = self._abs(parts[:-1])
+        self._filerevisions(doc, f)
+        revisions = lxml.etree.SubElement(doc, 'revisions')
+        for rev in reversed(f.revisions[:-1]):
+            self._revisionxml(revisions, 'revision', rev)
+        return doc
+
+    def filedirlistxml(self, parts, folder):
+        doc = self._root('filedirlist')
+        folders = lxml.etree.SubElement(doc, 'folders')
+        for path, sub in folder.walk('/'.join(parts)):
+            el = lxml.etree.SubElement(folders, 'folder', name=posixpath.basename(path))
+            lxml.etree.SubElement(el, 'path').text = self._abs(self._split(posixpath.dirname(path)))
+            lxml.etree.SubElement(el, 'abspath').text = self._abs(self._split(posixpath.dirname(path)))
+            files = lxml.etree.SubElement(el, 'files')
+            for f in sub.files.values():
+                if f.deleted is None and f.latest is not None:
+                    self._filerevisions(self._filexml(files, f), f, size=False)
+        return doc
+
+    def searchxml(self, matches):
+        doc = self._root('searchresult')
+        files = lxml.etree.SubElement(doc, 'files')
+        for parts, f in matches:
+            el = self._filexml(files, f)
+            lxml.etree.SubElement(el, 'path').text = self._abs(parts[:-1])
+            lxml.etree.SubElement(el, 'abspath').text = self._abs(parts[:-1])
+            self._filerevisions(el, f)
+        return doc
+
+    def _files(self, parts, folder):
+        'Yield (parts, File) for every live file below folder'
+        for path, sub in folder.walk('/'.join(parts)):
+            for f in sub.files.values():
+                if f.deleted is None and f.latest is not None:
+                    yield self._split(path) + [f.name], f
+
+    # requests
+
+    def _resolve(self, parts):
+        'Get the node at parts, or raise a http 404'
+        node = self.lookup('/'.join(parts))
+        if node is None:
+            raise EmulatorError(404, 'no.jotta.backup.errors.NoSuchPathException: %s' % self._abs(parts))
+        return node
+
+    def get(self, parts, query, headers):
+        '''Answer a GET for the path (split into `parts`) below the user.
+
+        Returns (status, headers, body)'''
+        if not parts:
+            self.stats['GET user'] += 1
+            return self._xml(self.userxml())
+        device = self.devices.get(parts[0])
+        if len(parts) == 2 and parts[1] == 'Latest' and device is not None and 'Latest' not in device.mountpoints:
+            self.stats['GET latest'] += 1
+            latest = sorted((m for mp in device.mountpoints.values()
+                             for m in self._files([parts[0], mp.name], mp)),
+                            key=lambda m: m[1].latest.updated, reverse=True)
+            return self._xml(self.searchxml(latest[:int(query.get('max', 10))]))
+        node = self._resolve(parts)
+        mode = query.get('mode')
+        if mode == 'bin':
+            if not isinstance(node, File) or node.current is None:
+                raise EmulatorError(404, 'no.jotta.backup.errors.NoSuchFileException: %s' % self._abs(parts))
+            self.stats['GET bin'] += 1
+            return self._bin(node.current.data, headers.get('Range'))
+        elif mode == 'thumb':
+            raise EmulatorError(404, 'no.jotta.backup.errors.NoSuchFileException: no thumbnails here')
+        elif mode == 'list':
+            if not isinstance(node, Folder):
+                raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: not a folder')
+            self.stats['GET list'] += 1
+            return self._xml(self.filedirlistxml(parts, node))
+        elif 'search' in query:
+            if not isinstance(node, Folder):
+                raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: not a folder')
+            self.stats['GET search'] += 1
+            needle = query['search'].lower()
+            return self._xml(self.searchxml([m for m in self._files(parts, node) if needle in m[1].name.lower()]))
+        if isinstance(node, Device):
+            self.stats['GET device'] += 1
+            return self._xml(self.devicexml(node))
+        elif isinstance(node, File):
+            self.stats['GET file'] += 1
+            return self._xml(self.filexml(parts, node))
+        elif len(parts) == 2:
+            self.stats['GET mountPoint'] += 1
+            return self._xml(self.mountpointxml(parts, node))
+        self.stats['GET folder'] += 1
+        return self._xml(self.folderxml(parts, node))
+
+    def post(self, host, parts, query, headers, body):
+        '''Answer a POST for the path (split into `parts`) below the user. `body` is what we received,
+        which may be cut short by an injected failure.
+
+        Returns (status, headers, body)'''
+        if host == 'up':
+            self.stats['POST up'] += 1
+            return self._upload(parts, query, headers, body)
+        if not parts:
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: nothing to post to')
+        for action in ('mkDir', 'dl', 'dlDir', 'mv', 'mvDir'):
+            if action in query:
+                self.stats['POST %s' % action] += 1
+                return getattr(self, '_' + action.lower())(parts, query[action])
+        if len(parts) == 1: # a new device
+            self.stats['POST device'] += 1
+            device = self.devices.setdefault(parts[0], Device(parts[0], query.get('type', 'WORKSTATION').upper()))
+            return self._xml(self.devicexml(device))
+        elif len(parts) == 2: # a new mountpoint
+            self.stats['POST mountPoint'] += 1
+            device = self._resolve(parts[:1])
+            mp = device.mountpoints.setdefault(parts[1], Folder(parts[1]))
+            return self._xml(self.mountpointxml(parts, mp))
+        raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: unknown post to %s' % self._abs(parts))
+
+    def _mkdir(self, parts, _):
+        folder = self.mkdirs('/'.join(parts))
+        return self._xml(self.folderxml(parts, folder))
+
+    def _dl(self, parts, _):
+        f = self._resolve(parts)
+        if not isinstance(f, File):
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: not a file')
+        f.deleted = time.time()
+        return self._xml(self.filexml(parts, f))
+
+    def _dldir(self, parts, _):
+        folder = self._resolve(parts)
+        if not isinstance(folder, Folder) or len(parts) < 3:
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: not a folder')
+        folder.deleted = time.time()
+        return self._xml(self.folderxml(parts, folder))
+
+    def _move(self, parts, destination, kind):
+        node = self._resolve(parts)
+        if not isinstance(node, kind) or len(parts) < 3:
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: cannot move %s' % self._abs(parts))
+        target = self._split(destination)
+        if target[:1] != [self.username]:
+            raise EmulatorError(403, 'no.jotta.backup.errors.ForbiddenException: %s' % destination)
+        target = target[1:]
+        parent = self.mkdirs('/'.join(target[:-1]))
+        source = self._resolve(parts[:-1])
+        if kind is File:
+            del source.files[parts[-1]]
+            node.name = target[-1]
+            parent.files[node.name] = node
+        else:
+            del source.folders[parts[-1]]
+            node.name = target[-1]
+            parent.folders[node.name] = node
+        return target, node
+
+    def _mv(self, parts, destination):
+        target, f = self._move(parts, destination, File)
+        return self._xml(self.filexml(target, f))
+
+    def _mvdir(self, parts, destination):
+        target, folder = self._move(parts, destination, Folder)
+        return self._xml(self.folderxml(target, folder))
+
+    def _upload(self, parts, query, headers, body):
+        fields = _multipart(body, headers.get('Content-Type', ''))
+        md5 = headers.get('JMd5') or _text(fields.get('md5', b''))
+        try:
+            size = int(headers['JSize'])
+        except (KeyError, ValueError):
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: no JSize')
+        data = fields.get('file', b'')
+        if len(parts) < 3:
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: cannot upload to %s' % self._abs(parts))
+        folder = self.mkdirs('/'.join(parts[:-1]))
+        name = parts[-1]
+        if name in folder.folders:
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: %s is a folder' % self._abs(parts))
+        f = folder.files.get(name) or File(name)
+        latest = f.latest
+        if latest is not None and latest.md5 == md5 and f.deleted is None and latest.state == STATE_COMPLETED:
+            self.stats['upload unchanged'] += 1 # same contents, nothing to do
+        elif latest is not None and latest.md5 == md5 and latest.state == STATE_INCOMPLETE and \
+                len(latest.data) + len(data) == size and len(data) < size:
+            self.stats['upload resumed'] += 1 # the rest of an incomplete file
+            latest.data.extend(data)
+            latest.check()
+        else:
+            def parse(t):
+                try:
+                    return time.mktime(dateutil.parser.parse(t).timetuple())
+                except (ValueError, TypeError, OverflowError):
+                    return time.time()
+            latest = Revision(len(f.revisions) + 1, size, md5,
+                              parse(headers.get('JCreated')), parse(headers.get('JModified')),
+                              mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            if query.get('cphash') in self.contents and len(self.contents[query['cphash']]) == size:
+                self.stats['upload cphash'] += 1 # we know these bytes already
+                latest.data[:] = self.contents[query['cphash']]
+            else:
+                latest.data[:] = data[:size]
+            latest.check()
+            f.revisions.append(latest)
+        f.deleted = None
+        folder.files[name] = f
+        if latest.state == STATE_COMPLETED:
+            self.contents[latest.md5] = bytes(latest.data)
+        return self._xml(self.filexml(parts, f))
+
+    def _xml(self, doc, status=200):
+        return status, {'Content-Type': 'application/xml; charset=UTF-8'}, \
+            lxml.etree.tostring(doc, xml_declaration=True, encoding='UTF-8')
+
+    def _bin(self, data, rangeheader):
+        if not rangeheader:
+            return 200, {'Content-Type': 'application/octet-stream'}, bytes(data)
+        m = re.match(r'bytes=(\d*)-(\d*)$', rangeheader.strip())
+        if m is None or not (m.group(1) or m.group(2)):
+            raise EmulatorError(400, 'no.jotta.backup.errors.BadRequestException: bad range %s' % rangeheader)
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)) + 1, len(data)) if m.group(2) else len(data)
+        else: # the last n bytes
+            start, end = max(len(data) - int(m.group(2)), 0), len(data)
+        if start >= len(data) or start >= end:
+            raise EmulatorError(416, 'no.jotta.backup.errors.RangeNotSatisfiableException: %s' % rangeheader)
+        return 206, {'Content-Type': 'application/octet-stream',
+                     'Content-Range': 'bytes %s-%s/%s' % (start, end-1, len(data))}, bytes(data[start:end])
+
+
+def _multipart(body, contenttype):
+    '''Parse a multipart/form-data body to a dict of name -> bytes. A body that is cut short
+    gives what we got of the last part'''
+    m = re.search(r'boundary="?([^";]+)"?', contenttype)
+    if m is None:
+        return {}
+    boundary = b'--' + m.group(1).encode('ascii')
+    fields = {}
+    for part in body.split(boundary)[1:]:
+        if part.startswith(b'--'): # the end
+            break
+        head, _, value = part.partition(b'\r\n\r\n')
+        name = re.search(br'name="([^"]*)"', head)
+        if name is None:
+            continue
+        if value.endswith(b'\r\n'):
+            value = value[:-2]
+        fields[name.group(1).decode('utf-8')] = value
+    return fields
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up on us all the time, e.g. when they give up on a stalled response
+        log.debug('connection from %r failed', client_address, exc_info=True)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real thing
+    disable_nagle_algorithm = True # or every response waits for the client's delayed ack
+    server_version = 'jfsemulator'
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        emu = self.server.emulator
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if isinstance(path, six.binary_type): # py2
+            path = path.decode('utf-8')
+        query = dict((k, _text(v[-1])) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+        with emu.lock:
+            emu.stats['requests'] += 1
+            emu.log.append((method, self.server.hostname, path, query))
+        failure = emu._failure(method, path)
+        try:
+            if emu.latency:
+                time.sleep(emu.latency)
+            # a failure with `after` or `stall` hits the request body of a POST, or the response body of a GET
+            body = self.receive(failure if method == 'POST' else None)
+            if failure is not None and failure.status is not None:
+                raise EmulatorError(failure.status, 'Injected failure: %r' % failure,
+                                    headers={'Retry-After': str(failure.retry_after)} if failure.retry_after is not None else None)
+            if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                # like a servlet, we take form fields as parameters, e.g. JFSFolder.mkdir() posts mkDir=true
+                for k, v in parse_qs(_text(body)).items():
+                    query.setdefault(k, _text(v[-1]))
+            if method == 'HEAD':
+                return self.respond(200, {}, b'', None)
+            if not self.authorized():
+                raise EmulatorError(401, 'org.springframework.security.authentication.BadCredentialsException: Bad credentials')
+            prefix = '/jfs/%s' % emu.username
+            if path.startswith('/rest/webrest/') or not (path == prefix or path.startswith(prefix + '/')):
+                raise EmulatorError(404, 'no.jotta.backup.errors.NoSuchPathException: %s is not emulated' % path)
+            parts = emu._split(path[len(prefix):])
+            with emu.lock:
+                if method == 'GET':
+                    status, headers, content = emu.get(parts, query, self.headers)
+                else:
+                    status, headers, content = emu.post(self.server.hostname, parts, query, self.headers, body)
+            if headers.get('Content-Type', '').startswith('application/xml'):
+                status, headers, content = self.negotiate(status, headers, content)
+            self.respond(status, headers, content, failure if method != 'POST' else None)
+        except EmulatorError as e:
+            with emu.lock:
+                emu.stats['errors'] += 1
+            status, headers, content = emu._xml(emu._error(e))
+            headers.update(e.headers)
+            self.respond(e.code, headers, content, None)
+        except Hangup:
+            with emu.lock:
+                emu.stats['hangups'] += 1
+            self.close_connection = True
+        except Exception:
+            log.exception('emulator failed on %s %s', method, self.path)
+            status, headers, content = emu._xml(emu._error(EmulatorError(500, 'emulator bug')))
+            self.respond(500, headers, content, None)
+
+    def negotiate(self, status, headers, content):
+        'Apply ETag/If-None-Match and gzip to an xml document'
+        emu = self.server.emulator
+        if emu.etags and status == 200:
+            # the time attribute changes every second, but the document doesn't
+            etag = '"%s"' % hashlib.md5(re.sub(br' time="[^"]*"', b'', content, count=1)).hexdigest()
+            headers = dict(headers, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                with emu.lock:
+                    emu.stats['not modified'] += 1
+                return 304, {'ETag': etag}, b''
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            with emu.lock:
+                emu.stats['gzipped'] += 1
+            return status, dict(headers, **{'Content-Encoding': 'gzip'}), gzip_compress(content)
+        return status, headers, content
+
+    def authorized(self):
+        emu = self.server.emulator
+        expected = 'Basic ' + base64.b64encode(('%s:%s' % (emu.username, emu.password)).encode('utf-8')).decode('ascii')
+        return self.headers.get('Authorization') == expected
+
+    def receive(self, failure):
+        'Read the request body, within .upload_bandwidth, and with the failure, if any'
+        emu = self.server.emulator
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            stream = self.chunks()
+            length = None
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            stream = None
+        body = bytearray()
+        started = time.time()
+        while length is None or len(body) < length:
+            want = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - len(body))
+            if failure is not None and failure.after is not None and len(body) + want > failure.after:
+                want = max(failure.after - len(body), 0)
+                if want == 0:
+                    if failure.stall is None:
+                        # hang up, and hand what we got so far to the handler. Uploads are kept as incomplete
+                        self.handle_partial(bytes(body))
+                        raise Hangup()
+                    time.sleep(failure.stall)
+                    failure = None
+                    continue
+            chunk = next(stream, b'') if stream is not None else self.rfile.read(want)
+            if not chunk:
+                break
+            body.extend(chunk)
+            if emu.upload_bandwidth:
+                delay = len(body) / float(emu.upload_bandwidth) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        with emu.lock:
+            emu.stats['bytes in'] += len(body)
+        return bytes(body)
+
+    def chunks(self):
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return
+            yield self.rfile.read(size)
+            self.rfile.readline()
+
+    def handle_partial(self, body):
+        'Keep what we got of an upload that was cut off'
+        emu = self.server.emulator
+        if self.server.hostname != 'up' or self.command != 'POST':
+            return
+        path = unquote(urlsplit(self.path).path)
+        parts = emu._split(path)[2:] # skip /jfs/<username>
+        query = dict((k, _text(v[-1])) for k, v in parse_qs(urlsplit(self.path).query).items())
+        try:
+            with emu.lock:
+                emu._upload(parts, query, self.headers, body)
+        except EmulatorError as e:
+            log.debug('could not keep partial upload to %r: %r', path, e)
+
+    def respond(self, status, headers, content, failure):
+        'Send the response, within .bandwidth, and with the failure, if any'
+        emu = self.server.emulator
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        sent = 0
+        started = time.time()
+        while sent < len(content):
+            chunk = content[sent:sent+CHUNK_SIZE]
+            if failure is not None and failure.after is not None and sent + len(chunk) > failure.after:
+                chunk = chunk[:max(failure.after - sent, 0)]
+                if not chunk:
+                    if failure.stall is None:
+                        self.wfile.flush()
+                        raise Hangup()
+                    time.sleep(failure.stall)
+                    failure = None
+                    continue
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if emu.bandwidth:
+                delay = sent / float(emu.bandwidth) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        with emu.lock:
+            emu.stats['bytes out'] += sent
+
+
+class EmulatorAdapter(requests.adapters.HTTPAdapter):
+    'A requests transport adapter that sends requests for jottacloud.com to an Emulator instead'
+    def __init__(self, emulator, **kwargs):
+        self.emulator = emulator
+        super(EmulatorAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = request.url
+        for real, local in self.emulator.urls().items():
+            if url.startswith(real):
+                request.url = local + url[len(real):]
+                break
+        try:
+            r = super(EmulatorAdapter, self).send(request, **kwargs)
+        finally:
+            request.url = url
+        r.url = url # so that JFS.getObject(response) sees the real url
+        return r
+
+
+class EmulatedRequestsTransport(transport.RequestsTransport):
+    'A jottalib.transport.RequestsTransport that talks to an Emulator'
+    def __init__(self, emulator):
+        self.emulator = emulator
+        super(EmulatedRequestsTransport, self).__init__()
+
+    def adapter(self, pool_size, pool_block=False):
+        plain = super(EmulatedRequestsTransport, self).adapter(pool_size, pool_block)
+        return EmulatorAdapter(self.emulator,
+                               pool_connections=1,
+                               pool_maxsize=pool_size,
+                               pool_block=pool_block,
+                               max_retries=plain.max_retries)
+
+
+class EmulatedUrllib3Transport(transport.Urllib3Transport):
+    'A jottalib.transport.Urllib3Transport that talks to an Emulator'
+    def __init__(self, emulator):
+        self.emulator = emulator
+        super(EmulatedUrllib3Transport, self).__init__()
+
+    def connectionpool(self, prefix, pool_size, pool_block=False):
+        return urllib3.connection_from_url(self.emulator.urls()[prefix], maxsize=pool_size, block=pool_block,
+                                           retries=transport.pool_retries())
+
+
+class EmulatedJFS(JFS.JFS):
+    'A JFS that talks to an Emulator, see Emulator.client()'
+    transports = {'requests': EmulatedRequestsTransport,
+                  'urllib3': EmulatedUrllib3Transport,
+                 }
+
+    def __init__(self, emulator, transport='requests', **kwargs):
+        self.emulator = emulator
+        if isinstance(transport, six.string_types):
+            transport = self.transports[transport](emulator)
+        super(EmulatedJFS, self).__init__(transport=transport, **kwargs)
+
+
+if aio is not None:
+    class EmulatedAsyncJFS(aio.AsyncJFS):
+        'A jottalib.aio.AsyncJFS that talks to an Emulator, see Emulator.async_client()'
+        def __init__(self, emulator, **kwargs):
+            self.emulator = emulator
+            super(EmulatedAsyncJFS, self).__init__(**kwargs)
+
+        def _rehost(self, url, prefixes):
+            for old, new in prefixes:
+                if url.startswith(old):
+                    return new + url[len(old):]
+            return url
+
+        def _url(self, url):
+            url = super(EmulatedAsyncJFS, self)._url(url)
+            return aio.URL(self._rehost(str(url), self.emulator.urls().items()), encoded=True)
+
+        def wrap(self, o, url):
+            # so that objects from a POST see the real url, not ours
+            url = self._rehost(url, [(local, real) for real, local in self.emulator.urls().items()])
+            return super(EmulatedAsyncJFS, self).wrap(o, url)
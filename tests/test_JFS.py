@@ -29,13 +29,19 @@ from six.moves import cStringIO as StringIO
 
 
 # import dependencies
-import lxml
-import dateutil
+import lxml, lxml.objectify, lxml.etree
+import dateutil, dateutil.parser, dateutil.tz
 import requests
 
 # import py.test
 import pytest # pip install pytest
 
+try:
+    import aiohttp # pip install aiohttp
+    HAS_AIOHTTP=True
+except ImportError: # no aiohttp installed, not critical because jottalib.aio is optional
+    HAS_AIOHTTP=False
+
 # import jotta
 from jottalib import JFS, __version__
 
@@ -120,6 +126,35 @@ class TestJFS:
     def test_devices(self):
         assert all(isinstance(item, JFS.JFSDevice) for item in jfs.devices)
 
+    def test_pools(self):
+        import threading
+        j = JFS.JFS(pool_size=3, upload_pool_size=2, pool_block=True, prewarm=True)
+        stats = j.poolstats()
+        assert stats['www']['maxsize'] == 3
+        assert stats['up']['maxsize'] == 2
+        assert stats['www']['idle'] <= 3
+        threads = [threading.Thread(target=j.getObject, args=('/Jotta/Archive',)) for _ in range(10)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        stats = j.poolstats()
+        assert stats['www']['created'] <= 3
+        assert stats['www']['in_use'] == 0
+        j.close()
+
+    def test_object_cache(self):
+        p = "/Jotta/Archive/testfile_object_cache.txt"
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA))
+        f = jfs.getObject(p)
+        hits = jfs.cache.hits
+        assert jfs.getObject(p) is f
+        assert jfs.cache.hits == hits + 1
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA + TESTFILEDATA)) # post() invalidates
+        f2 = jfs.getObject(p)
+        assert f2 is not f
+        assert f2.size == 2*len(TESTFILEDATA)
+        f2.delete()
+        assert jfs.getObject(p).is_deleted()
+
     def test_up_and_delete_data(self):
         p = "/Jotta/Archive/testfile_up_and_delete_data.txt"
         t = jfs.up(p, six.BytesIO(TESTFILEDATA))
@@ -163,6 +198,44 @@ class TestJFS:
         assert s == TESTFILEDATA
         t.delete()
 
+    def test_stream_parallel(self):
+        p = "/Jotta/Archive/testfile_up_and_stream_parallel.txt"
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA))
+        s = b"".join( [ chunk for chunk in t.stream(workers=3, range_size=100) ] )
+        assert s == TESTFILEDATA
+        t.delete()
+
+    def test_download(self, tmpdir):
+        p = "/Jotta/Archive/testfile_up_and_download.txt"
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA))
+        localfile = tmpdir.join('download.txt')
+        assert t.download(str(localfile), workers=3, range_size=100) == len(TESTFILEDATA)
+        assert localfile.read_binary() == TESTFILEDATA
+        t.delete()
+
+    def test_up_with_known_md5(self):
+        import hashlib
+        p = "/Jotta/Archive/testfile_up_with_known_md5.txt"
+        md5 = hashlib.md5(TESTFILEDATA).hexdigest()
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA), md5=md5)
+        assert t.md5 == md5
+        t.delete()
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA), spool=True)
+        assert t.md5 == md5
+        assert t.read() == TESTFILEDATA
+        t.delete()
+
+    def test_spool_and_hash(self):
+        import hashlib
+        md5, spool = JFS.spool_and_hash(six.BytesIO(TESTFILEDATA))
+        assert md5 == hashlib.md5(TESTFILEDATA).hexdigest()
+        assert spool.read() == TESTFILEDATA
+        # force it to spool to disk
+        md5, spool = JFS.spool_and_hash(six.BytesIO(TESTFILEDATA), max_memory=10)
+        assert md5 == hashlib.md5(TESTFILEDATA).hexdigest()
+        assert not isinstance(spool, six.BytesIO)
+        assert spool.read() == TESTFILEDATA
+
     @pytest.mark.xfail
     def test_resume(self):
         raise NotImplementedError
@@ -470,6 +543,35 @@ class TestJFSFile:
         #TODO: test file operations: .stream(), .rename(), .read(), .read_partial, .delete etc
         #TODO: test revisions
 
+    def test_parse_timestamp(self):
+        utc = dateutil.tz.tzutc()
+        assert JFS.parse_timestamp('2015-07-25-T21:18:49Z') == datetime.datetime(2015, 7, 25, 21, 18, 49, tzinfo=utc)
+        assert JFS.parse_timestamp('2015-07-25-T21:18:49Z') == dateutil.parser.parse('2015-07-25-T21:18:49Z')
+        # anything else goes through dateutil
+        assert JFS.parse_timestamp('2015-07-25T23:18:49+02:00') == datetime.datetime(2015, 7, 25, 21, 18, 49, tzinfo=utc)
+        assert JFS.parse_timestamp(None) is None
+
+    def test_compact_records(self):
+        xml = b"""<file name="a.txt" uuid="e8f268ac-d081-4d4f-bfb1-77149b2bd51d" deleted="2015-07-26-T22:26:54Z">
+  <currentRevision>
+    <number>2</number>
+    <state>COMPLETED</state>
+    <created>2015-07-25-T21:18:49Z</created>
+    <modified>2015-07-25-T21:18:49Z</modified>
+    <mime>text/plain</mime>
+    <size>12</size>
+    <md5>125073533339a616b99bc53efc509561</md5>
+    <updated>2015-07-25-T21:18:50Z</updated>
+  </currentRevision>
+</file>"""
+        for parse in (lxml.objectify.fromstring, lxml.etree.fromstring):
+            f = JFS.JFSFile(parse(xml), jfs, parentpath=jfs.rootpath + '/Jotta/Archive')
+            assert not hasattr(f, '__dict__') # __slots__ all the way down
+            assert f.size == 12
+            assert f.revisionNumber == 2
+            assert f.is_deleted()
+            assert f.created is f.modified # same timestamp, same object
+
     @pytest.mark.xfail(reason="Pending fix on bug #100")
     def test_on_the_fly_unicode_contents(self):
         data = six.StringIO(u'123abcæøå')
@@ -500,6 +602,134 @@ class TestJFSFileDirList:
         assert isinstance(fdl, JFS.JFSFileDirList)
         assert len(fdl.tree) > 0
 
+    def test_iterfiledirlist(self):
+        "Compare the streaming parser with JFSFileDirList"
+        fdl = jfs.getObject('/Jotta/Sync', params={'mode':'list'})
+        streamed = dict(jfs.iterfiledirlist('/Jotta/Sync'))
+        assert streamed == fdl.tree
+        for files in streamed.values():
+            assert all(isinstance(f, JFS.TreeFile) for f in files)
+
+    def test_columnar(self):
+        "Test the FileDirTree behind JFSFileDirList, without a network"
+        from jottalib.filedirtree import FileDirTree
+        md5 = u'0cc175b9c0f1b6a831c399e269772661'
+        folders = [(u'/u/Jotta/Sync', [JFS.TreeFile(u'ø.txt', 5, md5, u'e0fbf295-ec67-4669-8310-337d85e0ab6b', u'COMPLETED'),
+                                       JFS.TreeFile(u'broken', None, None, u'notauuid', u'CORRUPT')]),
+                   (u'/u/Jotta/Sync/sub', [JFS.TreeFile(u'c', 7, md5, u'7946b822-5845-4d70-acca-6022a2732001', u'COMPLETED')]),
+                   (u'/u/Jotta/Sync/empty', []),
+                  ]
+        tree = FileDirTree.fromiter(folders)
+        assert len(tree) == 3
+        assert tree.tree() == dict(folders) # values that don't pack must come back as is
+        for indexed in (False, True):
+            if indexed:
+                tree.build_indexes()
+            assert tree.lookup(u'/u/Jotta/Sync/ø.txt') == folders[0][1][0]
+            assert tree.lookup(u'/u/Jotta/Sync/sub/c').size == 7
+            assert tree.lookup(u'/u/Jotta/Sync/c') is None
+            assert tree.lookup(u'/u/Jotta/Nope/c') is None
+            assert [p for p, f in tree.by_md5(md5)] == [u'/u/Jotta/Sync', u'/u/Jotta/Sync/sub']
+        assert tree.total_size() == 12
+        assert tree.folder_sizes()[u'/u/Jotta/Sync'] == 5
+        assert tree.folder_sizes(recursive=True) == {u'/u/Jotta/Sync': 12, u'/u/Jotta/Sync/sub': 7, u'/u/Jotta/Sync/empty': 0}
+        assert tree.state_counts() == {u'COMPLETED': 2, u'CORRUPT': 1}
+        with pytest.raises(ValueError):
+            tree.append(u'/u/Jotta/Sync/sub', [])
+
+
+class TestRemoteIndex:
+    'Tests for jottalib.index'
+
+    def test_refresh_and_query(self, tmpdir):
+        from jottalib.index import RemoteIndex
+        folder = '/Jotta/Archive/test_remoteindex'
+        p = posixpath.join(folder, 'sub', 'testfile_index.txt')
+        t = jfs.up(p, six.BytesIO(TESTFILEDATA))
+        index = RemoteIndex(jfs, str(tmpdir.join('index.sqlite')))
+        assert index.refresh(folder) == 1
+        f = index.lookup(p)
+        assert f.size == len(TESTFILEDATA)
+        assert f.md5 == t.md5
+        assert f.uuid == t.uuid
+        assert isinstance(f.modified, datetime.datetime)
+        assert index.files(folder, md5=t.md5) == [f]
+        assert index.files(folder, minsize=len(TESTFILEDATA)+1) == []
+        assert index.folders(folder) == [folder, posixpath.join(folder, 'sub')]
+        assert index.total_size(folder) == len(TESTFILEDATA)
+        assert index.refreshed(p) is not None
+        # refresh just the subfolder, and see that the index follows
+        t.delete()
+        assert index.refresh(posixpath.join(folder, 'sub')) == 0
+        assert index.lookup(p) is None
+        assert index.stats()['refreshes'] == 2
+        jfs.getObject(folder).delete()
+        index.close()
+
+
+@pytest.mark.skipif(HAS_AIOHTTP==False,
+                    reason="requires aiohttp")
+class TestAsyncJFS:
+    'Tests for jottalib.aio'
+
+    def test_up_getObject_and_stream(self):
+        import asyncio
+        from jottalib import aio
+        loop = asyncio.new_event_loop()
+        ajfs = aio.AsyncJFS()
+        p = "/Jotta/Archive/testfile_async_up_and_stream.txt"
+        try:
+            loop.run_until_complete(ajfs.login())
+            t = loop.run_until_complete(ajfs.up(p, six.BytesIO(TESTFILEDATA)))
+            assert isinstance(t, JFS.JFSFile)
+            objs = loop.run_until_complete(asyncio.gather(*[ajfs.getObject(p) for _ in range(5)]))
+            assert all(o.md5 == t.md5 for o in objs)
+            folder = loop.run_until_complete(ajfs.getObject('/Jotta/Archive'))
+            assert isinstance(folder, aio.AsyncJFSFolder)
+            assert t.name in [f.name for f in loop.run_until_complete(folder.files())]
+            stream = t.stream()
+            chunks = []
+            while True:
+                try:
+                    chunks.append(loop.run_until_complete(stream.__anext__()))
+                except StopAsyncIteration:
+                    break
+            assert b"".join(chunks) == TESTFILEDATA
+        finally:
+            jfs.getObject(p).delete()
+            loop.run_until_complete(ajfs.close())
+            loop.close()
+
+
+class TestObjectCache:
+    'Tests for jottalib.cache'
+
+    def test_lru_and_ttl(self):
+        from jottalib.cache import ObjectCache
+        import time
+        c = ObjectCache(maxentries=2, maxbytes=100, ttl=0.1)
+        c.put('https://host/a', 1, size=10)
+        c.put('https://host/b', 2, size=10)
+        assert c.get('https://host/a') == 1 # now b is the oldest
+        c.put('https://host/c', 3, size=10)
+        assert c.get('https://host/b') is None
+        c.put('https://host/d', 4, size=95) # too big to keep the others
+        assert len(c) == 1
+        time.sleep(0.2)
+        assert c.get('https://host/d') is None
+
+    def test_invalidate(self):
+        from jottalib.cache import ObjectCache
+        c = ObjectCache()
+        for p in ('/u', '/u/Jotta', '/u/Jotta/Archive', '/u/Jotta/Archive/x', '/u/Jotta/Archive/x/y',
+                  '/u/Jotta/Archive/x-y', '/u/Jotta/Sync'):
+            c.put('https://www.jottacloud.com/jfs' + p, p)
+        c.put('https://www.jottacloud.com/jfs/u/Jotta/Archive/x', 'x', params={'mode':'list'})
+        c.invalidate('https://up.jottacloud.com/jfs/u/Jotta/Archive/x')
+        left = sorted(k[0] for k in c._keys)
+        assert left == ['https://www.jottacloud.com/jfs/u/Jotta/Archive/x-y',
+                        'https://www.jottacloud.com/jfs/u/Jotta/Sync']
+
 
 class TestJFSError:
     'Test different JFSErrors'
@@ -515,7 +745,7 @@ class TestJFSError:
     """
     def test_errors(self):
         with pytest.raises(JFS.JFSCredentialsError): # HTTP 401
-            JFS.JFS(auth=('PYTEST','PYTEST'))
+            JFS.JFS(auth=('PYTEST','PYTEST')).login() # nothing is fetched before we ask
         with pytest.raises(JFS.JFSNotFoundError): # HTTP 404
             jfs.get('/Jotta/Archive/FileNot.found')
         with pytest.raises(JFS.JFSRangeError): # HTTP 416
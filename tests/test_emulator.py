@@ -0,0 +1,918 @@
+# -*- encoding: utf-8 -*-
+'Tests for jottalib against the offline JottaCloud emulator in jfsemulator.py'
+#
+# This file is part of jottalib.
+#
+# jottalib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# jottalib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with jottafs.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2016 Håvard Gulldahl <havard@gulldahl.no>
+
+# metadata
+__author__ = 'havard@gulldahl.no'
+
+# import standardlib
+import os, time, hashlib, datetime, threading
+import six
+
+# import py.test
+import pytest # pip install pytest
+import requests_toolbelt
+
+# import jotta
+from jottalib import JFS
+from jottalib.retry import RetryPolicy, CircuitBreaker
+from jottalib.throttle import TokenBucket, GLOBAL_DOWNLOAD
+from jottalib.cache import ObjectCache
+from jottalib.checkpoint import CheckpointStore
+from jottalib.multipart import MultipartBody
+from jottalib.readahead import ReadAhead, WaitCounter
+from jottalib import jottacloud
+from jfsemulator import Emulator, aio
+
+TESTFILEDATA = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 1000
+
+
+@pytest.fixture
+def emu():
+    emulator = Emulator().start()
+    yield emulator
+    emulator.stop()
+
+@pytest.fixture(params=['requests', 'urllib3'])
+def jfs(emu, request):
+    return emu.client(transport=request.param)
+
+
+class TestEmulator:
+    'Tests for the emulated api, through JFS'
+
+    def test_login(self, emu, jfs):
+        assert jfs.username == emu.username
+        assert [d.name for d in jfs.devices] == ['Jotta']
+        assert sorted(jfs.getObject('/Jotta').mountPoints.keys()) == ['Archive', 'Shared', 'Sync']
+        with pytest.raises(JFS.JFSCredentialsError):
+            emu.client(auth=(emu.username, 'wrong')).login()
+
+    def test_topology(self, emu):
+        jfs = emu.client()
+        assert emu.stats['requests'] == 0 # we log in when we need to
+        sync = jfs.getFolder('/Jotta/Sync')
+        assert isinstance(sync, JFS.JFSMountPoint)
+        assert sync.path == jfs.rootpath + '/Jotta/Sync'
+        assert isinstance(jfs.getFolder('/Jotta/Sync/a/b'), JFS.JFSFolder)
+        assert emu.stats['requests'] == 0
+        emu.add_file('/Jotta/Sync/x.txt', b'x')
+        assert [f.name for f in sync.files()] == ['x.txt']
+        assert emu.stats['requests'] == 1
+        # devices are fetched once, and their mountpoints when asked for
+        devices = jfs.devices
+        assert jfs.devices == devices
+        assert emu.stats['GET user'] == 1
+        assert emu.stats['GET device'] == 0
+        assert sorted(devices[0].mountPoints) == ['Archive', 'Shared', 'Sync']
+        assert sorted(devices[0].mountPoints) == ['Archive', 'Shared', 'Sync']
+        assert emu.stats['GET device'] == 1
+        jfs.new_device('Laptop', 'laptop')
+        assert [d.name for d in jfs.devices] == ['Jotta', 'Laptop']
+
+    def test_up_and_read(self, emu, jfs):
+        p = u'/Jotta/Archive/test_emulator/ø.txt'
+        f = jfs.up(p, six.BytesIO(TESTFILEDATA))
+        assert isinstance(f, JFS.JFSFile)
+        assert f.path == jfs.rootpath + p
+        assert f.md5 == hashlib.md5(TESTFILEDATA).hexdigest()
+        assert f.size == len(TESTFILEDATA)
+        assert isinstance(f.modified, datetime.datetime)
+        assert f.read() == TESTFILEDATA
+        assert f.readpartial(10, 100) == TESTFILEDATA[10:100]
+        assert b''.join(f.stream(workers=4, range_size=10000)) == TESTFILEDATA
+        assert [x.name for x in jfs.getObject(u'/Jotta/Archive/test_emulator').files()] == [u'ø.txt']
+        assert emu.stats['POST up'] == 1
+
+    def test_streaming_up(self, emu, jfs, tmpdir):
+        archive = jfs.getObject('/Jotta/Archive')
+        # a generator
+        f = archive.up((TESTFILEDATA[i:i+1000] for i in range(0, len(TESTFILEDATA), 1000)), 'gen.txt')
+        assert f.md5 == hashlib.md5(TESTFILEDATA).hexdigest()
+        assert f.read() == TESTFILEDATA
+        # a pipe
+        r, w = os.pipe()
+        def write():
+            with os.fdopen(w, 'wb') as pipe:
+                pipe.write(TESTFILEDATA)
+        t = threading.Thread(target=write)
+        t.start()
+        with os.fdopen(r, 'rb') as pipe:
+            assert not JFS.seekable(pipe)
+            f = archive.up(pipe, 'pipe.txt')
+        t.join()
+        assert f.size == len(TESTFILEDATA)
+        assert f.read() == TESTFILEDATA
+        with pytest.raises(JFS.JFSError):
+            archive.up(42, 'int.txt')
+        # big ones are spooled to disk
+        md5, spool = JFS.spool_and_hash(JFS.IterableReader([TESTFILEDATA]), max_memory=1000, directory=str(tmpdir))
+        assert not isinstance(spool, six.BytesIO)
+        assert spool.read() == TESTFILEDATA
+
+    def test_folders(self, emu, jfs):
+        archive = jfs.getObject('/Jotta/Archive')
+        folder = archive.mkdir('new')
+        assert isinstance(folder, JFS.JFSFolder)
+        folder.up(six.BytesIO(b'hello'), 'hello.txt')
+        moved = folder.rename('/Jotta/Archive/moved')
+        assert moved.name == 'moved'
+        with pytest.raises(JFS.JFSNotFoundError):
+            jfs.getObject('/Jotta/Archive/new')
+        f = jfs.getObject('/Jotta/Archive/moved/hello.txt').rename('/Jotta/Archive/moved/hi.txt')
+        assert f.read() == b'hello'
+        d = f.delete()
+        assert d.is_deleted()
+        assert jfs.getObject('/Jotta/Archive/moved').delete().is_deleted()
+
+    def test_folder_changes(self, emu, jfs):
+        folder = jfs.getObject('/Jotta/Archive').mkdir('bulk')
+        assert list(folder.files()) == []
+        gets = emu.stats['GET folder']
+        for i in range(20):
+            folder.up(six.BytesIO(b'x' * i), 'f%02d.txt' % i)
+        folder.up(six.BytesIO(b'new'), 'f00.txt')
+        sub = folder.mkdir('sub')
+        # the folder keeps up by itself, without fetching itself again
+        assert emu.stats['GET folder'] == gets
+        names = [f.name for f in folder.files()]
+        assert names == ['f%02d.txt' % i for i in range(20)]
+        assert [f.name for f in folder.folders()] == ['sub']
+        folder.sync()
+        assert sorted(f.name for f in folder.files()) == names
+        assert next(folder.files()).read() == b'new'
+        # a deleted folder is fetched again on next read
+        sub.delete()
+        assert sub.is_deleted()
+        assert emu.stats['GET folder'] == gets + 1
+        assert list(sub.files()) == []
+        assert emu.stats['GET folder'] == gets + 2
+
+    def test_getobjects(self, emu, jfs):
+        for i in range(10):
+            emu.add_file('/Jotta/Archive/many/%s.txt' % i, b'x' * i)
+        emu.mkdirs('/Jotta/Archive/many/sub')
+        emu.fail(method='POST', path='incomplete.txt', after=1000)
+        with pytest.raises(Exception):
+            emu.client(retry=False).up('/Jotta/Archive/many/incomplete.txt', six.BytesIO(TESTFILEDATA))
+        paths = ['/Jotta/Archive/many/%s.txt' % i for i in range(10)]
+        paths += ['/Jotta/Archive/many/sub', '/Jotta/Archive/many/incomplete.txt', '/Jotta/Archive/many/nope.txt',
+                  '/Jotta/Archive/nowhere/nope.txt', '/Jotta/Archive/nowhere/nada.txt', '/Jotta/Archive/single/nope.txt']
+        requests = emu.stats['requests']
+        found = jfs.getObjects(paths)
+        # the listing of many/, the incomplete file on its own, nowhere/ and single/nope.txt
+        assert emu.stats['requests'] == requests + 4
+        assert sorted(found) == sorted(paths[:12])
+        assert [found[p].size for p in paths[:10]] == list(range(10))
+        assert found[paths[3]].read() == b'xxx'
+        assert isinstance(found['/Jotta/Archive/many/sub'], JFS.JFSFolder)
+        incomplete = found['/Jotta/Archive/many/incomplete.txt']
+        assert isinstance(incomplete, JFS.JFSIncompleteFile)
+        assert 0 < incomplete.size < len(TESTFILEDATA)
+
+    def test_filedirlist(self, emu, jfs):
+        for i in range(10):
+            emu.add_file('/Jotta/Sync/a/%s.txt' % i, b'x' * i)
+            emu.add_file('/Jotta/Sync/a/b/%s.txt' % i, b'y' * i)
+        fdl = jfs.getObject('/Jotta/Sync', params={'mode':'list'})
+        assert isinstance(fdl, JFS.JFSFileDirList)
+        streamed = dict(jfs.iterfiledirlist('/Jotta/Sync'))
+        assert streamed == fdl.tree
+        assert len(streamed[jfs.rootpath[len(JFS.JFS_ROOT)-1:] + '/Jotta/Sync/a/b']) == 10
+        # jottacloud.iter_tree() yields folder paths, like it always did
+        assert list(jottacloud.iter_tree('/Jotta/Sync', jfs)) == list(fdl.tree)
+        assert dict(jottacloud.iter_tree_files('/Jotta/Sync', jfs)) == fdl.tree
+
+    def test_deprecated_xml(self, emu, jfs):
+        emu.add_file('/Jotta/Sync/a/x.txt', b'x')
+        folder = jfs.getObject('/Jotta/Sync/a')
+        # the xml isn't kept any more, so the old attributes fetch it again, and say so
+        with pytest.deprecated_call():
+            assert folder.folder.get('name') == 'a'
+        with pytest.deprecated_call():
+            assert next(folder.files()).f.get('name') == 'x.txt'
+        with pytest.deprecated_call():
+            assert jfs.getObject('/Jotta').dev.name == 'Jotta'
+        with pytest.raises(JFS.JFSError):
+            jfs.getObject('/Jotta/Sync', params={'mode':'list'}).filedirlist
+
+    def test_filedirlist_broken(self, emu, jfs):
+        for folder in 'abcdef':
+            for i in range(50):
+                emu.add_file('/Jotta/Sync/%s/%s.txt' % (folder, i), b'x' * i)
+        whole = list(jfs.iterfiledirlist('/Jotta/Sync'))
+        # a listing that breaks off is asked for again, and each folder is yielded once
+        emu.fail(method='GET', path='Jotta/Sync$', after=60000) # half way
+        emu.reset_stats()
+        assert list(jfs.iterfiledirlist('/Jotta/Sync')) == whole
+        assert emu.stats['requests'] == 2
+        emu.fail(method='GET', path='Jotta/Sync$', after=60000, times=-1)
+        with pytest.raises(JFS.JFSError) as e:
+            list(jfs.iterfiledirlist('/Jotta/Sync', retries=1))
+        assert 'incomplete' in str(e.value)
+
+    def test_latest_and_search(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/old.txt', b'old')
+        time.sleep(0.01)
+        jfs.up('/Jotta/Sync/new.txt', six.BytesIO(b'new'))
+        assert [f.name for f in jfs.getLatest(files=1)] == ['new.txt']
+        result = jfs.getObject('/Jotta/Archive', params={'search': 'OLD'})
+        assert [f.name for f in result.files()] == ['old.txt']
+
+    def test_resume(self, emu, jfs):
+        p = '/Jotta/Archive/resumed.bin'
+        emu.fail(method='POST', path='resumed.bin', after=len(TESTFILEDATA)//2)
+        with pytest.raises(Exception):
+            emu.client(retry=False).up(p, six.BytesIO(TESTFILEDATA))
+        incomplete = jfs.getObject(p)
+        assert isinstance(incomplete, JFS.JFSIncompleteFile)
+        assert 0 < incomplete.size < len(TESTFILEDATA)
+        f = incomplete.resume(six.BytesIO(TESTFILEDATA))
+        assert isinstance(f, JFS.JFSFile)
+        assert f.read() == TESTFILEDATA
+
+    def test_failures(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/fail.txt', TESTFILEDATA)
+        emu.fail(method='GET', path='fail.txt', status=500)
+        with pytest.raises(JFS.JFSError):
+            emu.client(retry=False).getObject('/Jotta/Archive/fail.txt')
+        f = jfs.getObject('/Jotta/Archive/fail.txt')
+        # a download that breaks off is resumed from where it stopped
+        emu.fail(method='GET', path='fail.txt', after=1000)
+        assert f.download(six.BytesIO(), workers=1) == len(TESTFILEDATA)
+        assert emu.stats['hangups'] == 1
+        emu.fail(method='GET', status=404, times=-1)
+        with pytest.raises(JFS.JFSNotFoundError):
+            emu.client().getObject('/Jotta/Archive/fail.txt') # jfs has it cached
+
+    def test_stall(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/stall.bin', TESTFILEDATA)
+        f = jfs.getObject('/Jotta/Archive/stall.bin')
+        # the server goes quiet halfway, and we pick up from there on a new connection
+        emu.fail(method='GET', path='stall.bin', after=20000, stall=5)
+        started = time.time()
+        assert b''.join(f.stream(chunk_size=8192, stall_timeout=0.5)) == TESTFILEDATA
+        assert time.time() - started < 3
+        assert [q.get('mode') for m, host, path, q in emu.log].count('bin') == 2
+        # and the same for an open ended stream, and for ranges fetched in parallel
+        emu.fail(method='GET', path='stall.bin', after=30000, stall=5)
+        assert b''.join(jfs.stream(f.path, params={'mode':'bin'}, stall_timeout=0.5)) == TESTFILEDATA
+        emu.fail(method='GET', path='stall.bin', after=100, stall=5)
+        assert b''.join(f.stream(workers=3, range_size=10000, stall_timeout=0.5)) == TESTFILEDATA
+        # a slow download isn't a stalled one, even if a chunk takes longer than stall_timeout
+        data = TESTFILEDATA * 3
+        emu.add_file('/Jotta/Archive/slow.bin', data)
+        slow = jfs.getObject('/Jotta/Archive/slow.bin')
+        emu.reset_stats()
+        emu.bandwidth = 64*1024 # 16k every 0.25s
+        assert b''.join(slow.stream(chunk_size=48000, stall_timeout=0.5)) == data # 0.75s a chunk
+        buf = bytearray(len(data))
+        assert jfs.readinto(slow.path, buf, params={'mode':'bin'}, chunk_size=48000, stall_timeout=0.5) == len(buf)
+        assert buf == data
+        assert emu.stats['GET bin'] == 2
+        emu.bandwidth = None
+        # but we give up on a server that never gets anywhere
+        emu.fail(method='GET', path='stall.bin', after=0, times=-1)
+        with pytest.raises(Exception):
+            b''.join(f.stream(stall_timeout=0.5))
+
+    def test_stream_ranges_stopped(self, emu, jfs):
+        data = TESTFILEDATA * 4
+        emu.add_file('/Jotta/Archive/ranges.bin', data)
+        f = jfs.getObject('/Jotta/Archive/ranges.bin')
+        ended = []
+        getrange = jfs.getrange
+        def recording(*args, **kwargs):
+            try:
+                ended.append(getrange(*args, **kwargs))
+            except JFS.JFSError as e:
+                ended.append(e)
+                raise
+        jfs.getrange = recording
+        emu.bandwidth = 100*1024 # a range takes half a second
+        chunks = f.stream(chunk_size=1024, workers=3, range_size=50000)
+        assert next(chunks) == data[:1024] # the first range comes as it arrives
+        chunks.close()
+        for _ in range(50):
+            if len(ended) == 3:
+                break
+            time.sleep(0.1)
+        # and when we stop, the ranges in flight stop too
+        assert len(ended) == 3 and all(isinstance(e, JFS.JFSError) for e in ended)
+
+    def test_readinto(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/readinto.bin', TESTFILEDATA)
+        f = jfs.getObject('/Jotta/Archive/readinto.bin')
+        buf = bytearray(10000)
+        assert f.readinto(buf, 1000) == 10000
+        assert buf == TESTFILEDATA[1000:11000]
+        # reads into a part of a buffer, and stops at the end of the file
+        assert f.readinto(memoryview(buf)[100:], len(TESTFILEDATA) - 50) == 50
+        assert buf[100:150] == TESTFILEDATA[-50:]
+        assert f.readinto(buf, len(TESTFILEDATA)) == 0
+        # every range was read to the end, so it's all one connection
+        assert jfs.poolstats()['www']['created'] == 1
+        # and a download that breaks off is resumed from where it stopped
+        emu.fail(method='GET', path='readinto.bin', after=2000)
+        assert f.readinto(buf) == 10000
+        assert buf == TESTFILEDATA[:10000]
+        assert emu.stats['hangups'] == 1
+
+    def test_download_to(self, emu, jfs, tmpdir):
+        emu.add_file('/Jotta/Archive/download.bin', TESTFILEDATA)
+        f = jfs.getObject('/Jotta/Archive/download.bin')
+        p = str(tmpdir.join('download.bin'))
+        with open(p, 'wb') as fh:
+            fh.write(b'x' * 100000) # more than we get, so it must be cut to size
+        progress = []
+        assert f.download_to(p, workers=3, range_size=10000,
+                             callback=lambda written, size: progress.append(written)) == len(TESTFILEDATA)
+        with open(p, 'rb') as fh:
+            assert fh.read() == TESTFILEDATA
+        assert progress[-1] == len(TESTFILEDATA)
+        # ranges that stall are picked up where they stopped
+        emu.fail(method='GET', path='download.bin', after=5000, stall=5)
+        assert f.download_to(p, workers=2, range_size=20000, stall_timeout=0.5, keep_cache=False) == len(TESTFILEDATA)
+        with open(p, 'rb') as fh:
+            assert fh.read() == TESTFILEDATA
+        # a file descriptor we can't map is written to from buffers
+        fd = os.open(p, os.O_WRONLY | os.O_TRUNC)
+        try:
+            assert f.download_to(fd, workers=2, range_size=10000) == len(TESTFILEDATA)
+        finally:
+            os.close(fd)
+        with open(p, 'rb') as fh:
+            assert fh.read() == TESTFILEDATA
+        # one worker gets it all in one request, mapped or not
+        for path_or_fd in (p, os.open(p, os.O_WRONLY | os.O_TRUNC)):
+            emu.reset_stats()
+            try:
+                assert f.download_to(path_or_fd, workers=1, range_size=10000) == len(TESTFILEDATA)
+            finally:
+                if not isinstance(path_or_fd, str):
+                    os.close(path_or_fd)
+            assert emu.stats['GET bin'] == 1
+            with open(p, 'rb') as fh:
+                assert fh.read() == TESTFILEDATA
+
+    def test_single_flight(self, emu):
+        jfs = emu.client(cache=False)
+        emu.latency = 0.3
+        go = threading.Event()
+        results = []
+        def fetch(path):
+            go.wait()
+            try:
+                results.append(jfs.getObject(path).name)
+            except JFS.JFSNotFoundError as e:
+                results.append(e)
+        threads = [threading.Thread(target=fetch, args=('/Jotta/Archive', )) for _ in range(8)]
+        threads += [threading.Thread(target=fetch, args=('/Jotta/Archive/nope', )) for _ in range(4)]
+        for t in threads:
+            t.start()
+        go.set()
+        for t in threads:
+            t.join()
+        assert results.count('Archive') == 8
+        assert len([r for r in results if isinstance(r, JFS.JFSNotFoundError)]) == 4
+        assert emu.stats['GET mountPoint'] == 1
+        assert jfs.flights.stats() == {'calls': 2, 'shared': 10, 'in flight': 0}
+        # and one after the other, they're separate requests
+        jfs.getObject('/Jotta/Archive')
+        assert emu.stats['GET mountPoint'] == 2
+
+    def test_notfound(self, emu, jfs):
+        requests = emu.stats['requests']
+        for _ in range(3):
+            with pytest.raises(JFS.JFSNotFoundError):
+                jfs.getObject('/Jotta/Archive/ghost')
+            with pytest.raises(JFS.JFSNotFoundError):
+                jfs.getObject('/Jotta/Archive/ghost/boo.txt')
+        assert emu.stats['requests'] == requests + 2
+        assert jfs.notfound.stats()['hits'] == 4
+        # creating something makes it, and the folders above it, exist
+        jfs.up('/Jotta/Archive/ghost/boo.txt', six.BytesIO(b'boo'))
+        assert jfs.getObject('/Jotta/Archive/ghost/boo.txt').read() == b'boo'
+        assert jfs.getObject('/Jotta/Archive/ghost').name == 'ghost'
+        # and things that are created elsewhere show up when we have forgotten
+        jfs = emu.client(notfound_ttl=0.2)
+        with pytest.raises(JFS.JFSNotFoundError):
+            jfs.getObject('/Jotta/Archive/elsewhere.txt')
+        emu.add_file('/Jotta/Archive/elsewhere.txt', b'hi')
+        with pytest.raises(JFS.JFSNotFoundError):
+            jfs.getObject('/Jotta/Archive/elsewhere.txt')
+        time.sleep(0.2)
+        assert jfs.getObject('/Jotta/Archive/elsewhere.txt').read() == b'hi'
+
+    def test_object_cache(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/cached.txt', b'cached')
+        # nothing is cached unless you ask for it
+        requests = emu.stats['requests']
+        for _ in range(3):
+            assert jfs.getObject('/Jotta/Archive/cached.txt').name == 'cached.txt'
+        assert emu.stats['requests'] == requests + 3
+        jfs = emu.client(cache=True)
+        requests = emu.stats['requests']
+        for _ in range(3):
+            assert jfs.getObject('/Jotta/Archive/cached.txt').name == 'cached.txt'
+        assert emu.stats['requests'] == requests + 1
+        assert jfs.cache.maxentries > 0
+        # hard_delete() posts somewhere else, but the file is gone from the cache all the same
+        f = jfs.getObject('/Jotta/Archive/cached.txt')
+        jfs.post = lambda url, **kwargs: None # webrest isn't emulated
+        f.hard_delete()
+        assert jfs.cache.get(f.path) is None
+        # a cache of our own is used as it is, empty or not
+        jfs = emu.client(cache=ObjectCache(ttl=600))
+        assert jfs.cache.ttl == 600
+        requests = emu.stats['requests']
+        for _ in range(3):
+            jfs.getObject('/Jotta/Archive/cached.txt')
+        assert emu.stats['requests'] == requests + 1
+        # and cache=False turns it off
+        jfs = emu.client(cache=False)
+        requests = emu.stats['requests']
+        for _ in range(3):
+            jfs.getObject('/Jotta/Archive/cached.txt')
+        assert emu.stats['requests'] == requests + 3
+
+    def test_cache_during_post(self, emu, jfs):
+        emu.mkdirs('/Jotta/Archive/busy')
+        assert list(jfs.getObject('/Jotta/Archive/busy').files()) == []
+        # somebody looks at the folder while we're uploading to it
+        request = jfs.transport.request
+        def meanwhile(method, url, **kwargs):
+            if method == 'POST':
+                jfs.cache.invalidate(jfs.rootpath + '/Jotta/Archive/busy')
+                assert list(jfs.getObject('/Jotta/Archive/busy').files()) == []
+            return request(method, url, **kwargs)
+        jfs.transport.request = meanwhile
+        jfs.up('/Jotta/Archive/busy/new.txt', six.BytesIO(b'new'))
+        jfs.transport.request = request
+        # and what they cached from before the upload is gone
+        assert [f.name for f in jfs.getObject('/Jotta/Archive/busy').files()] == ['new.txt']
+
+    def test_httpcache(self, emu, tmpdir):
+        emu.add_file('/Jotta/Archive/cached.txt', b'cached')
+        # a server with validators is asked every time, but only sends what has changed
+        emu.etags = True
+        for _ in range(2):
+            jfs = emu.client(httpcache=str(tmpdir.join('etags'))) # e.g. another process
+            assert jfs.getObject('/Jotta/Archive/cached.txt').read() == b'cached'
+        assert emu.stats['not modified'] == 1
+        assert jfs.httpcache.stats()['revalidated'] == 1
+        assert emu.stats['gzipped'] > 0
+        # without them, we trust what we have for a while
+        emu.etags = False
+        jfs = emu.client(httpcache=str(tmpdir.join('ttl')))
+        jfs.getObject('/Jotta/Archive')
+        jfs = emu.client(httpcache=str(tmpdir.join('ttl')))
+        requests = emu.stats['requests']
+        folder = jfs.getObject('/Jotta/Archive')
+        assert 'cached.txt' in [f.name for f in folder.files()]
+        assert emu.stats['requests'] == requests
+        # and forget it when we change something
+        jfs.up('/Jotta/Archive/new.txt', six.BytesIO(b'new'))
+        jfs.cache.clear()
+        assert 'new.txt' in [f.name for f in jfs.getObject('/Jotta/Archive').files()]
+        # also where the path has to be escaped
+        for folder in (u'/Jotta/Archive/My Folder', u'/Jotta/Archive/blå'):
+            emu.mkdirs(folder)
+            assert list(jfs.getObject(folder).files()) == []
+            jfs.up(folder + '/new.txt', six.BytesIO(b'new'))
+            jfs.cache.clear()
+            assert [f.name for f in jfs.getObject(folder).files()] == ['new.txt']
+        # and a name that only looks escaped is a name of its own
+        emu.mkdirs(u'/Jotta/Archive/A')
+        emu.mkdirs(u'/Jotta/Archive/%41')
+        assert list(jfs.getObject(u'/Jotta/Archive/A').files()) == []
+        assert list(jfs.getObject(u'/Jotta/Archive/%41').files()) == []
+        jfs.up(u'/Jotta/Archive/%41/new.txt', six.BytesIO(b'new'))
+        requests = emu.stats['requests']
+        assert list(jfs.getObject(u'/Jotta/Archive/A').files()) == [] # still cached
+        assert emu.stats['requests'] == requests
+        assert [f.name for f in jfs.getObject(u'/Jotta/Archive/%41').files()] == ['new.txt']
+
+    def test_checkpoint(self, emu, tmpdir, monkeypatch):
+        localfile = tmpdir.join('big.bin')
+        localfile.write_binary(TESTFILEDATA)
+        localfile = str(localfile)
+        checkpoints = CheckpointStore(str(tmpdir.join('checkpoints.sqlite')))
+        jfs = emu.client(retry=False)
+        emu.fail(method='POST', path='big.bin', after=20000)
+        with pytest.raises(Exception):
+            jottacloud.new(localfile, '/Jotta/Archive/big.bin', jfs, checkpoints=checkpoints)
+        assert [c.md5 for c in checkpoints.pending()] == [hashlib.md5(TESTFILEDATA).hexdigest()]
+        # the next time, we know the hash, and send only what's missing
+        def rehash(fileobject):
+            raise AssertionError('the file was hashed again')
+        monkeypatch.setattr(jottacloud, 'calculate_md5', rehash)
+        monkeypatch.setattr(JFS, 'calculate_md5', rehash)
+        jfs.cache.clear()
+        f = jottacloud.new(localfile, '/Jotta/Archive/big.bin', jfs, checkpoints=checkpoints)
+        assert emu.stats['upload resumed'] == 1
+        assert f.read() == TESTFILEDATA
+        assert checkpoints.pending() == []
+        assert checkpoints.hits == 1
+        # and a file that has changed since is hashed again
+        checkpoints.record(localfile, '/Jotta/Archive/big.bin', 'stale')
+        with open(localfile, 'ab') as lf:
+            lf.write(b'more')
+        assert checkpoints.lookup(localfile) is None
+        assert checkpoints.pending() == []
+
+    def test_new_hashes_in_place(self, emu, tmpdir, monkeypatch):
+        localfile = tmpdir.join('inplace.bin')
+        localfile.write_binary(TESTFILEDATA)
+        def spool(*args, **kwargs):
+            raise AssertionError('a local file was spooled')
+        monkeypatch.setattr(JFS, 'spool_and_hash', spool)
+        f = jottacloud.new(str(localfile), '/Jotta/Archive/inplace.bin', emu.client())
+        assert f.md5 == hashlib.md5(TESTFILEDATA).hexdigest()
+        assert f.read() == TESTFILEDATA
+
+    def test_changed_after_interruption(self, emu, tmpdir):
+        localfile = tmpdir.join('changing.bin')
+        localfile.write_binary(TESTFILEDATA)
+        localfile = str(localfile)
+        checkpoints = CheckpointStore(str(tmpdir.join('checkpoints.sqlite')))
+        emu.fail(method='POST', path='changing.bin', after=20000)
+        with pytest.raises(Exception):
+            jottacloud.new(localfile, '/Jotta/Archive/changing.bin', emu.client(retry=False), checkpoints=checkpoints)
+        with open(localfile, 'wb') as lf:
+            lf.write(b'something else')
+        # the incomplete file is not what we have now, so we upload what we have
+        jfs = emu.client()
+        assert isinstance(jfs.getObject('/Jotta/Archive/changing.bin'), JFS.JFSIncompleteFile)
+        f = jottacloud.new(localfile, '/Jotta/Archive/changing.bin', jfs, checkpoints=checkpoints)
+        assert f.read() == b'something else'
+        assert emu.stats['upload resumed'] == 0
+
+    def test_latency_and_bandwidth(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/slow.bin', b'0' * 100000)
+        f = jfs.getObject('/Jotta/Archive/slow.bin')
+        emu.latency = 0.2
+        emu.bandwidth = 500000
+        started = time.time()
+        assert len(f.read()) == 100000
+        assert time.time() - started >= 0.2 + 0.19 # latency, and 100kB at 500kB/s
+
+
+class TestRetryPolicy:
+    'Tests for jottalib.retry, against the emulator'
+
+    def test_retry(self, emu):
+        jfs = emu.client(retry=RetryPolicy(backoff=0.01))
+        emu.add_file('/Jotta/Archive/flaky.txt', TESTFILEDATA)
+        emu.fail(method='GET', path='flaky.txt', status=503, times=2)
+        assert jfs.getObject('/Jotta/Archive/flaky.txt').read() == TESTFILEDATA
+        assert jfs.retry.stats()['retries'] == 2
+        # not found is not worth another try
+        with pytest.raises(JFS.JFSNotFoundError):
+            jfs.getObject('/Jotta/Archive/nope.txt')
+        assert jfs.retry.stats()['retries'] == 2
+        # and we give up, eventually
+        emu.fail(method='GET', path='flaky.txt', status=500, times=-1)
+        with pytest.raises(JFS.JFSServerError):
+            jfs.getObject('/Jotta/Archive/flaky.txt').read()
+        assert jfs.retry.stats()['giveups'] == 1
+
+    def test_retry_after(self, emu):
+        jfs = emu.client(retry=RetryPolicy(backoff=0.01))
+        emu.fail(method='GET', path='Archive', status=429, retry_after=0.3)
+        started = time.time()
+        jfs.getObject('/Jotta/Archive')
+        assert time.time() - started >= 0.3
+        assert jfs.retry.stats()['backoff_time'] == 0.3
+
+    def test_idempotency(self, emu):
+        jfs = emu.client(retry=RetryPolicy(backoff=0.01))
+        # uploads are safe to repeat, and the file is rewound for every attempt
+        emu.fail(method='POST', path='up.txt', status=500)
+        f = jfs.up('/Jotta/Archive/up.txt', six.BytesIO(TESTFILEDATA))
+        assert f.read() == TESTFILEDATA
+        assert [m for m, host, path, q in emu.log].count('POST') == 2
+        # moves aren't
+        emu.fail(method='POST', path='up.txt', status=500)
+        with pytest.raises(JFS.JFSError):
+            f.rename('/Jotta/Archive/moved.txt')
+        assert jfs.retry.stats()['retries'] == 1
+        # unless the server tells us that it didn't do anything
+        emu.fail(method='POST', path='up.txt', status=503)
+        assert f.rename('/Jotta/Archive/moved.txt').name == 'moved.txt'
+
+    def test_circuit_breaker(self, emu):
+        breaker = CircuitBreaker(window=4, threshold=0.5, pause=0.3)
+        jfs = emu.client(retry=RetryPolicy(retries=0, breaker=breaker))
+        jfs.login()
+        emu.fail(method='GET', path='Archive', status=500, times=2)
+        for _ in range(2):
+            with pytest.raises(JFS.JFSError):
+                jfs.getObject('/Jotta/Archive')
+            jfs.cache.clear()
+        assert breaker.state == 'closed' # we need a full window before we judge
+        jfs.getObject('/Jotta/Sync') # login, two failures and this one: half of them failed
+        assert breaker.state == 'open'
+        started = time.time()
+        jfs.getObject('/Jotta/Archive') # waits, and then probes
+        assert time.time() - started >= 0.25
+        assert breaker.state == 'closed'
+        assert jfs.retry.stats()['breaker_trips'] == 1
+        assert jfs.retry.stats()['breaker_time'] >= 0.25
+
+    def test_circuit_breaker_probe(self):
+        breaker = CircuitBreaker(window=2, threshold=0.5, pause=0.1, probe_timeout=1)
+        retry = RetryPolicy(retries=0, breaker=breaker)
+        breaker.record(False)
+        breaker.record(False)
+        assert breaker.state == 'open'
+        def interrupted():
+            raise KeyboardInterrupt()
+        class OK(object): # a response
+            status_code = 200
+        with pytest.raises(KeyboardInterrupt): # the probe dies
+            retry.call(interrupted)
+        assert breaker.state == 'open' # and someone else gets to probe
+        assert retry.call(OK).status_code == 200
+        assert breaker.state == 'closed'
+        # a probe that never reports back holds the others up for probe_timeout, no longer
+        breaker.record(False)
+        breaker.record(False)
+        time.sleep(0.1)
+        breaker.wait() # we're the probe, and we vanish
+        started = time.time()
+        breaker.wait()
+        assert 0.5 < time.time() - started < 3
+        assert breaker.state == 'probing'
+
+
+class TestThrottle:
+    'Tests for jottalib.throttle, against the emulator'
+
+    def test_bucket(self):
+        bucket = TokenBucket(100000)
+        started = time.time()
+        for _ in range(10):
+            bucket.consume(10000)
+        # the first 25000 bytes fit in the full bucket
+        assert 0.7 <= time.time() - started < 1.0
+        bucket.rate = None
+        assert bucket.consume(10**9) == 0
+        assert bucket.stats()['consumed'] == 10**9 + 100000
+
+    def test_upload_and_download(self, emu):
+        jfs = emu.client(upload_rate=100000, download_rate=100000)
+        started = time.time()
+        f = jfs.up('/Jotta/Archive/throttled.txt', six.BytesIO(TESTFILEDATA)) # 57kB
+        assert time.time() - started >= 0.25
+        started = time.time()
+        assert f.read() == TESTFILEDATA
+        assert time.time() - started >= 0.25
+        assert jfs.upload_bucket.stats()['consumed'] > len(TESTFILEDATA) # and the multipart framing
+        assert jfs.download_bucket.stats()['waited'] > 0
+        # limits are lifted at runtime
+        jfs.download_bucket.rate = None
+        started = time.time()
+        assert b''.join(f.stream()) == TESTFILEDATA
+        assert time.time() - started < 0.2
+
+    def test_shared_budget(self, emu):
+        emu.add_file('/Jotta/Archive/a.bin', b'a' * 100000)
+        emu.add_file('/Jotta/Archive/b.bin', b'b' * 100000)
+        jfs = emu.client()
+        files = [jfs.getObject('/Jotta/Archive/a.bin'), jfs.getObject('/Jotta/Archive/b.bin')]
+        finished = {}
+        def fetch(f):
+            assert len(b''.join(f.stream(chunk_size=8192))) == 100000
+            finished[f.name] = time.time()
+        GLOBAL_DOWNLOAD.rate = 400000
+        try:
+            started = time.time()
+            threads = [threading.Thread(target=fetch, args=(f,)) for f in files]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            GLOBAL_DOWNLOAD.rate = None
+        # 200kB at 400kB/s, less the burst, and both get their fair share along the way
+        assert max(finished.values()) - started >= 0.35
+        assert abs(finished['a.bin'] - finished['b.bin']) < 0.1
+
+
+class TestMultipart:
+    'Tests for jottalib.multipart'
+
+    def test_wire_format(self, tmpdir):
+        ondisk = tmpdir.join('data.bin')
+        ondisk.write_binary(TESTFILEDATA)
+        class Plain(object): # no fileno() or getbuffer(), so it's read
+            def __init__(self):
+                self.f = six.BytesIO(TESTFILEDATA)
+                self.read, self.seek, self.tell = self.f.read, self.f.seek, self.f.tell
+        for make in (lambda: six.BytesIO(TESTFILEDATA), lambda: open(str(ondisk), 'rb'), Plain):
+            for offset in (0, 1000):
+                fields = lambda f: {'md5': ('', 'abc'), 'created': ('', u'nå'),
+                                    'file': (u'ø.txt', f, 'application/octet-stream')}
+                expected = requests_toolbelt.MultipartEncoder(fields(six.BytesIO(TESTFILEDATA[offset:])),
+                                                              boundary='xyz').to_string()
+                f = make()
+                f.seek(offset) # we send from here
+                body = MultipartBody(fields(f), boundary='xyz', chunk_size=10000)
+                chunks = [bytes(chunk) for chunk in body]
+                assert b''.join(chunks) == expected
+                assert len(body) == len(expected) == body.bytes_read
+                assert max(len(c) for c in chunks) == 10000
+                f.seek(offset) # and .read() gets the same
+                body = MultipartBody(fields(f), boundary='xyz', chunk_size=10000)
+                read = [body.read(4096) for _ in range(len(expected) // 4096 + 2)]
+                assert b''.join(read) == expected
+                assert read[-1] == b'' and all(len(r) == 4096 for r in read[:-2])
+                getattr(f, 'close', lambda: None)()
+
+    def test_upload_callback(self, emu):
+        jfs = emu.client(upload_chunk_size=8192)
+        progress = []
+        f = jfs.up('/Jotta/Archive/chunked.txt', six.BytesIO(TESTFILEDATA),
+                   upload_callback=lambda monitor, size: progress.append((monitor.bytes_read, size)))
+        assert f.read() == TESTFILEDATA
+        assert len(progress) > len(TESTFILEDATA) // 8192
+        assert progress[-1][0] == progress[-1][1] > len(TESTFILEDATA)
+        assert progress == sorted(progress)
+
+    def test_upload_read(self, emu, jfs, monkeypatch):
+        monkeypatch.setattr(six, 'PY2', True) # so the body is .read(), as httplib on python 2 wants it
+        f = jfs.up('/Jotta/Archive/read.txt', six.BytesIO(TESTFILEDATA))
+        assert f.read() == TESTFILEDATA
+
+
+class TestReadAhead:
+    'Tests for jottalib.readahead'
+
+    def test_backpressure(self):
+        read = []
+        def chunks():
+            for i in range(20):
+                read.append(i)
+                yield i
+        counter = WaitCounter()
+        ahead = ReadAhead(chunks(), 4, counter=counter)
+        got = []
+        for chunk in ahead:
+            time.sleep(0.01)
+            # the reader stays within the queue, and the one it's holding
+            assert len(read) - len(got) <= 4 + 2
+            got.append(chunk)
+        assert got == list(range(20))
+        stats = counter.stats()
+        assert stats['chunks'] == 20
+        assert stats['reader_waits'] > 10 # the consumer is the slow one
+        assert stats['consumer_waits'] <= 2
+
+    def test_slow_reader_and_errors(self):
+        def chunks():
+            for i in range(3):
+                time.sleep(0.02)
+                yield i
+            raise IOError('network gone')
+        ahead = ReadAhead(chunks(), 4)
+        got = []
+        with pytest.raises(IOError):
+            for chunk in ahead:
+                got.append(chunk)
+        assert got == [0, 1, 2] # what came before the error
+        assert ahead.counter.stats()['consumer_waits'] >= 3
+
+    def test_close(self):
+        closed = threading.Event()
+        def chunks():
+            try:
+                while True:
+                    yield b'x'
+            finally:
+                closed.set()
+        with ReadAhead(chunks(), 2) as ahead:
+            assert next(ahead) == b'x'
+        assert closed.wait(1) # the reader let go of the generator
+        with pytest.raises(StopIteration):
+            next(ahead)
+
+    def test_stream(self, emu, jfs):
+        emu.add_file('/Jotta/Archive/readahead.bin', TESTFILEDATA)
+        f = jfs.getObject('/Jotta/Archive/readahead.bin')
+        assert b''.join(f.stream(chunk_size=8192, readahead=4)) == TESTFILEDATA
+        assert jfs.readahead_counter.stats()['chunks'] == 7
+        # for every stream of a client, and ranges and resumed downloads too
+        jfs = emu.client(readahead=4)
+        f = jfs.getObject('/Jotta/Archive/readahead.bin')
+        emu.fail(method='GET', path='readahead.bin', after=20000, stall=5)
+        assert b''.join(f.stream(chunk_size=8192, stall_timeout=0.5)) == TESTFILEDATA
+        assert b''.join(f.stream(workers=3, range_size=10000)) == TESTFILEDATA
+        assert jfs.readahead_counter.stats()['chunks'] > 7
+        assert b''.join(f.stream(readahead=0)) == TESTFILEDATA
+
+
+@pytest.mark.skipif(aio is None, reason="requires aiohttp")
+class TestAsyncJFS:
+    'Tests for jottalib.aio, against the emulator'
+
+    @pytest.fixture
+    def ajfs(self, emu):
+        'Yield (loop, a logged in AsyncJFS)'
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop) # for asyncio.gather()
+        ajfs = self.connect(loop, emu)
+        yield loop, ajfs
+        loop.run_until_complete(ajfs.close())
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    def connect(self, loop, emu, **kwargs):
+        'Get a logged in AsyncJFS for emu, made in the running loop, as aiohttp wants it'
+        made = loop.create_future()
+        loop.call_soon(lambda: made.set_result(emu.async_client(**kwargs)))
+        return loop.run_until_complete(loop.run_until_complete(made).__aenter__())
+
+    def test_getObject(self, emu, ajfs):
+        import asyncio
+        loop, ajfs = ajfs
+        ajfs.cache = ObjectCache() # like AsyncJFS(cache=True)
+        emu.add_file('/Jotta/Archive/a/x.txt', b'x')
+        folders = loop.run_until_complete(asyncio.gather(*[ajfs.getObject('/Jotta/Archive/a') for _ in range(5)]))
+        assert isinstance(folders[0], aio.AsyncJFSFolder)
+        assert [f.name for f in loop.run_until_complete(folders[0].files())] == ['x.txt']
+        gets = emu.stats['GET folder']
+        folder = loop.run_until_complete(ajfs.getObject('/Jotta/Archive/a'))
+        assert emu.stats['GET folder'] == gets and folder in folders # from the cache
+        emu.fail(method='GET', path='Archive/b', status=500)
+        with pytest.raises(JFS.JFSServerError):
+            loop.run_until_complete(ajfs.getObject('/Jotta/Archive/b'))
+        with pytest.raises(JFS.JFSNotFoundError):
+            loop.run_until_complete(ajfs.getObject('/Jotta/Archive/b'))
+
+    def test_up_and_stream(self, emu, ajfs):
+        loop, ajfs = ajfs
+        folder = loop.run_until_complete(ajfs.getObject('/Jotta/Archive'))
+        readers = set()
+        class Recording(six.BytesIO): # where is it read?
+            def read(self, *args):
+                readers.add(threading.current_thread())
+                return six.BytesIO.read(self, *args)
+        f = loop.run_until_complete(folder.up(Recording(TESTFILEDATA), 'async.txt', md5=hashlib.md5(TESTFILEDATA).hexdigest()))
+        assert readers and threading.current_thread() not in readers # not on the event loop
+        assert isinstance(f, aio.AsyncJFSFile)
+        with pytest.raises(JFS.JFSError):
+            f.download(six.BytesIO())
+        assert f.path == ajfs.rootpath + '/Jotta/Archive/async.txt'
+        assert f.md5 == hashlib.md5(TESTFILEDATA).hexdigest()
+        assert emu.stats['POST up'] == 1
+        assert emu.contents[f.md5] == TESTFILEDATA
+        # the upload threw the folder out of the cache
+        folder = loop.run_until_complete(ajfs.getObject('/Jotta/Archive'))
+        assert [f.name for f in loop.run_until_complete(folder.files())] == ['async.txt']
+        emu.fail(method='POST', path='async2.txt', status=500)
+        with pytest.raises(JFS.JFSServerError):
+            loop.run_until_complete(ajfs.up('/Jotta/Archive/async2.txt', six.BytesIO(b'x')))
+        stream = f.stream(chunk_size=8192)
+        chunks = []
+        while True:
+            try:
+                chunks.append(loop.run_until_complete(stream.__anext__()))
+            except StopAsyncIteration:
+                break
+        assert b''.join(chunks) == TESTFILEDATA
+        assert stream.response.closed
+
+    def test_stream_stopped_early(self, emu):
+        import asyncio
+        emu.add_file('/Jotta/Archive/big.bin', TESTFILEDATA * 10)
+        loop = asyncio.new_event_loop()
+        ajfs = self.connect(loop, emu, max_connections=1)
+        try:
+            f = loop.run_until_complete(ajfs.getObject('/Jotta/Archive/big.bin'))
+            stream = f.stream(chunk_size=1024)
+            assert len(loop.run_until_complete(stream.__anext__())) == 1024
+            loop.run_until_complete(stream.aclose())
+            assert stream.response.closed
+            # with only one connection, a leaked response would keep the next request waiting forever
+            loop.run_until_complete(asyncio.wait_for(ajfs.getObject('/Jotta/Archive'), 5))
+        finally:
+            loop.run_until_complete(ajfs.close())
+            loop.close()